@@ -2,6 +2,9 @@ import telegram
 from telegram_bot import bot
 from database import create_connection
 from rate_limiter import rate_limiter
+from broadcast import create_broadcast_job, is_admin_chat
+from menu_cache import bump_catalog_version, load_plant_data
+from repository import repository
 import logging
 
 logger = logging.getLogger(__name__)
@@ -29,7 +32,10 @@ async def show_admin_menu(chat_id):
 
         if is_admin == 1:
             keyboard = [
-                [telegram.InlineKeyboardButton("📢 Announcement", callback_data='admin_announcement')]
+                [telegram.InlineKeyboardButton("📢 Announcement", callback_data='admin_announcement')],
+                [telegram.InlineKeyboardButton("📊 Announcement Progress", callback_data='admin_broadcasts')],
+                [telegram.InlineKeyboardButton("📈 Economy Report", callback_data='admin_analytics')],
+                [telegram.InlineKeyboardButton("🔄 Reload Catalog", callback_data='admin_reload_catalog')]
             ]
             reply_markup = telegram.InlineKeyboardMarkup(keyboard)
             await bot.send_message(chat_id=chat_id, text='Choose an option:', reply_markup=reply_markup)
@@ -79,14 +85,9 @@ async def send_admin_announcement_text(chat_id, message, user_data):
             is_admin = 0  # Default to 0 if no result found
 
         if is_admin == 1:
-            cursor.execute("SELECT chat_id FROM users")
-            tosend_chat_ids = cursor.fetchall()
-            
-            for user_chat_id in tosend_chat_ids:
-                try:
-                    await bot.send_message(chat_id=user_chat_id[0], text=message)
-                except Exception as e:
-                    logger.error(f"Failed to send message to {user_chat_id[0]}: {e}")
+            # Queue the announcement; the broadcast worker sends it in the background
+            job_id, total_recipients = create_broadcast_job(chat_id, 'text', message)
+            await bot.send_message(chat_id=chat_id, text=f'Announcement #{job_id} queued for {total_recipients:,} users. You will receive progress reports.')
         else:
             await bot.send_message(chat_id=chat_id, text='You are not authorized to send announcements.')
 
@@ -127,15 +128,35 @@ async def send_admin_announcement_photo(chat_id, photo, user_data):
                 await bot.send_message(chat_id=chat_id, text='You are sending requests too quickly. Please wait a moment.')
                 return
             
-            cursor.execute("SELECT chat_id FROM users") 
-            tosend_chat_ids = cursor.fetchall()
-            
-            for user_chat_id in tosend_chat_ids:
-                try:
-                    await bot.send_photo(chat_id=user_chat_id[0], photo=photo)
-                except Exception as e:
-                    logger.error(f"Failed to send message to {user_chat_id[0]}: {e}")
+            # Queue the announcement; the broadcast worker sends it in the background
+            job_id, total_recipients = create_broadcast_job(chat_id, 'photo', photo)
+            await bot.send_message(chat_id=chat_id, text=f'Announcement #{job_id} queued for {total_recipients:,} users. You will receive progress reports.')
         else:
             await bot.send_message(chat_id=chat_id, text='You are not authorized to send announcements.')
 
     user_data[chat_id]['waiting_for_photo'] = False
+
+
+async def reload_catalog(chat_id, plant_data):
+    """Reload the plant and upgrade catalogs after an admin edited them, on this worker and then on every other one."""
+    if not is_admin_chat(chat_id):
+        await bot.send_message(chat_id=chat_id, text='You are not authorized to reload the catalog.')
+        return
+
+    # Other workers see the new version on their next update and reload their own copy
+    conn = create_connection()
+    bump_catalog_version(conn.cursor())
+    conn.commit()
+    conn.close()
+
+    try:
+        await repository.replicate_catalog()  # Shards and PostgreSQL keep their own copy of the plants
+        upgrade_catalog = load_plant_data(plant_data)
+    except Exception as e:
+        logger.error(f"Error reloading the catalog: {e}")
+        await bot.send_message(chat_id=chat_id, text='The catalog could not be reloaded. Please try again later.')
+        return
+
+    plants = sum(len(category) for category in plant_data.values())
+    ladders = ', '.join(f'{category} {len(ladder)}' for category, ladder in upgrade_catalog.ladders.items())
+    await bot.send_message(chat_id=chat_id, text=f'Catalog reloaded: {plants} plants, upgrades by category: {ladders}.')
\ No newline at end of file
@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import time
+import logging
+import numpy as np
+import pandas as pd
+from database import DATABASE_NAME, DATABASE_SHARDS, get_shard_path
+from crops import CROP_HARVESTED
+from backup import list_snapshots, connect_snapshot
+from broadcast import is_admin_chat
+from telegram_bot import bot
+
+logger = logging.getLogger(__name__)
+
+# Analytics configuration
+ANALYTICS_SOURCE = os.getenv('ANALYTICS_SOURCE', 'snapshot')  # 'snapshot' reads the newest verified backup, 'live' the database files read-only
+ANALYTICS_CHUNK_SIZE = int(os.getenv('ANALYTICS_CHUNK_SIZE', 100000))  # Rows read per chunk
+ANALYTICS_MAX_AGE = int(os.getenv('ANALYTICS_MAX_AGE', 300))  # Seconds a report is served before the tables are refreshed
+
+# Kinds of ledger entries, recognised by the start of their description
+LEDGER_KINDS = {
+    'Harvested': 'harvest',
+    'Manager payroll': 'payroll',
+    'Planted': 'planting',
+    'Purchased': 'upgrade',
+    'Initial cashflow': 'registration',
+}
+LEDGER_KIND_CATEGORIES = list(LEDGER_KINDS.values()) + ['other']
+
+# The plant name and quantity in harvest, payroll and planting descriptions, such as "Harvested 1,200 Corn(s)."
+LEDGER_PLANT_PATTERN = r'^(?:Harvested|Manager payroll for harvesting|Planted) ([\d,]+) (?:[^\w\s]\S* )?(.+?)\(s\)\.$'
+
+# Tables loaded so far, extended with the rows added since the last refresh
+analytics_cache = {'ledger': None, 'crops': None, 'plants': None, 'max_ids': {}, 'source': None, 'refreshed_at': None, 'report': None}
+
+def connect_sources():
+    """Return (name, read-only connection) for each file holding per-user tables, and the source's description.
+
+    Snapshots are preferred so reports never read the live files; without one, or with ANALYTICS_SOURCE=live,
+    the live files are opened read-only.
+    """
+    snapshots = list_snapshots() if ANALYTICS_SOURCE == 'snapshot' else []
+    if snapshots:
+        manifest = snapshots[0]
+        if manifest['shards'] > 1:
+            return [(f'shard{shard}', connect_snapshot(manifest['name'], shard)) for shard in range(manifest['shards'])], f"backup {manifest['name']}"
+        return [('main', connect_snapshot(manifest['name']))], f"backup {manifest['name']}"
+
+    if DATABASE_SHARDS > 1:
+        return [(f'shard{shard}', sqlite3.connect(f"file:{get_shard_path(shard)}?mode=ro", uri=True)) for shard in range(DATABASE_SHARDS)], 'live database'
+    return [('main', sqlite3.connect(f"file:{DATABASE_NAME}?mode=ro", uri=True))], 'live database'
+
+def downcast(frame, columns):
+    """Shrink integer and float columns to the smallest dtype that holds their values."""
+    for column in columns:
+        kind = 'integer' if pd.api.types.is_integer_dtype(frame[column]) else 'float'
+        frame[column] = pd.to_numeric(frame[column], downcast=kind)
+    return frame
+
+def parse_ledger_chunk(chunk, plant_names):
+    """Turn a chunk of ledger rows into compact columns: the description becomes its kind, plant and quantity.
+
+    Descriptions repeat a lot, so each distinct description is parsed once and the results are spread by code.
+    """
+    codes, descriptions = pd.factorize(chunk.pop('description').fillna(''))
+    descriptions = pd.Series(descriptions, dtype=object).astype(str)
+
+    kinds = pd.Series('other', index=descriptions.index)
+    for prefix, kind in LEDGER_KINDS.items():
+        kinds = kinds.mask(descriptions.str.startswith(prefix), kind)
+    parts = descriptions.str.extract(LEDGER_PLANT_PATTERN)
+    quantities = pd.to_numeric(parts[0].str.replace(',', '', regex=False), errors='coerce').fillna(0).astype(np.int64)
+
+    chunk['kind'] = pd.Categorical(kinds.to_numpy()[codes], categories=LEDGER_KIND_CATEGORIES)
+    chunk['plant'] = pd.Categorical(parts[1].to_numpy()[codes], categories=plant_names)
+    chunk['quantity'] = quantities.to_numpy()[codes]
+
+    return downcast(chunk, ['id', 'user_id', 'amount', 'transaction_date', 'quantity'])
+
+def read_chunks(conn, sql, params, parse):
+    """Read a query in chunks of ANALYTICS_CHUNK_SIZE rows, compacting each chunk before the next is read."""
+    chunks = [parse(chunk) for chunk in pd.read_sql_query(sql, conn, params=params, chunksize=ANALYTICS_CHUNK_SIZE)]
+    return pd.concat(chunks, ignore_index=True) if chunks else None
+
+def append_rows(frame, rows):
+    """Append newly read rows to a cached table, keeping the compact dtypes where they still fit."""
+    if rows is None or rows.empty:
+        return frame
+    if frame is None:
+        return rows
+    combined = pd.concat([frame, rows], ignore_index=True)
+    return downcast(combined, [column for column in combined.columns if pd.api.types.is_numeric_dtype(combined[column]) and not isinstance(combined[column].dtype, pd.CategoricalDtype)])
+
+def update_open_crops(crops, source, conn):
+    """Read the current status of the cached crops of a source that were not harvested yet.
+
+    Rows that no longer exist, merged away by the consolidation at startup, are dropped.
+    """
+    open_rows = crops.index[(crops['source'] == source) & (crops['status'] != CROP_HARVESTED)]
+    open_ids = crops.loc[open_rows, 'id'].astype(np.int64).tolist()
+
+    current = []
+    for start in range(0, len(open_ids), 900):  # Below SQLite's limit on query parameters
+        batch = open_ids[start:start + 900]
+        current.append(pd.read_sql_query(f"SELECT id, status, planted_quantity FROM user_crops WHERE id IN ({','.join('?' * len(batch))})", conn, params=batch))
+    if not current:
+        return crops
+    current = pd.concat(current).set_index('id')
+
+    ids = crops.loc[open_rows, 'id']
+    found = ids.isin(current.index)
+    for column in ('status', 'planted_quantity'):
+        # Widen the downcast column first, as the new values may not fit it
+        values = crops[column].astype(np.int64)
+        values.loc[open_rows[found.values]] = ids[found].map(current[column]).values
+        crops[column] = pd.to_numeric(values, downcast='integer')
+    return crops.drop(open_rows[~found.values]).reset_index(drop=True)
+
+def refresh_tables():
+    """Load the ledger, crops and plants, reading only the ledger and crop rows added since the last refresh.
+
+    Ledger rows never change once written, so rows up to the last id are kept as they are. Crop rows change
+    status until they are harvested, so the cached crops that are not harvested yet are read again.
+    """
+    sources, description = connect_sources()
+    cache = analytics_cache
+
+    # Row ids are per file, so a different set of files starts over
+    if set(cache['max_ids']) != {name for name, _ in sources}:
+        cache.update(ledger=None, crops=None, max_ids={name: (0, 0) for name, _ in sources})
+
+    try:
+        plants = pd.read_sql_query("SELECT id, name, emoji, min_harvesting_ratio, max_harvesting_ratio, seed_purchase_price, selling_price FROM plants_listing", sources[0][1])
+        plant_names = list(plants['name'].dropna().unique())
+
+        for name, conn in sources:
+            max_ledger_id, max_crop_id = cache['max_ids'][name]
+
+            ledger = read_chunks(conn, "SELECT id, user_id, amount, description, transaction_date FROM cashflow_ledger WHERE id > ? ORDER BY id",
+                                 (max_ledger_id,), lambda chunk: parse_ledger_chunk(chunk, plant_names))
+            crops = read_chunks(conn, "SELECT id, user_id, item_id, planted_at, status, planted_quantity FROM user_crops WHERE id > ? ORDER BY id",
+                                (max_crop_id,), lambda chunk: downcast(chunk, ['id', 'user_id', 'item_id', 'planted_at', 'status', 'planted_quantity']))
+            if ledger is not None:
+                ledger['source'] = pd.Categorical([name] * len(ledger), categories=list(cache['max_ids']))
+            if crops is not None:
+                crops['source'] = pd.Categorical([name] * len(crops), categories=list(cache['max_ids']))
+
+            # Crops that were still growing are read again for their current status
+            if cache['crops'] is not None:
+                cache['crops'] = update_open_crops(cache['crops'], name, conn)
+
+            cache['ledger'] = append_rows(cache['ledger'], ledger)
+            cache['crops'] = append_rows(cache['crops'], crops)
+            cache['max_ids'][name] = (
+                int(ledger['id'].max()) if ledger is not None else max_ledger_id,
+                int(crops['id'].max()) if crops is not None else max_crop_id,
+            )
+    finally:
+        for _, conn in sources:
+            conn.close()
+
+    cache.update(plants=plants, source=description, refreshed_at=time.time())
+    return cache
+
+def build_economy_report(ledger, crops, plants, now=None):
+    """Compute the standard economy reports from the ledger, crops and plants tables.
+
+    Return a dict with the money supply, the flows by kind of entry, the earnings per crop, the manager payroll
+    and the harvest shortfall against a normal season. The ledger does not record harvest events, so disaster
+    and low season losses are measured as that shortfall.
+    """
+    now = now or time.time()
+    amounts = ledger['amount'].astype(np.int64)
+
+    # Money supply: every balance is the sum of the user's ledger entries
+    balances = amounts.groupby(ledger['user_id']).sum()
+    money_supply = {
+        'total': int(balances.sum()),
+        'users': int(len(balances)),
+        'median_balance': float(balances.median()) if len(balances) else 0.0,
+        'top_1pct_share': float(balances.nlargest(max(len(balances) // 100, 1)).sum() / balances.sum()) if balances.sum() > 0 else 0.0,
+    }
+
+    # Money created and destroyed by each kind of entry, overall and in the last day
+    flows = amounts.groupby(ledger['kind'], observed=False).agg(['sum', 'count'])
+    recent = ledger['transaction_date'] >= now - 86400
+    flows['last_day'] = amounts[recent].groupby(ledger.loc[recent, 'kind'], observed=False).sum()
+
+    # Per crop: seeds bought, harvest income and payroll from the ledger, quantities from the crops
+    by_plant = pd.DataFrame({
+        'seed_spend': -amounts.where(ledger['kind'] == 'planting', 0).groupby(ledger['plant'], observed=False).sum(),
+        'income': amounts.where(ledger['kind'] == 'harvest', 0).groupby(ledger['plant'], observed=False).sum(),
+        'payroll': -amounts.where(ledger['kind'] == 'payroll', 0).groupby(ledger['plant'], observed=False).sum(),
+        'harvested_units': ledger['quantity'].where(ledger['kind'] == 'harvest', 0).astype(np.int64).groupby(ledger['plant'], observed=False).sum(),
+    })
+    plants = plants.set_index('name')
+    quantities = crops['planted_quantity'].astype(np.int64)
+    harvested = crops['status'] == CROP_HARVESTED
+    planted_by_item = quantities.groupby(crops['item_id']).sum()
+    harvested_by_item = quantities.where(harvested, 0).groupby(crops['item_id']).sum()
+    by_plant['planted_units'] = plants['id'].map(planted_by_item).fillna(0).astype(np.int64)
+    by_plant['harvested_plots'] = plants['id'].map(harvested_by_item).fillna(0).astype(np.int64)
+    by_plant['net'] = by_plant['income'] - by_plant['seed_spend'] - by_plant['payroll']
+
+    # What the harvested plots would have earned in a normal season, against what they earned
+    normal_ratio = (plants['min_harvesting_ratio'] + plants['max_harvesting_ratio']) / 2
+    expected = np.ceil(by_plant['harvested_plots'] * normal_ratio) * plants['selling_price']
+    by_plant['shortfall'] = (expected.fillna(0) - by_plant['income']).round().astype(np.int64)
+    by_plant = by_plant.fillna(0).sort_values('net', ascending=False)
+
+    payroll_rows = ledger['kind'] == 'payroll'
+    harvest_income = int(by_plant['income'].sum())
+    payroll = {
+        'total': int(-amounts[payroll_rows].sum()),
+        'users': int(ledger.loc[payroll_rows, 'user_id'].nunique()),
+        'share_of_income': float(-amounts[payroll_rows].sum() / harvest_income) if harvest_income else 0.0,
+    }
+
+    return {'money_supply': money_supply, 'flows': flows, 'crops': by_plant, 'payroll': payroll, 'ledger_rows': int(len(ledger)), 'crop_rows': int(len(crops))}
+
+def get_economy_report(force=False):
+    """Return the cached economy report, refreshing the tables and the report once it is older than ANALYTICS_MAX_AGE."""
+    cache = analytics_cache
+    if force or cache['report'] is None or time.time() - cache['refreshed_at'] >= ANALYTICS_MAX_AGE:
+        started = time.monotonic()
+        refresh_tables()
+        cache['report'] = build_economy_report(cache['ledger'], cache['crops'], cache['plants'])
+        cache['report']['duration'] = round(time.monotonic() - started, 2)
+        logger.info(f"Economy report refreshed from the {cache['source']} in {cache['report']['duration']} seconds ({cache['report']['ledger_rows']:,} ledger rows).")
+    return cache['report']
+
+def format_economy_report(report):
+    """Format an economy report as a short message for admins."""
+    money_supply, payroll, flows = report['money_supply'], report['payroll'], report['flows']
+    lines = [
+        '📈 Economy report',
+        f"Source: {analytics_cache['source']}, {time.strftime('%Y-%m-%d %H:%M', time.localtime(analytics_cache['refreshed_at']))}",
+        f"Money supply: ${money_supply['total']:,} across {money_supply['users']:,} users",
+        f"Median balance: ${money_supply['median_balance']:,.0f}, top 1% hold {money_supply['top_1pct_share']:.0%}",
+        '',
+        'Flows (all time / last day):',
+    ]
+    for kind, row in flows.iterrows():
+        if row['count']:
+            lines.append(f"• {kind}: ${int(row['sum']):,} / ${int(row['last_day']):,}")
+
+    lines += ['', 'Top crops by net earnings:']
+    for plant_name, row in report['crops'].head(5).iterrows():
+        shortfall = int(row['shortfall'])
+        lines.append(f"• {plant_name}: ${int(row['net']):,} net, ${int(row['income']):,} income, ${abs(shortfall):,} {'below' if shortfall >= 0 else 'above'} a normal season")
+
+    lines += ['', f"Manager payroll: ${payroll['total']:,} from {payroll['users']:,} users ({payroll['share_of_income']:.1%} of harvest income)"]
+    return '\n'.join(lines)
+
+async def show_economy_report(chat_id):
+    """Send an admin the economy report from the analytics snapshot."""
+    if not is_admin_chat(chat_id):
+        await bot.send_message(chat_id=chat_id, text='You are not authorized to access this menu.')
+        return
+
+    try:
+        # Loading the tables takes a while, so it runs on a thread instead of the event loop
+        report = await asyncio.to_thread(get_economy_report)
+    except Exception as e:
+        logger.error(f"Error building the economy report: {e}")
+        await bot.send_message(chat_id=chat_id, text='The economy report could not be built. Please try again later.')
+        return
+
+    await bot.send_message(chat_id=chat_id, text=format_economy_report(report))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the economy report from the newest backup, or from the live database read-only.')
+    parser.add_argument('--live', action='store_true')  # Read the live database files instead of the newest backup
+    args = parser.parse_args()
+
+    if args.live:
+        ANALYTICS_SOURCE = 'live'
+    report = get_economy_report(force=True)
+    print(format_economy_report(report))
+    print()
+    print(report['crops'].to_string())
+    print(f"\nBuilt in {report['duration']} seconds from {report['ledger_rows']:,} ledger rows and {report['crop_rows']:,} crop rows.")
\ No newline at end of file
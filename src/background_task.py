@@ -1,76 +1,138 @@
 import asyncio
-from datetime import datetime, timedelta
+import os
+import time
 import logging
 import telegram
-from database import create_connection
-from telegram_bot import bot
+from telegram_bot import bulk_bot
 from farm_manager import handle_manager_auto_harvest
+from reachability import is_reachable
+from repository import repository
+from broadcast import BROADCAST_RATE_PER_SECOND
+from overload import send_picture, get_level, LEVEL_ESSENTIAL
+from manager_pipeline import pipeline_stats
 
 logger = logging.getLogger(__name__)
 
+# After downtime, overdue crops are worked through in slices instead of all at once
+CATCH_UP_THRESHOLD = int(os.getenv('CATCH_UP_THRESHOLD', 1000))  # Overdue crops that switch a check to catch-up mode
+CATCH_UP_SLICE_SIZE = int(os.getenv('CATCH_UP_SLICE_SIZE', 200))  # Overdue crops marked ready per slice
+CATCH_UP_SLICE_INTERVAL = float(os.getenv('CATCH_UP_SLICE_INTERVAL', 1))  # Seconds between slices, left to interactive updates
+CATCH_UP_NOTIFY_WINDOW = int(os.getenv('CATCH_UP_NOTIFY_WINDOW', 600))  # Seconds the notifications of a backlog are spread over
+CATCH_UP_ACTIVE_WINDOW = int(os.getenv('CATCH_UP_ACTIVE_WINDOW', 86400))  # Users seen within this many seconds are served first
+
+# Progress of the current or last catch-up, reported in GET /metrics
+catch_up_stats = {'active': False, 'backlog': 0, 'processed': 0, 'remaining': 0, 'users_notified': 0, 'started_at': None, 'duration': None}
+
+def get_catch_up_stats():
+    """Return the progress of the current or last catch-up."""
+    return dict(catch_up_stats)
+
+async def get_ready_users(marked):
+    """Return the owners of the crops just marked ready, given as counts per user id, in the order of marked."""
+    users = await repository.get_users(marked)
+
+    ready_users = []
+    for user_id in marked:
+        user = users.get(user_id)
+        if user:
+            ready_users.append(user)
+            logger.info(f"User {user['username']} with chat_id {user['chat_id']} has crops ready for harvest.")
+        else:
+            logger.error(f"No chat_id found for user_id {user_id}")
+    return ready_users
+
+async def notify_ready_for_harvest(chat_ids, interval=0):
+    """Send the ready for harvest notification to each chat, waiting interval seconds between sends.
+
+    The notifications are dropped while the worker sheds load; the crops stay ready for harvest.
+    """
+    if get_level() >= LEVEL_ESSENTIAL:
+        logger.info(f"Overloaded: skipped {len(chat_ids):,} ready for harvest notifications.")
+        return
+
+    for chat_id in chat_ids:
+        # Skip users who blocked the bot
+        if not is_reachable(chat_id):
+            continue
+        try:
+            photo_path = '../images/ready_for_harvest.jpg'  # Replace with the path to your image file
+            await send_picture(bulk_bot, chat_id, photo_path, 'Your crops are ready for harvest! 🌾')
+        except telegram.error.BadRequest as e:
+            logger.error(f"Failed to send message to chat_id {chat_id}: {e}")  # Log the error
+        except Exception as e:
+            logger.error(f"An unexpected error occurred: {e}")  # Log any other unexpected errors
+
+        if interval:
+            await asyncio.sleep(interval)
+
+async def run_catch_up(backlog, backlog_users):
+    """Work through a backlog of overdue crops in slices, serving recently seen users and the oldest crops first.
+
+    The notifications of the backlog are spread over CATCH_UP_NOTIFY_WINDOW, and the manager harvests and
+    plants only for the users of each slice, so the database and Telegram see a steady load.
+    """
+    started = time.monotonic()
+    catch_up_stats.update(active=True, backlog=backlog, processed=0, remaining=backlog, users_notified=0, started_at=int(time.time()), duration=None)
+    logger.warning(f"Catch-up: {backlog:,} overdue crops of {backlog_users:,} users, notified over {CATCH_UP_NOTIFY_WINDOW} seconds.")
+
+    # Space the notifications so the backlog's users are notified across the window, never faster than broadcasts
+    notify_interval = max(CATCH_UP_NOTIFY_WINDOW / max(backlog_users, 1), 1 / BROADCAST_RATE_PER_SECOND)
+    notified = set()  # Chats with crops in several slices are notified once
+
+    try:
+        while True:
+            now = int(time.time())
+            marked = await repository.mark_due_crops_ready(now, limit=CATCH_UP_SLICE_SIZE, active_since=now - CATCH_UP_ACTIVE_WINDOW)
+            if not marked:
+                break
+
+            catch_up_stats['processed'] += sum(marked.values())
+            catch_up_stats['remaining'] = max(backlog - catch_up_stats['processed'], 0)  # Crops that came due since the start are not counted
+
+            users = await get_ready_users(marked)
+            chat_ids = [user['chat_id'] for user in users if user['chat_id'] not in notified]
+            notified.update(chat_ids)
+            await notify_ready_for_harvest(chat_ids, notify_interval)
+            catch_up_stats['users_notified'] = len(notified)
+
+            # Automation is paused for users who blocked the bot. The manager pipeline may harvest and replant the same
+            # users meanwhile: a harvest is paid once, and a planting checks the free plots and balance in its transaction.
+            await handle_manager_auto_harvest([user for user in users if user['manager_on_off'] == 1 and is_reachable(user['chat_id'])])
+
+            logger.info(f"Catch-up: {catch_up_stats['processed']:,} of {backlog:,} overdue crops processed, {len(notified):,} users notified.")
+
+            # Leave the database to interactive updates between slices
+            await asyncio.sleep(CATCH_UP_SLICE_INTERVAL)
+    finally:
+        catch_up_stats.update(active=False, remaining=0, duration=round(time.monotonic() - started, 1))
+
+    logger.warning(f"Catch-up finished: {catch_up_stats['processed']:,} crops of {len(notified):,} users in {catch_up_stats['duration']} seconds.")
+
 async def check_ready_for_harvest(users_to_notify):
     """Check for crops that are ready for harvest and notify users."""
     while True:
         await asyncio.sleep(30)  # Check every 30 seconds
-        
+
         try:
-            conn = create_connection()
-            cursor = conn.cursor()
-
-            # Get current time
-            current_time = datetime.now()
-
-            # Fetch crops that are ready for harvest
-            cursor.execute("""SELECT user_id, id, planted_at, item_id FROM user_crops WHERE status = 'planted'""")
-            crops_response = cursor.fetchall()
-
-            for crop in crops_response:
-                user_id = crop[0]
-                crop_id = crop[1]
-                planted_at = datetime.fromisoformat(crop[2].replace('Z', ''))  # Adjust if necessary
-                item_id = crop[3]
-
-                # Fetch plant details to get harvest time
-                cursor.execute("SELECT harvest_time FROM plants_listing WHERE id = ?", (item_id,))
-                plant = cursor.fetchone()
-
-                if plant:
-                    harvest_time_minutes = plant[0]
-                    harvest_ready_time = planted_at + timedelta(minutes=harvest_time_minutes)
-
-                    # Check if the crop is ready for harvest
-                    if current_time >= harvest_ready_time:
-                        # Update crop status to "Ready for Harvest"
-                        cursor.execute("UPDATE user_crops SET status = ? WHERE id = ?", ('Ready for Harvest', crop_id))
-
-                        # Fetch the chat_id from the users table
-                        cursor.execute("SELECT chat_id, username FROM users WHERE id = ?", (user_id,))
-                        user = cursor.fetchone()
-                        if user:
-                            chat_id = user[0]
-                            users_to_notify.add(chat_id)  # Add chat_id to notify list
-                            username = user[1]
-                            logger.info(f"User {username} with chat_id {chat_id} has crops ready for harvest.")
-                        else:
-                            logger.error(f"No chat_id found for user_id {user_id}")
-
-            conn.commit()
+            # A large backlog, such as after downtime, is worked through in slices
+            now = int(time.time())
+            backlog, backlog_users = await repository.count_due_crops(now)
+            if backlog > CATCH_UP_THRESHOLD:
+                await run_catch_up(backlog, backlog_users)
+                continue
+
+            # Mark the planted crops whose harvest time has passed as "Ready for Harvest"
+            for user in await get_ready_users(await repository.mark_due_crops_ready(now)):
+                users_to_notify.add(user['chat_id'])  # Add chat_id to notify list
         except Exception as e:
             logger.error(f"Error checking for ready crops: {e}")
-        finally:
-            conn.close()
 
         # Notify users
-        for chat_id in users_to_notify:
-            try:
-                photo_path = '../images/ready_for_harvest.jpg'  # Replace with the path to your image file
-                await bot.send_photo(chat_id=chat_id, photo=open(photo_path, 'rb'), caption='Your crops are ready for harvest! 🌾')     
-            except telegram.error.BadRequest as e:
-                logger.error(f"Failed to send message to chat_id {chat_id}: {e}")  # Log the error
-            except Exception as e:
-                logger.error(f"An unexpected error occurred: {e}")  # Log any other unexpected errors
+        await notify_ready_for_harvest(users_to_notify)
 
         # Clear the notify list for the next check
         users_to_notify.clear()
 
-        await handle_manager_auto_harvest()      
\ No newline at end of file
+        # The manager pipeline rescans the manager users itself, so this runs only while it is off or has stopped
+        if not pipeline_stats['running']:
+            await handle_manager_auto_harvest()
\ No newline at end of file
@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import time
+import logging
+from database import DATABASE_NAME, DATABASE_SHARDS, DATABASE_BUSY_TIMEOUT, get_shard_path
+
+logger = logging.getLogger(__name__)
+
+# Online backup configuration
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', 21600))  # Seconds between snapshots; 0 turns the backup job off
+BACKUP_DIR = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(DATABASE_NAME or '.')), 'backups'))  # Where snapshots are kept
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))  # Verified snapshots kept; older ones are deleted
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', 256))  # Pages copied per step while holding the read lock
+BACKUP_STEP_SLEEP = float(os.getenv('BACKUP_STEP_SLEEP', 0.02))  # Seconds between steps, left to the writers
+BACKUP_MAX_RESTARTS = int(os.getenv('BACKUP_MAX_RESTARTS', 3))  # Restarts caused by concurrent writes before copying in a single step
+
+MANIFEST_NAME = 'manifest.json'  # Written last, so a snapshot without it is incomplete
+
+class BackupRestarted(Exception):
+    """Raised to abort a stepped backup that keeps restarting because of concurrent writes."""
+
+def get_database_files():
+    """Return the paths of the files a snapshot copies: the main database and its shards."""
+    paths = [DATABASE_NAME]
+    if DATABASE_SHARDS > 1:
+        paths += [get_shard_path(shard) for shard in range(DATABASE_SHARDS)]
+    return paths
+
+def copy_database(source_path, target_path):
+    """Copy a live database with the backup API, a few pages at a time with sleeps between steps.
+
+    A step holds the read lock only while it copies BACKUP_PAGES_PER_STEP pages. A write by another connection
+    restarts the copy, so after BACKUP_MAX_RESTARTS restarts the rest is copied in one step, which in WAL mode
+    still does not block writers. Return the number of restarts.
+    """
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        # The remaining page count goes back up when the copy starts over
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted()
+        last_remaining = remaining
+        time.sleep(BACKUP_STEP_SLEEP)
+
+    source = sqlite3.connect(source_path, timeout=DATABASE_BUSY_TIMEOUT)
+    target = sqlite3.connect(target_path)
+    try:
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+        except BackupRestarted:
+            logger.warning(f"Backup of {source_path} restarted {BACKUP_MAX_RESTARTS} times under writes; copying the rest in one step.")
+            source.backup(target, pages=-1)
+
+        # A snapshot is a single self-contained file, readable without -wal and -shm files
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+    return restarts
+
+def get_ledger_checksum(conn, schema='main', up_to_id=None):
+    """Return (rows, sum of amounts, highest id) of the ledger in a database, optionally up to a ledger id."""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' AND name = 'cashflow_ledger'")
+    if not cursor.fetchone():
+        return 0, 0, 0
+    condition = f"WHERE id <= {int(up_to_id)}" if up_to_id is not None else ""
+    cursor.execute(f"SELECT COUNT(*), COALESCE(SUM(amount), 0), COALESCE(MAX(id), 0) FROM {schema}.cashflow_ledger {condition}")
+    return tuple(cursor.fetchone())
+
+def verify_copy(source_path, target_path):
+    """Check a copied file with PRAGMA integrity_check and compare its ledger with the live database.
+
+    The ledger only grows, so the rows of the copy must add up to the same count and sum as the live rows up to
+    the highest id in the copy. Return the verification details, with 'ok' set when both checks pass.
+    """
+    conn = sqlite3.connect(f"file:{target_path}?mode=ro", uri=True)
+    integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    rows, total, highest_id = get_ledger_checksum(conn)
+    conn.close()
+
+    source = sqlite3.connect(source_path, timeout=DATABASE_BUSY_TIMEOUT)
+    live_rows, live_total, _ = get_ledger_checksum(source, up_to_id=highest_id)
+    source.close()
+
+    ledger_ok = (rows, total) == (live_rows, live_total)
+    return {
+        'integrity': integrity,
+        'ledger_rows': rows,
+        'ledger_sum': total,
+        'ledger_max_id': highest_id,
+        'ok': integrity == 'ok' and ledger_ok,
+    }
+
+def take_snapshot():
+    """Copy every database file into a new snapshot directory, verify it and write its manifest.
+
+    A snapshot that fails verification is deleted. Return the snapshot's manifest.
+    """
+    started = time.monotonic()
+    created_at = int(time.time())
+    name = time.strftime('backup-%Y%m%d-%H%M%S', time.localtime(created_at))
+    directory = os.path.join(BACKUP_DIR, name)
+    os.makedirs(directory)
+
+    files = {}
+    try:
+        for source_path in get_database_files():
+            target_path = os.path.join(directory, os.path.basename(source_path))
+            restarts = copy_database(source_path, target_path)
+            files[os.path.basename(source_path)] = dict(verify_copy(source_path, target_path), restarts=restarts, size=os.path.getsize(target_path))
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    manifest = {
+        'name': name,
+        'created_at': created_at,
+        'duration': round(time.monotonic() - started, 2),
+        'shards': DATABASE_SHARDS,
+        'files': files,
+        'ok': all(details['ok'] for details in files.values()),
+    }
+    if not manifest['ok']:
+        shutil.rmtree(directory, ignore_errors=True)
+        logger.error(f"Backup {name} failed verification and was deleted: {files}")
+        return manifest
+
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    logger.info(f"Backup {name} written in {manifest['duration']} seconds: " + ', '.join(f"{file} ({details['size']:,} bytes, {details['ledger_rows']:,} ledger rows)" for file, details in files.items()))
+    return manifest
+
+def list_snapshots():
+    """Return the manifests of the verified snapshots, newest first."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+
+    manifests = []
+    for name in os.listdir(BACKUP_DIR):
+        manifest_path = os.path.join(BACKUP_DIR, name, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifests.append(json.load(manifest_file))
+    return sorted(manifests, key=lambda manifest: manifest['created_at'], reverse=True)
+
+def rotate_snapshots():
+    """Delete verified snapshots beyond the newest BACKUP_KEEP and any incomplete ones left by a crash."""
+    if not os.path.isdir(BACKUP_DIR):
+        return
+
+    keep = {manifest['name'] for manifest in list_snapshots()[:BACKUP_KEEP]}
+    for name in os.listdir(BACKUP_DIR):
+        path = os.path.join(BACKUP_DIR, name)
+        if name.startswith('backup-') and os.path.isdir(path) and name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info(f"Deleted backup {name}.")
+
+def connect_snapshot(name=None, shard=None):
+    """Open a verified snapshot read-only, the newest unless a name is given, for analytics queries.
+
+    Like database.create_connection, a shard is opened with the snapshot's main database attached as `core`.
+    """
+    snapshots = list_snapshots()
+    manifest = next((snapshot for snapshot in snapshots if name in (None, snapshot['name'])), None)
+    if manifest is None:
+        raise FileNotFoundError(f"No verified backup {name or ''} in {BACKUP_DIR}.")
+
+    directory = os.path.join(BACKUP_DIR, manifest['name'])
+    main_path = os.path.join(directory, os.path.basename(DATABASE_NAME))
+    if shard is None or manifest['shards'] == 1:
+        return sqlite3.connect(f"file:{main_path}?mode=ro", uri=True)
+
+    conn = sqlite3.connect(f"file:{os.path.join(directory, os.path.basename(get_shard_path(shard)))}?mode=ro", uri=True)
+    conn.execute("ATTACH DATABASE ? AS core", (f"file:{main_path}?mode=ro",))
+    return conn
+
+async def run_backup_job():
+    """Take a snapshot every BACKUP_INTERVAL seconds and rotate the old ones. Runs on the leader worker only."""
+    if not BACKUP_INTERVAL:
+        return
+
+    # Continue the schedule of the last snapshot across restarts
+    snapshots = list_snapshots()
+    next_at = snapshots[0]['created_at'] + BACKUP_INTERVAL if snapshots else time.time()
+
+    while True:
+        await asyncio.sleep(max(next_at - time.time(), 0))
+        next_at = time.time() + BACKUP_INTERVAL
+
+        try:
+            # The copy sleeps between steps, so it runs on a thread instead of the event loop
+            await asyncio.to_thread(take_snapshot)
+            await asyncio.to_thread(rotate_snapshots)
+        except Exception as e:
+            logger.error(f"Error taking a backup: {e}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Take, list and verify online backups of DATABASE_NAME and its shards.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('run', help='Take a snapshot now and rotate the old ones')
+    subparsers.add_parser('list', help='List the verified snapshots, newest first')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'run':
+        manifest = take_snapshot()
+        rotate_snapshots()
+        print(json.dumps(manifest, indent=2))
+    else:
+        for manifest in list_snapshots():
+            rows = sum(details['ledger_rows'] for details in manifest['files'].values())
+            print(f"{manifest['name']}: {len(manifest['files'])} file(s), {rows:,} ledger rows, {manifest['duration']} seconds")
\ No newline at end of file
@@ -0,0 +1,255 @@
+import asyncio
+import os
+import time
+import logging
+import telegram
+from database import create_connection
+from telegram_bot import bot, bulk_bot
+from overload import get_level, LEVEL_ESSENTIAL, OVERLOAD_SAMPLE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Broadcast configuration
+BROADCAST_RATE_PER_SECOND = float(os.getenv('BROADCAST_RATE_PER_SECOND', 20))  # Messages per second, below Telegram's limit of about 30
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', 500))  # Recipients read from users per query
+BROADCAST_POLL_INTERVAL = int(os.getenv('BROADCAST_POLL_INTERVAL', 5))  # Seconds between checks for new jobs
+BROADCAST_REPORT_INTERVAL = int(os.getenv('BROADCAST_REPORT_INTERVAL', 60))  # Seconds between progress reports to the admin
+
+def create_broadcast_job(admin_chat_id, kind, content):
+    """Queue a text or photo broadcast to every registered user. Return (job_id, recipient count)."""
+    conn = create_connection()
+    cursor = conn.cursor()
+
+    # Users who register after the job is created do not receive it, nor do users who blocked the bot
+    cursor.execute("SELECT COALESCE(MAX(id), 0), COUNT(CASE WHEN reachability = 'reachable' THEN 1 END) FROM users")
+    max_user_id, total_recipients = cursor.fetchone()
+
+    now = time.time()
+    cursor.execute("""
+        INSERT INTO broadcast_jobs (admin_chat_id, kind, content, status, max_user_id, total_recipients, created_at, updated_at)
+        VALUES (?, ?, ?, 'running', ?, ?, ?, ?)
+    """, (admin_chat_id, kind, content, max_user_id, total_recipients, now, now))
+    job_id = cursor.lastrowid
+
+    conn.commit()
+    conn.close()
+    return job_id, total_recipients
+
+def set_broadcast_status(job_id, status, from_statuses):
+    """Move a job to a new status if it is in one of from_statuses. Return True if it moved."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE broadcast_jobs SET status = ?, updated_at = ? WHERE id = ? AND status IN ({})".format(','.join('?' * len(from_statuses))), (status, time.time(), job_id, *from_statuses))
+    moved = cursor.rowcount == 1
+    conn.commit()
+    conn.close()
+    return moved
+
+def get_broadcast_job(job_id):
+    """Fetch (id, admin_chat_id, kind, status, cursor_user_id, sent_count, failed_count, total_recipients) of a job."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, admin_chat_id, kind, status, cursor_user_id, sent_count, failed_count, total_recipients FROM broadcast_jobs WHERE id = ?", (job_id,))
+    job = cursor.fetchone()
+    conn.close()
+    return job
+
+def format_broadcast_progress(job):
+    """Describe a job's progress in one line."""
+    job_id, _, kind, status, _, sent_count, failed_count, total_recipients = job
+    return f'📢 Broadcast #{job_id} ({kind}): {status} - {sent_count + failed_count:,}/{total_recipients:,} processed, {sent_count:,} sent, {failed_count:,} failed.'
+
+def build_broadcast_controls(job_id, status):
+    """Build the pause/resume/cancel buttons that apply to a job in the given status."""
+    keyboard = []
+    if status == 'running':
+        keyboard.append([telegram.InlineKeyboardButton("⏸️ Pause", callback_data=f'broadcast_pause_{job_id}')])
+    if status == 'paused':
+        keyboard.append([telegram.InlineKeyboardButton("▶️ Resume", callback_data=f'broadcast_resume_{job_id}')])
+    if status in ('running', 'paused'):
+        keyboard.append([telegram.InlineKeyboardButton("🛑 Cancel", callback_data=f'broadcast_cancel_{job_id}')])
+    return telegram.InlineKeyboardMarkup(keyboard) if keyboard else None
+
+async def report_broadcast_progress(job_id):
+    """Send the admin who started a job its current progress."""
+    job = get_broadcast_job(job_id)
+    if job is None:
+        return
+    try:
+        await bot.send_message(chat_id=job[1], text=format_broadcast_progress(job), reply_markup=build_broadcast_controls(job_id, job[3]))
+    except Exception as e:
+        logger.error(f"Failed to report progress of broadcast {job_id}: {e}")
+
+def recover_interrupted_send(cursor, job_id):
+    """Skip the recipient a previous run was sending to when it stopped, since it may already have been delivered."""
+    cursor.execute("SELECT in_flight_user_id FROM broadcast_jobs WHERE id = ?", (job_id,))
+    in_flight_user_id = cursor.fetchone()[0]
+
+    if in_flight_user_id is not None:
+        logger.warning(f"Broadcast {job_id}: delivery to user {in_flight_user_id} was interrupted and is not retried.")
+        cursor.execute("UPDATE broadcast_jobs SET in_flight_user_id = NULL, failed_count = failed_count + 1 WHERE id = ?", (job_id,))
+        cursor.connection.commit()
+
+def fetch_recipient_page(cursor, job_id):
+    """Return the next page of recipients after the job's cursor, or None if the job is not running."""
+    cursor.execute("SELECT cursor_user_id, max_user_id FROM broadcast_jobs WHERE id = ? AND status = 'running'", (job_id,))
+    job = cursor.fetchone()
+    if job is None:
+        return None
+
+    # Keyset pagination over users.id, so the position survives restarts and no page is read twice
+    cursor.execute("SELECT id, chat_id FROM users WHERE id > ? AND id <= ? AND reachability = 'reachable' ORDER BY id LIMIT ?", (job[0], job[1], BROADCAST_PAGE_SIZE))
+    return cursor.fetchall()
+
+def claim_recipient(cursor, job_id, user_id):
+    """Move a running job's cursor past a recipient before sending to them. Return False if the job is not running.
+
+    The claim is committed before the send, so a chat is never sent the same broadcast twice, even if the
+    process dies mid-send.
+    """
+    cursor.execute("UPDATE broadcast_jobs SET cursor_user_id = ?, in_flight_user_id = ?, updated_at = ? WHERE id = ? AND status = 'running'", (user_id, user_id, time.time(), job_id))
+    claimed = cursor.rowcount == 1
+    cursor.connection.commit()
+    return claimed
+
+async def send_broadcast(kind, content, chat_id):
+    """Send one broadcast message, waiting out Telegram's flood control if asked to."""
+    while True:
+        try:
+            if kind == 'photo':
+                await bulk_bot.send_photo(chat_id=chat_id, photo=content)
+            else:
+                await bulk_bot.send_message(chat_id=chat_id, text=content)
+            return
+        except telegram.error.RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.warning(f"Flood control while broadcasting, waiting {retry_after}s.")
+            await asyncio.sleep(retry_after)
+
+async def run_broadcast_job(job_id):
+    """Send a job to its remaining recipients at the configured rate until it is done, paused or cancelled."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT kind, content FROM broadcast_jobs WHERE id = ?", (job_id,))
+    kind, content = cursor.fetchone()
+
+    interval = 1 / BROADCAST_RATE_PER_SECOND
+    last_report = time.monotonic()
+    recover_interrupted_send(cursor, job_id)
+
+    try:
+        # Stream the recipients a page at a time instead of loading every chat_id
+        page = fetch_recipient_page(cursor, job_id)
+        while page:
+            for user_id, chat_id in page:
+                # Announcements wait while the worker sheds load
+                while get_level() >= LEVEL_ESSENTIAL:
+                    await asyncio.sleep(OVERLOAD_SAMPLE_INTERVAL)
+
+                # Stop as soon as the admin pauses or cancels the job
+                if not claim_recipient(cursor, job_id, user_id):
+                    page = None
+                    break
+                started = time.monotonic()
+
+                try:
+                    await send_broadcast(kind, content, chat_id)
+                    outcome = 'sent_count'
+                except Exception as e:
+                    logger.error(f"Broadcast {job_id}: failed to send to {chat_id}: {e}")
+                    outcome = 'failed_count'
+
+                cursor.execute(f"UPDATE broadcast_jobs SET {outcome} = {outcome} + 1, in_flight_user_id = NULL WHERE id = ?", (job_id,))
+                conn.commit()
+
+                if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    await report_broadcast_progress(job_id)
+
+                # Keep to the configured rate
+                await asyncio.sleep(max(0, interval - (time.monotonic() - started)))
+            else:
+                page = fetch_recipient_page(cursor, job_id)
+
+        # Every recipient has been handled unless the job was paused or cancelled in the meantime
+        cursor.execute("UPDATE broadcast_jobs SET status = 'done', updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+    await report_broadcast_progress(job_id)
+
+async def run_broadcast_worker():
+    """Process running broadcast jobs one at a time, oldest first. Runs on the leader worker only."""
+    while True:
+        try:
+            conn = create_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id LIMIT 1")
+            job = cursor.fetchone()
+            conn.close()
+
+            if job:
+                await run_broadcast_job(job[0])
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in broadcast worker: {e}")
+
+        await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+def is_admin_chat(chat_id):
+    """Return True if the chat belongs to an admin user."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT is_admin FROM users WHERE chat_id = ?", (chat_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result is not None and result[0] == 1
+
+async def show_broadcast_jobs(chat_id):
+    """Show an admin the progress of the most recent broadcast jobs."""
+    if not is_admin_chat(chat_id):
+        await bot.send_message(chat_id=chat_id, text='You are not authorized to manage announcements.')
+        return
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM broadcast_jobs ORDER BY id DESC LIMIT 5")
+    job_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+
+    if not job_ids:
+        await bot.send_message(chat_id=chat_id, text='No announcements have been sent yet.')
+        return
+
+    for job_id in job_ids:
+        job = get_broadcast_job(job_id)
+        await bot.send_message(chat_id=chat_id, text=format_broadcast_progress(job), reply_markup=build_broadcast_controls(job_id, job[3]))
+
+async def handle_broadcast_control(chat_id, callback_data):
+    """Pause, resume or cancel a broadcast job from its control buttons."""
+    if not is_admin_chat(chat_id):
+        await bot.send_message(chat_id=chat_id, text='You are not authorized to manage announcements.')
+        return
+
+    _, action, job_id = callback_data.split('_')
+    job_id = int(job_id)
+
+    transitions = {
+        'pause': ('paused', ['running']),
+        'resume': ('running', ['paused']),
+        'cancel': ('cancelled', ['running', 'paused']),
+    }
+    if action not in transitions:
+        logger.error(f"Unexpected broadcast control: {callback_data}")
+        return
+
+    status, from_statuses = transitions[action]
+    if not set_broadcast_status(job_id, status, from_statuses):
+        await bot.send_message(chat_id=chat_id, text=f'Broadcast #{job_id} cannot be {status} now.')
+        return
+
+    job = get_broadcast_job(job_id)
+    await bot.send_message(chat_id=chat_id, text=format_broadcast_progress(job), reply_markup=build_broadcast_controls(job_id, job[3]))
\ No newline at end of file
@@ -0,0 +1,243 @@
+import argparse
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import logging
+from datetime import datetime, timedelta
+from crops import CROP_STATUS_NAMES, consolidate_crop_rows
+
+logger = logging.getLogger(__name__)
+
+# Local 'YYYY-MM-DD HH:MM:SS' or isoformat() text to epoch seconds
+EPOCH_SQL = "CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+
+# Status text to status code
+STATUS_CODE_SQL = "CASE {column} " + ' '.join(f"WHEN '{name}' THEN {code}" for code, name in CROP_STATUS_NAMES.items()) + " END"
+
+# Columns rewritten by the migration: table -> {column: conversion}; the table is rebuilt while any of them is TEXT
+COMPACT_COLUMNS = {
+    'users': {'created_at': EPOCH_SQL},
+    'cashflow_ledger': {'transaction_date': EPOCH_SQL},
+    'user_crops': {'planted_at': EPOCH_SQL, 'status': STATUS_CODE_SQL},
+}
+
+# Read-only views with the old text columns, for reports and ad hoc queries written against the old schema
+LEGACY_VIEWS = {
+    'users_legacy': """
+        SELECT id, chat_id, username, datetime(created_at, 'unixepoch', 'localtime') AS created_at, manager_on_off, is_admin
+        FROM users
+    """,
+    'cashflow_ledger_legacy': """
+        SELECT id, user_id, amount, description, datetime(transaction_date, 'unixepoch', 'localtime') AS transaction_date
+        FROM cashflow_ledger
+    """,
+    'user_crops_legacy': """
+        SELECT id, user_id, item_id, datetime(planted_at, 'unixepoch', 'localtime') AS planted_at,
+               CASE status """ + ' '.join(f"WHEN {code} THEN '{name}'" for code, name in CROP_STATUS_NAMES.items()) + """ END AS status,
+               planted_quantity, ready_bucket
+        FROM user_crops
+    """,
+}
+
+def get_text_columns(cursor, table):
+    """Return the columns of a table that the migration still has to convert."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cursor.fetchall() if row[1] in COMPACT_COLUMNS[table] and row[2].upper() == 'TEXT']
+
+def rebuild_table(cursor, table):
+    """Copy a table into a new one with INTEGER timestamp and status columns, then swap it in.
+
+    Indexes are dropped with the old table; create_tables creates them again.
+    """
+    conversions = COMPACT_COLUMNS[table]
+
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    table_sql = cursor.fetchone()[0]
+
+    # The stored statement includes the columns added later with ALTER TABLE
+    compact_sql = re.sub(rf'^CREATE TABLE (IF NOT EXISTS )?"?{table}"?', f'CREATE TABLE {table}_compact', table_sql)
+    for column in conversions:
+        compact_sql = re.sub(rf'\b{column}\s+TEXT\b', f'{column} INTEGER', compact_sql)
+
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = [row[1] for row in cursor.fetchall()]
+    values = [conversions[column].format(column=column) if column in conversions else column for column in columns]
+
+    # Planted rows get their ready bucket again from the new planted_at
+    if table == 'user_crops' and 'ready_bucket' in columns:
+        values[columns.index('ready_bucket')] = 'NULL'
+
+    cursor.execute(f"DROP TABLE IF EXISTS {table}_compact")
+    cursor.execute(compact_sql)
+    cursor.execute(f"INSERT INTO {table}_compact ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_compact RENAME TO {table}")
+
+def migrate_to_compact_schema(cursor):
+    """Convert text timestamps to epoch seconds and crop status text to status codes, once.
+
+    Runs in its own IMMEDIATE transaction so concurrent workers starting up migrate only once.
+    Return the names of the tables rebuilt.
+    """
+    if not any(get_text_columns(cursor, table) for table in COMPACT_COLUMNS):
+        return []
+
+    cursor.connection.commit()
+    cursor.execute("BEGIN IMMEDIATE")
+
+    # The views reference the tables being swapped out
+    for view in LEGACY_VIEWS:
+        cursor.execute(f"DROP VIEW IF EXISTS {view}")
+
+    # Check again under the write lock, another worker may have migrated in the meantime
+    rebuilt = [table for table in COMPACT_COLUMNS if get_text_columns(cursor, table)]
+    for table in rebuilt:
+        rebuild_table(cursor, table)
+        logger.info(f"Migrated {table} to epoch timestamps and status codes.")
+
+    cursor.connection.commit()
+    return rebuilt
+
+def create_legacy_views(cursor):
+    """Create the views that expose the compact tables with their old text columns."""
+    for view, select_sql in LEGACY_VIEWS.items():
+        cursor.execute(f"CREATE VIEW IF NOT EXISTS {view} AS {select_sql}")
+
+def generate_legacy_database(path, users):
+    """Fill a new database with the old text schema at a given user count, for measurements."""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER UNIQUE, username TEXT, created_at TEXT, manager_on_off INTEGER, is_admin INTEGER DEFAULT 0)")
+    cursor.execute("CREATE TABLE cashflow_ledger (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount INTEGER, description TEXT, transaction_date TEXT)")
+    cursor.execute("CREATE TABLE plants_listing (id INTEGER PRIMARY KEY, name TEXT, harvest_time INTEGER)")
+    cursor.execute("CREATE TABLE user_crops (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, item_id INTEGER, planted_at TEXT, status TEXT, planted_quantity INTEGER, ready_bucket INTEGER)")
+    cursor.executemany("INSERT INTO plants_listing (id, name, harvest_time) VALUES (?, ?, ?)", [(plant_id, f'Plant {plant_id}', plant_id * 15) for plant_id in range(1, 11)])
+
+    now = datetime.now()
+    statuses = list(CROP_STATUS_NAMES.values())
+    for first_user in range(1, users + 1, 10000):
+        user_ids = range(first_user, min(first_user + 10000, users + 1))
+        cursor.executemany("INSERT INTO users (id, chat_id, username, created_at, manager_on_off) VALUES (?, ?, ?, ?, ?)", [
+            (user_id, 100000 + user_id, f'user{user_id}', (now - timedelta(days=random.randint(0, 365))).strftime('%Y-%m-%d %H:%M:%S'), random.randint(0, 1))
+            for user_id in user_ids
+        ])
+        # About 30 ledger entries and 5 crop rows per user, with both timestamp formats in use
+        cursor.executemany("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", [
+            (user_id, random.randint(-5000, 5000), 'Harvested 1,000 Plant(s).', (now - timedelta(seconds=random.randint(0, 90 * 86400))).strftime('%Y-%m-%d %H:%M:%S'))
+            if entry % 10 else
+            (user_id, -1000, 'Purchased plot upgrade to level 1', (now - timedelta(seconds=random.randint(0, 90 * 86400))).isoformat())
+            for user_id in user_ids for entry in range(30)
+        ])
+        cursor.executemany("INSERT INTO user_crops (user_id, item_id, planted_at, status, planted_quantity) VALUES (?, ?, ?, ?, ?)", [
+            (user_id, item_id, (now - timedelta(minutes=random.randint(0, 600))).strftime('%Y-%m-%d %H:%M:%S'), random.choice(statuses), random.randint(1, 10000))
+            for user_id in user_ids for item_id in range(1, 6)
+        ])
+    conn.commit()
+
+    # The same ready buckets and indexes as a production database before the migration
+    cursor.execute("""
+        UPDATE user_crops SET ready_bucket = (CAST(strftime('%s', planted_at) AS INTEGER)
+            + (SELECT harvest_time FROM plants_listing WHERE plants_listing.id = user_crops.item_id) * 60) / 60
+        WHERE status = 'planted'
+    """)
+    cursor.execute("CREATE UNIQUE INDEX idx_user_crops_planted_bucket ON user_crops (user_id, item_id, ready_bucket) WHERE status = 'planted'")
+    cursor.execute("CREATE INDEX idx_user_crops_user_status ON user_crops (user_id, status)")
+    conn.commit()
+    conn.close()
+
+def measure_sizes(cursor):
+    """Return the size in bytes of every table and index of interest."""
+    cursor.execute("""
+        SELECT name, SUM(pgsize) FROM dbstat
+        WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name IN ('users', 'cashflow_ledger', 'user_crops'))
+        GROUP BY name ORDER BY name
+    """)
+    return dict(cursor.fetchall())
+
+def measure_scans(cursor, repeat=3):
+    """Time the hot full scans, best of `repeat`, including the Python-side timestamp handling."""
+    cursor.execute("SELECT typeof(planted_at) FROM user_crops LIMIT 1")
+    compact = (cursor.fetchone() or ['integer'])[0] == 'integer'
+    planted = 0 if compact else "'planted'"
+    month_ago = time.time() - 30 * 86400
+
+    def ready_check():
+        # The harvest checker's loop over planted crops
+        cursor.execute(f"SELECT user_id, id, planted_at, item_id FROM user_crops WHERE status = {planted}")
+        for crop in cursor.fetchall():
+            planted_at = crop[2] if compact else datetime.fromisoformat(crop[2].replace('Z', '')).timestamp()
+
+    def balances():
+        cursor.execute("SELECT user_id, SUM(amount) FROM cashflow_ledger GROUP BY user_id")
+        cursor.fetchall()
+
+    def recent_ledger():
+        if compact:
+            cursor.execute("SELECT COUNT(*) FROM cashflow_ledger WHERE transaction_date >= ?", (int(month_ago),))
+        else:
+            cursor.execute("SELECT COUNT(*) FROM cashflow_ledger WHERE CAST(strftime('%s', transaction_date, 'utc') AS INTEGER) >= ?", (int(month_ago),))
+        cursor.fetchall()
+
+    timings = {}
+    for name, scan in (('ready check', ready_check), ('balances', balances), ('ledger, last 30 days', recent_ledger)):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            scan()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+def run_measurement(database, users):
+    """Migrate a copy of a database, or a generated one, and print sizes and scan times before and after."""
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'measure.db')
+
+    try:
+        if database:
+            # Never touch the original; the backup API gives a consistent copy even while the bot runs
+            source = sqlite3.connect(database)
+            target = sqlite3.connect(path)
+            source.backup(target)
+            source.close()
+            target.close()
+        else:
+            generate_legacy_database(path, users)
+
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        conn.execute("VACUUM")
+        sizes_before, scans_before = measure_sizes(cursor), measure_scans(cursor)
+        file_size_before = os.path.getsize(path)
+
+        rebuilt = migrate_to_compact_schema(cursor)
+        if not rebuilt:
+            print("The database already uses the compact schema.")
+        consolidate_crop_rows(cursor)
+        conn.commit()
+        conn.execute("VACUUM")
+        sizes_after, scans_after = measure_sizes(cursor), measure_scans(cursor)
+        conn.close()
+
+        print(f"{'table / index':<32} {'before (KiB)':>13} {'after (KiB)':>12}")
+        for name in sorted(set(sizes_before) | set(sizes_after)):
+            print(f"{name:<32} {sizes_before.get(name, 0) / 1024:>13,.0f} {sizes_after.get(name, 0) / 1024:>12,.0f}")
+        print(f"{'database file':<32} {file_size_before / 1024:>13,.0f} {os.path.getsize(path) / 1024:>12,.0f}")
+        print()
+        print(f"{'scan':<32} {'before (ms)':>13} {'after (ms)':>12}")
+        for name in scans_before:
+            print(f"{name:<32} {scans_before[name] * 1000:>13,.1f} {scans_after[name] * 1000:>12,.1f}")
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure table size and scan time before and after the compact schema migration.')
+    parser.add_argument('--database', help='Database to copy and migrate; it is not modified')  # Production copy
+    parser.add_argument('--users', type=int, default=100000)  # Users in the generated database when --database is not given
+    args = parser.parse_args()
+    run_measurement(args.database, args.users)
\ No newline at end of file
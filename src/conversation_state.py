@@ -0,0 +1,29 @@
+import json
+import time
+from database import create_connection
+
+def load_user_state(chat_id):
+    """Load the conversation state of a chat shared between workers."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT state FROM conversation_state WHERE chat_id = ?", (chat_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return json.loads(result[0]) if result else {}
+
+def save_user_state(chat_id, state):
+    """Persist the conversation state of a chat so any worker can pick it up."""
+    conn = create_connection()
+    cursor = conn.cursor()
+
+    if state:
+        cursor.execute("""
+            INSERT INTO conversation_state (chat_id, state, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+        """, (chat_id, json.dumps(state), time.time()))
+    else:
+        # Empty state needs no row
+        cursor.execute("DELETE FROM conversation_state WHERE chat_id = ?", (chat_id,))
+
+    conn.commit()
+    conn.close()
@@ -0,0 +1,221 @@
+import asyncio
+import os
+import logging
+from database import create_connection, connect_shard, DATABASE_SHARDS
+from earnings import record_ledger_entries, get_balance
+
+logger = logging.getLogger(__name__)
+
+# Plantings of the same plant that become ready within the same window share one user_crops row
+CROP_READY_BUCKET_SECONDS = int(os.getenv('CROP_READY_BUCKET_SECONDS', 60))
+
+# Seconds between consistency checks of the occupied_plots counters
+OCCUPIED_PLOTS_CHECK_INTERVAL = int(os.getenv('OCCUPIED_PLOTS_CHECK_INTERVAL', 3600))
+
+# user_crops.status codes
+CROP_PLANTED = 0
+CROP_READY = 1
+CROP_HARVESTED = 2
+CROP_STATUS_NAMES = {CROP_PLANTED: 'planted', CROP_READY: 'Ready for Harvest', CROP_HARVESTED: 'Harvested'}
+
+# Why a planting or an upgrade purchase was refused by the transaction that would have written it
+REFUSED_BALANCE = 'balance'
+REFUSED_PLOTS = 'plots'
+REFUSED_OWNED = 'owned'
+
+# Ready bucket of a row, from its planted_at epoch seconds and the plant's harvest time in minutes
+READY_BUCKET_SQL = "({planted_at} + {harvest_time} * 60) / {bucket}"
+
+def plant_crop(cursor, user_id, item_id, quantity, planted_at):
+    """Plant a crop, merging it into the user's planted row for the same plant and ready bucket if there is one.
+
+    Also adds the quantity to the user's occupied_plots counter in the same transaction.
+    """
+    ready_bucket = READY_BUCKET_SQL.format(
+        planted_at='?',
+        harvest_time='(SELECT harvest_time FROM plants_listing WHERE id = ?)',
+        bucket=CROP_READY_BUCKET_SECONDS,
+    )
+
+    # The merged row keeps the latest planted_at so no part of it is harvested early
+    cursor.execute(f"""
+        INSERT INTO user_crops (user_id, item_id, planted_at, status, planted_quantity, ready_bucket)
+        VALUES (?, ?, ?, {CROP_PLANTED}, ?, {ready_bucket})
+        ON CONFLICT(user_id, item_id, ready_bucket) WHERE status = {CROP_PLANTED}
+        DO UPDATE SET planted_quantity = planted_quantity + excluded.planted_quantity,
+                      planted_at = MAX(planted_at, excluded.planted_at)
+    """, (user_id, item_id, planted_at, quantity, planted_at, item_id))
+
+    # The new crop occupies plots until it is harvested
+    add_occupied_plots(cursor, [(quantity, user_id)])
+
+def record_planting(cursor, user_id, item_id, quantity, total_cost, description, planted_at, available_plots):
+    """Charge a planting to the user's ledger and plant the crop. Submitted to the write batcher.
+
+    The free plots and the balance are checked under the same write lock, so plantings arriving together cannot
+    overfill the farm or overspend. Return None once planted, or REFUSED_PLOTS or REFUSED_BALANCE.
+    """
+    if quantity > available_plots - get_occupied_plots(cursor, user_id):
+        return REFUSED_PLOTS
+    if get_balance(cursor, user_id) < total_cost:
+        return REFUSED_BALANCE
+
+    record_ledger_entries(cursor, [(user_id, -total_cost, description, planted_at)])
+    plant_crop(cursor, user_id, item_id, quantity, planted_at)
+    return None
+
+def record_harvest(cursor, harvests):
+    """Mark the crop rows of each (crop_ids, ledger_entries) harvest as harvested and write its ledger entries.
+
+    The ledger entries of a harvest are written only if all its rows were still ready, so crops harvested
+    concurrently are paid once. Return whether each harvest was recorded. Submitted to the write batcher.
+    """
+    recorded = []
+    for crop_ids, ledger_entries in harvests:
+        harvested = harvest_crop_rows(cursor, crop_ids) > 0
+        if harvested and ledger_entries:
+            record_ledger_entries(cursor, ledger_entries)
+        recorded.append(harvested)
+    return recorded
+
+def consolidate_crop_rows(cursor):
+    """Collapse active user_crops rows into one row per user, plant and ready bucket.
+
+    Planted rows are merged per ready bucket and rows that are already ready for harvest are merged per plant.
+    The surviving row is the oldest one of each group. Creates the unique index plant_crop relies on.
+    """
+    # Work out the ready bucket of planted rows written before buckets existed
+    cursor.execute(f"""
+        UPDATE user_crops SET ready_bucket = {READY_BUCKET_SQL.format(
+            planted_at='planted_at',
+            harvest_time='(SELECT harvest_time FROM plants_listing WHERE plants_listing.id = user_crops.item_id)',
+            bucket=CROP_READY_BUCKET_SECONDS,
+        )}
+        WHERE status = {CROP_PLANTED} AND ready_bucket IS NULL
+    """)
+
+    # Find the groups that have more than one row
+    cursor.execute(f"""
+        SELECT MIN(id), SUM(planted_quantity), MAX(planted_at), COUNT(*) FROM user_crops
+        WHERE status = {CROP_PLANTED} GROUP BY user_id, item_id, ready_bucket HAVING COUNT(*) > 1
+        UNION ALL
+        SELECT MIN(id), SUM(planted_quantity), MAX(planted_at), COUNT(*) FROM user_crops
+        WHERE status = {CROP_READY} GROUP BY user_id, item_id HAVING COUNT(*) > 1
+    """)
+    groups = cursor.fetchall()
+
+    collapsed_rows = 0
+    for keep_id, total_quantity, latest_planted_at, row_count in groups:
+        # Delete the rest of the group, then give the surviving row the group's total
+        cursor.execute(f"""
+            DELETE FROM user_crops WHERE id != ? AND id IN (
+                SELECT other.id FROM user_crops AS other JOIN user_crops AS kept ON kept.id = ?
+                WHERE other.user_id = kept.user_id AND other.item_id = kept.item_id AND other.status = kept.status
+                AND (other.status != {CROP_PLANTED} OR other.ready_bucket = kept.ready_bucket)
+            )
+        """, (keep_id, keep_id))
+        cursor.execute("UPDATE user_crops SET planted_quantity = ?, planted_at = ? WHERE id = ?", (total_quantity, latest_planted_at, keep_id))
+        collapsed_rows += row_count - 1
+
+    if collapsed_rows:
+        logger.info(f"Collapsed {collapsed_rows:,} active user_crops rows into {len(groups):,} aggregated rows.")
+
+    # At most one planted row per user, plant and ready bucket from now on
+    cursor.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_user_crops_planted_bucket
+        ON user_crops (user_id, item_id, ready_bucket) WHERE status = {CROP_PLANTED}
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_crops_user_status ON user_crops (user_id, status)")
+
+def add_occupied_plots(cursor, changes):
+    """Apply (quantity, user_id) changes to the occupied_plots counters.
+
+    With sharding the counters are kept in each shard's plot_counters table, so plantings and harvests write
+    only to the shard.
+    """
+    if DATABASE_SHARDS > 1:
+        cursor.executemany("""
+            INSERT INTO plot_counters (user_id, occupied_plots) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET occupied_plots = occupied_plots + excluded.occupied_plots
+        """, [(user_id, quantity) for quantity, user_id in changes])
+    else:
+        cursor.executemany("UPDATE users SET occupied_plots = COALESCE(occupied_plots, 0) + ? WHERE id = ?", changes)
+
+def get_occupied_plots(cursor, user_id):
+    """Return the number of plots the user's planted and ready crops occupy."""
+    if DATABASE_SHARDS > 1:
+        cursor.execute("SELECT occupied_plots FROM plot_counters WHERE user_id = ?", (user_id,))
+    else:
+        cursor.execute("SELECT occupied_plots FROM users WHERE id = ?", (user_id,))
+    result = cursor.fetchone()
+    return (result[0] or 0) if result else 0
+
+def harvest_crop_rows(cursor, crop_ids):
+    """Mark ready crop rows as harvested and free their plots, all of them or none if any is no longer ready.
+
+    The update comes first, so the rows are checked under the write lock. Return the number of rows harvested.
+    """
+    crop_ids = list(dict.fromkeys(crop_ids))
+    placeholders = ','.join('?' * len(crop_ids))
+
+    # Update the crop status to "Harvested" only if no row was harvested in the meantime
+    cursor.execute(f"""
+        UPDATE user_crops SET status = {CROP_HARVESTED} WHERE id IN ({placeholders}) AND status = {CROP_READY}
+        AND (SELECT COUNT(*) FROM user_crops WHERE id IN ({placeholders}) AND status = {CROP_READY}) = ?
+    """, crop_ids + crop_ids + [len(crop_ids)])
+    harvested_rows = cursor.rowcount
+    if harvested_rows == 0:
+        return 0
+
+    # Free the plots of the rows that were just harvested
+    cursor.execute(f"SELECT user_id, SUM(planted_quantity) FROM user_crops WHERE id IN ({placeholders}) GROUP BY user_id", crop_ids)
+    add_occupied_plots(cursor, [(-quantity, user_id) for user_id, quantity in cursor.fetchall()])
+    return harvested_rows
+
+def check_occupied_plots(fix=False):
+    """Compare every user's occupied_plots counter with their crops. Return the mismatches as (user_id, counter, actual)."""
+    mismatches = []
+
+    # Each shard holds its users' crops and plot counters, so the check never needs the main database
+    for shard in range(DATABASE_SHARDS):
+        conn = connect_shard(shard, attach_main=False) if DATABASE_SHARDS > 1 else create_connection()
+        cursor = conn.cursor()
+        counters_sql = "SELECT user_id, occupied_plots FROM plot_counters" if DATABASE_SHARDS > 1 else "SELECT id AS user_id, occupied_plots FROM users"
+
+        # Hold the write lock while correcting so no planting or harvest slips in between the check and the fix
+        if fix:
+            cursor.execute("BEGIN IMMEDIATE")
+
+        cursor.execute(f"""
+            SELECT counters.user_id, counters.occupied_plots, COALESCE(active.quantity, 0)
+            FROM ({counters_sql}) AS counters LEFT JOIN (
+                SELECT user_id, SUM(planted_quantity) AS quantity FROM user_crops
+                WHERE status = {CROP_PLANTED} OR status = {CROP_READY} GROUP BY user_id
+            ) AS active ON active.user_id = counters.user_id
+            WHERE COALESCE(counters.occupied_plots, 0) != COALESCE(active.quantity, 0)
+        """)
+        shard_mismatches = cursor.fetchall()
+
+        for user_id, counter, actual in shard_mismatches:
+            logger.warning(f"occupied_plots of user {user_id} is {counter} but their crops occupy {actual} plots.")
+
+        if fix and shard_mismatches:
+            # The counters are off by the difference, which add_occupied_plots applies in either storage mode
+            add_occupied_plots(cursor, [(actual - (counter or 0), user_id) for user_id, counter, actual in shard_mismatches])
+            logger.info(f"Corrected occupied_plots for {len(shard_mismatches)} users.")
+
+        conn.commit()
+        conn.close()
+        mismatches.extend(shard_mismatches)
+
+    return mismatches
+
+async def run_occupied_plots_checker():
+    """Periodically check and correct the occupied_plots counters."""
+    from repository import repository  # The repository builds on this module
+    while True:
+        await asyncio.sleep(OCCUPIED_PLOTS_CHECK_INTERVAL)
+        try:
+            await repository.check_occupied_plots(fix=True)
+        except Exception as e:
+            logger.error(f"Error checking occupied plots: {e}")
@@ -6,16 +6,71 @@ load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 
 # SQLite setup
 DATABASE_NAME = os.getenv('DATABASE_NAME')  # Define your SQLite database name
+DATABASE_BUSY_TIMEOUT = float(os.getenv('DATABASE_BUSY_TIMEOUT', 30))  # Seconds to wait for a lock held by another worker
 
-def create_connection():
-    """Create a database connection to the SQLite database."""
-    conn = sqlite3.connect(DATABASE_NAME)
+# Multi-worker setup
+WEB_WORKERS = int(os.getenv('WEB_CONCURRENCY', 1))  # Number of uvicorn worker processes
+SHARED_STATE = os.getenv('SHARED_STATE', '1' if WEB_WORKERS > 1 else '0') == '1'  # Keep conversation and rate limit state in SQLite
+
+# Sharded storage: per-user tables split across DATABASE_SHARDS files by the user's chat_id (1 keeps everything in DATABASE_NAME)
+DATABASE_SHARDS = int(os.getenv('DATABASE_SHARDS', 1))
+SHARDED_TABLES = ('cashflow_ledger', 'user_crops', 'user_upgrades', 'user_auto_planting')  # Rows live in the owner's shard
+CATALOG_TABLES = ('plants_listing', 'upgrade_listings')  # Copied into every shard so joins stay local
+
+def create_connection(chat_id=None):
+    """Create a database connection to the SQLite database.
+
+    With sharding, the connection for a chat opens the chat's shard with the main database attached as `core`,
+    so the same SQL reaches the per-user tables in the shard and users and the other shared tables in the main file.
+    """
+    if DATABASE_SHARDS > 1 and chat_id is not None:
+        return connect_shard(get_shard(chat_id))
+    conn = sqlite3.connect(DATABASE_NAME, timeout=DATABASE_BUSY_TIMEOUT)
+    return conn
+
+def get_shard(chat_id):
+    """Return the shard holding a chat's per-user rows."""
+    return chat_id % DATABASE_SHARDS
+
+def get_shard_path(shard):
+    """Return the file name of a shard, next to the main database."""
+    base, extension = os.path.splitext(DATABASE_NAME)
+    return f"{base}.shard{shard}{extension or '.db'}"
+
+def connect_shard(shard, attach_main=True):
+    """Open a shard, with the main database attached unless only per-user and catalog tables are needed."""
+    conn = sqlite3.connect(get_shard_path(shard), timeout=DATABASE_BUSY_TIMEOUT)
+    if attach_main:
+        conn.execute("ATTACH DATABASE ? AS core", (DATABASE_NAME,))
     return conn
 
+def shard_connections():
+    """Return one connection per shard for queries over every user, or a single connection without sharding."""
+    if DATABASE_SHARDS > 1:
+        return [connect_shard(shard) for shard in range(DATABASE_SHARDS)]
+    return [create_connection()]
+
+def shard_users_sql(shard):
+    """Return an SQL condition on users that selects the users of a shard."""
+    if DATABASE_SHARDS > 1:
+        return f"users.chat_id % {DATABASE_SHARDS} = {shard}"
+    return "1 = 1"
+
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to an existing table if it is not there yet. Return True if it was added."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in cursor.fetchall()]:
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
 def create_tables():
     """Create tables in the SQLite database if they don't exist."""
     conn = create_connection()
     cursor = conn.cursor()
+
+    # Use WAL so that several worker processes can read while one writes
+    cursor.execute("PRAGMA journal_mode=WAL")
     
     # Create users table
     cursor.execute('''
@@ -23,7 +78,7 @@ def create_tables():
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         chat_id INTEGER UNIQUE,
         username TEXT,
-        created_at TEXT,
+        created_at INTEGER,
         manager_on_off INTEGER,
         is_admin INTEGER DEFAULT 0
     )
@@ -36,7 +91,7 @@ def create_tables():
         user_id INTEGER,
         amount INTEGER,
         description TEXT,
-        transaction_date TEXT,
+        transaction_date INTEGER,
         FOREIGN KEY (user_id) REFERENCES users (id)
     )
     ''')
@@ -64,8 +119,8 @@ def create_tables():
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
         item_id INTEGER,
-        planted_at TEXT,
-        status TEXT,
+        planted_at INTEGER,
+        status INTEGER,
         planted_quantity INTEGER,
         FOREIGN KEY (user_id) REFERENCES users (id),
         FOREIGN KEY (item_id) REFERENCES plants_listing (id)           
@@ -104,6 +159,127 @@ def create_tables():
         FOREIGN KEY (item_id) REFERENCES plants_listing (id)
     )
     ''')
+
+    # Timestamps as epoch seconds and crop statuses as codes (see crops.CROP_STATUS_NAMES), converting older databases once
+    from compact_schema import migrate_to_compact_schema, create_legacy_views
+    migrate_to_compact_schema(cursor)
+
+    # Aggregated crop rows: one planted row per user, plant and ready bucket
+    add_column_if_missing(cursor, 'user_crops', 'ready_bucket', 'INTEGER')
+    from crops import consolidate_crop_rows, CROP_PLANTED, CROP_READY
+    consolidate_crop_rows(cursor)
+
+    # Plots occupied by planted and ready crops, maintained by crops.plant_crop and crops.harvest_crop_rows
+    if add_column_if_missing(cursor, 'users', 'occupied_plots', 'INTEGER DEFAULT 0'):
+        cursor.execute(f"""
+            UPDATE users SET occupied_plots = (
+                SELECT COALESCE(SUM(planted_quantity), 0) FROM user_crops
+                WHERE user_crops.user_id = users.id AND (status = {CROP_PLANTED} OR status = {CROP_READY})
+            )
+        """)
+
+    # Harvest notification preference: full, summary or silent
+    add_column_if_missing(cursor, 'users', 'notification_pref', "TEXT DEFAULT 'summary'")
+
+    # Add reachability columns to users (reachable, blocked or deactivated, with re-probe backoff)
+    add_column_if_missing(cursor, 'users', 'reachability', "TEXT DEFAULT 'reachable'")
+    add_column_if_missing(cursor, 'users', 'reachability_failed_at', 'REAL')
+    add_column_if_missing(cursor, 'users', 'reachability_failures', 'INTEGER DEFAULT 0')
+    add_column_if_missing(cursor, 'users', 'next_probe_at', 'REAL')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users (next_probe_at) WHERE reachability != 'reachable'")
+
+    # Last time the user sent an update (epoch seconds), written in batches; catch-up serves recent users first
+    add_column_if_missing(cursor, 'users', 'last_seen_at', 'INTEGER')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen_at)")
+
+    # Create worker_leases table (leader election between uvicorn workers)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS worker_leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT,
+        expires_at REAL,
+        heartbeat_at REAL
+    )
+    ''')
+
+    # Create manager_pipeline_checkpoints table (where a new leader's manager pipeline resumes reading plantings, per shard)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS manager_pipeline_checkpoints (
+        storage TEXT,
+        shard INTEGER,
+        checkpoint INTEGER,
+        saved_at INTEGER,
+        PRIMARY KEY (storage, shard)
+    )
+    ''')
+
+    # Create conversation_state table (per-chat state shared between workers)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversation_state (
+        chat_id INTEGER PRIMARY KEY,
+        state TEXT,
+        updated_at REAL
+    )
+    ''')
+
+    # Create rate_limit_events table (request timestamps shared between workers)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rate_limit_events (
+        chat_id INTEGER,
+        requested_at REAL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rate_limit_events_chat ON rate_limit_events (chat_id, requested_at)")
+
+    # Create broadcast_jobs table (admin announcements sent in the background)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_chat_id INTEGER,
+        kind TEXT,
+        content TEXT,
+        status TEXT,
+        cursor_user_id INTEGER DEFAULT 0,
+        max_user_id INTEGER,
+        in_flight_user_id INTEGER,
+        total_recipients INTEGER DEFAULT 0,
+        sent_count INTEGER DEFAULT 0,
+        failed_count INTEGER DEFAULT 0,
+        created_at REAL,
+        updated_at REAL
+    )
+    ''')
+
+    # Create update_dedupe table (bitmap of recently seen update ids)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS update_dedupe (
+        id INTEGER PRIMARY KEY,
+        highest INTEGER,
+        bitmap BLOB,
+        saved_at REAL
+    )
+    ''')
+
+    # Create catalog_version table (bumped when an admin reloads the catalogs, so every worker reloads them)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INTEGER PRIMARY KEY,
+        version INTEGER,
+        reloaded_at INTEGER
+    )
+    ''')
+
+    # Views with the old text timestamps and statuses for reports written against the old schema
+    create_legacy_views(cursor)
+
+    # Per-user, per-day earnings for the leaderboards, rebuilt from the ledger if they do not add up to it
+    from earnings import create_daily_earnings
+    create_daily_earnings(cursor)
     
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+    # Per-user tables, catalog copies and plot counters in every shard
+    if DATABASE_SHARDS > 1:
+        from shards import create_shard_tables
+        create_shard_tables()
\ No newline at end of file
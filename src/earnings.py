@@ -0,0 +1,107 @@
+import time
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Ledger entries are rolled up per user and UTC day (epoch seconds // 86400)
+SECONDS_PER_DAY = 86400
+
+# Ledger descriptions that mark a manager payroll and a harvest
+PAYROLL_PREFIX = 'Manager payroll'
+HARVEST_PREFIX = 'Harvested'
+
+# Leaderboard windows in days, None for all time
+RANKING_WINDOWS = {'today': 1, 'week': 7, 'all': None}
+RANKING_WINDOW_TITLES = {'today': 'Today', 'week': 'Last 7 Days', 'all': 'All Time'}
+
+# Per-user, per-day totals of the ledger, written in the same transaction as the ledger entries
+DAILY_EARNINGS_SQL = """
+    CREATE TABLE IF NOT EXISTS {schema}user_daily_earnings (
+        user_id INTEGER,
+        day INTEGER,
+        income INTEGER DEFAULT 0,
+        spend INTEGER DEFAULT 0,
+        payroll INTEGER DEFAULT 0,
+        harvests INTEGER DEFAULT 0,
+        entries INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    )
+"""
+
+# The rollup of every ledger row, classified the same way as roll_up_entries
+DAILY_EARNINGS_SELECT_SQL = f"""
+    SELECT user_id, transaction_date / {SECONDS_PER_DAY} AS day,
+           SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END),
+           SUM(CASE WHEN amount < 0 AND description NOT LIKE '{PAYROLL_PREFIX}%' THEN -amount ELSE 0 END),
+           SUM(CASE WHEN amount < 0 AND description LIKE '{PAYROLL_PREFIX}%' THEN -amount ELSE 0 END),
+           SUM(CASE WHEN description LIKE '{HARVEST_PREFIX}%' THEN 1 ELSE 0 END),
+           COUNT(*)
+    FROM cashflow_ledger GROUP BY user_id, day
+"""
+
+# Adds rolled up entries to a user's day
+DAILY_EARNINGS_UPSERT_SQL = """
+    INSERT INTO user_daily_earnings (user_id, day, income, spend, payroll, harvests, entries) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, day) DO UPDATE SET
+        income = income + excluded.income, spend = spend + excluded.spend, payroll = payroll + excluded.payroll,
+        harvests = harvests + excluded.harvests, entries = entries + excluded.entries
+"""
+
+def get_day(timestamp):
+    """Return the UTC day number of an epoch seconds timestamp."""
+    return int(timestamp) // SECONDS_PER_DAY
+
+def get_window_start(window, now=None):
+    """Return the first day of a leaderboard window, or None for all time."""
+    days = RANKING_WINDOWS[window]
+    return get_day(now or time.time()) - days + 1 if days else None
+
+def roll_up_entries(ledger_entries):
+    """Sum (user_id, amount, description, transaction_date) ledger entries per user and day.
+
+    Return (user_id, day, income, spend, payroll, harvests, entries) rows.
+    """
+    totals = defaultdict(lambda: [0, 0, 0, 0, 0])
+    for user_id, amount, description, transaction_date in ledger_entries:
+        row = totals[(user_id, get_day(transaction_date))]
+        is_payroll = (description or '').startswith(PAYROLL_PREFIX)
+        if amount > 0:
+            row[0] += amount
+        elif is_payroll:
+            row[2] -= amount
+        else:
+            row[1] -= amount
+        row[3] += (description or '').startswith(HARVEST_PREFIX)
+        row[4] += 1
+    return [key + tuple(row) for key, row in totals.items()]
+
+def get_balance(cursor, user_id):
+    """Return the sum of a user's ledger entries."""
+    cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM cashflow_ledger WHERE user_id = ?", (user_id,))
+    return cursor.fetchone()[0]
+
+def record_ledger_entries(cursor, ledger_entries):
+    """Insert (user_id, amount, description, transaction_date) entries into the ledger and add them to the daily rollups."""
+    cursor.executemany("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", ledger_entries)
+    cursor.executemany(DAILY_EARNINGS_UPSERT_SQL, roll_up_entries(ledger_entries))
+
+def create_daily_earnings(cursor, schema='main'):
+    """Create the daily rollups next to a ledger and rebuild them from the ledger if they do not add up to it.
+
+    This backfills the rollups of an existing ledger, and repairs them after rows were moved between shards.
+    """
+    cursor.execute(DAILY_EARNINGS_SQL.format(schema=f'{schema}.'))
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_user_daily_earnings_day ON user_daily_earnings (day)")
+
+    cursor.execute(f"SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM {schema}.cashflow_ledger")
+    ledger_totals = cursor.fetchone()
+    cursor.execute(f"SELECT COALESCE(SUM(entries), 0), COALESCE(SUM(income - spend - payroll), 0) FROM {schema}.user_daily_earnings")
+    if cursor.fetchone() == ledger_totals:
+        return False
+
+    started = time.monotonic()
+    cursor.execute(f"DELETE FROM {schema}.user_daily_earnings")
+    cursor.execute(f"INSERT INTO {schema}.user_daily_earnings (user_id, day, income, spend, payroll, harvests, entries) {DAILY_EARNINGS_SELECT_SQL.replace('FROM cashflow_ledger', f'FROM {schema}.cashflow_ledger')}")
+    logger.info(f"Rebuilt the daily earnings of {ledger_totals[0]:,} ledger entries in {time.monotonic() - started:.2f} seconds.")
+    return True
\ No newline at end of file
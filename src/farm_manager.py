@@ -1,32 +1,36 @@
 import telegram
 from datetime import datetime, timedelta
-from telegram_bot import bot
-from database import create_connection
+import time
+from telegram_bot import bot, bulk_bot, send_menu
 from rate_limiter import rate_limiter
 from plots import get_available_plots_slots
 from harvest_crops import harvest_crops
+from crops import CROP_PLANTED
+from planting import get_unlocked_plants, build_plants_keyboard
+from menu_cache import get_menu
+from repository import repository, STORAGE_BACKEND
+from user_mgnt import get_known_user
+from harvest_batch import MANAGER_HARVEST_MODE, run_manager_harvest_batch
+from overload import send_picture, get_level, LEVEL_ESSENTIAL
 
 
 async def show_manager_menu(chat_id):
     """Display the manager menu with options for plant selection."""
     keyboard = [
         [telegram.InlineKeyboardButton("👨‍🌾 Manager On/Off", callback_data='manager_on_off')],
-        [telegram.InlineKeyboardButton("👨‍🌾 Auto Planting", callback_data='auto_planting')]
+        [telegram.InlineKeyboardButton("👨‍🌾 Auto Planting", callback_data='auto_planting')],
+        [telegram.InlineKeyboardButton("🔔 Notifications", callback_data='manager_notifications')]
     ]
     reply_markup = telegram.InlineKeyboardMarkup(keyboard)
-    await bot.send_message(chat_id=chat_id, text='Choose an option:', reply_markup=reply_markup)
+    await send_menu(chat_id=chat_id, text='Choose an option:', reply_markup=reply_markup)
 
 async def handle_manager_on_off(chat_id):
     """Handle the manager on/off selection for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-
     # Fetch manager_on_off based on chat_id
-    cursor.execute("SELECT manager_on_off FROM users WHERE chat_id = ?", (chat_id,))
-    result = cursor.fetchone()  # Fetch the result once
+    user = await repository.get_user(chat_id)
 
     # Check if result is None
-    manager_on_off = result[0] if result else 0  # Default to 0 if no result found
+    manager_on_off = user['manager_on_off'] if user else 0  # Default to 0 if no result found
 
     if manager_on_off == 0:
         message = ('Manager is currently off.\n'
@@ -46,9 +50,7 @@ async def handle_manager_on_off(chat_id):
     # Create inline keyboard for confirmation
     reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-    await bot.send_message(chat_id=chat_id, text=message, reply_markup=reply_markup)
-
-    conn.close()
+    await send_menu(chat_id=chat_id, text=message, reply_markup=reply_markup)
 
 async def handle_manager_on(chat_id):
     """Handle the manager on selection for the user."""
@@ -56,65 +58,39 @@ async def handle_manager_on(chat_id):
         await bot.send_message(chat_id=chat_id, text='You are sending requests too quickly. Please wait a moment.')
         return
 
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET manager_on_off = 1 WHERE chat_id = ?", (chat_id,))
-    conn.commit()
-    conn.close()
+    await repository.set_manager_on_off(chat_id, 1)
     await bot.send_message(chat_id=chat_id, text='Manager has been turned on.')
 
 async def handle_manager_off(chat_id):
     """Handle the manager off selection for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("UPDATE users SET manager_on_off = 0 WHERE chat_id = ?", (chat_id,))
-    conn.commit()
-    conn.close()
+    await repository.set_manager_on_off(chat_id, 0)
     await bot.send_message(chat_id=chat_id, text='Manager has been turned off.')
 
 async def handle_auto_planting(chat_id):
     """Handle the auto planting selection for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-    
     # Fetch user ID based on chat_id
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()  # Fetch the result once
+    user = await get_known_user(chat_id)
 
     if user is None:
         await bot.send_message(chat_id=chat_id, text='User not found. Please register first.')
-        conn.close()
         return  # Exit the function if user is not found
 
-    user_id = user[0]  # Now it's safe to access user[0]
-
     # Fetch item_id for the user's auto planting
-    cursor.execute("SELECT item_id FROM user_auto_planting WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()  # Fetch the result once
-
-    if result is None:
-        item_id = None  # No item_id found
-    else:
-        item_id = result[0]  # Now it's safe to access result[0]
+    item_id = await repository.get_auto_planting(user)
 
     if item_id:
-        cursor.execute("SELECT emoji, name, seed_purchase_price, selling_price, harvest_time FROM plants_listing WHERE id = ?", (item_id,))
-        plant_data = cursor.fetchone()  # Fetch plant data
+        plant_data = await repository.get_plant(item_id)  # Fetch plant data
 
         if plant_data is None:
             await bot.send_message(chat_id=chat_id, text='Error: Plant not found.')
-            conn.close()
             return  # Exit if plant data is not found
 
-        emoji, name, seed_purchase_price, selling_price, harvest_time = plant_data
-
         # Construct the message with upgrade details
         current_auto_planting_message = (
-            f'Current Auto Planting: {emoji} {name}\n'
-            f'Seed Purchase Price: ${seed_purchase_price:,}\n'
-            f'Selling Price: ${selling_price:,}\n'
-            f'Harvest Time: {harvest_time} mins\n'
+            f'Current Auto Planting: {plant_data["emoji"]} {plant_data["name"]}\n'
+            f'Seed Purchase Price: ${plant_data["seed_purchase_price"]:,}\n'
+            f'Selling Price: ${plant_data["selling_price"]:,}\n'
+            f'Harvest Time: {plant_data["harvest_time"]} mins\n'
             'Do you want to change your auto planting seeds?'
         )
 
@@ -125,7 +101,7 @@ async def handle_auto_planting(chat_id):
         ]
         reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-        await bot.send_message(chat_id=chat_id, text=current_auto_planting_message, reply_markup=reply_markup)
+        await send_menu(chat_id=chat_id, text=current_auto_planting_message, reply_markup=reply_markup)
     else:
         # Construct the message with upgrade details
         current_auto_planting_message = (
@@ -140,9 +116,7 @@ async def handle_auto_planting(chat_id):
         ]
         reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-        await bot.send_message(chat_id=chat_id, text=current_auto_planting_message, reply_markup=reply_markup)
-
-    conn.close()
+        await send_menu(chat_id=chat_id, text=current_auto_planting_message, reply_markup=reply_markup)
 
 async def handle_change_auto_planting_category(chat_id):
     """Handle the change auto planting category selection for the user."""
@@ -153,7 +127,7 @@ async def handle_change_auto_planting_category(chat_id):
     ]
     reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-    await bot.send_message(chat_id=chat_id, text='Choose a category to auto plant:', reply_markup=reply_markup)
+    await send_menu(chat_id=chat_id, text='Choose a category to auto plant:', reply_markup=reply_markup)
 
 async def show_auto_planting_plants(chat_id, category, plant_data):
     """Display specific plants based on the selected category."""
@@ -161,251 +135,121 @@ async def show_auto_planting_plants(chat_id, category, plant_data):
         await bot.send_message(chat_id=chat_id, text='No plants available in this category.')
         return
 
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
-
-    # Fetch all upgrade IDs for the user
-    cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-    user_upgrades = cursor.fetchall()  # Fetch all upgrades
+    # The menu only depends on which crop upgrades the user has unlocked
+    crop_unlocks, filtered_plants = await get_unlocked_plants(chat_id, category, plant_data)
+    text, reply_markup = get_menu('auto_planting_plants', category, crop_unlocks, lambda: (
+        f"Choose a plant to auto plant from {category.capitalize()}:",
+        build_plants_keyboard(filtered_plants, lambda plant: f"auto_plant_{plant['id']}")
+    ))
 
-    # Filter the plants in the category to only include the ones with NULL upgrade_id or the plants with upgrade_id that is in the user_upgrades
-    filtered_plants = [plant for plant in plant_data[category] if plant['upgrade_id'] is None or plant['upgrade_id'] in [upgrade_id[0] for upgrade_id in user_upgrades]]
-    
-    keyboard = [
-        [telegram.InlineKeyboardButton(
-            f"{plant['emoji']} {plant['name']} - ⬇${plant['seed_purchase_price']}/⬆${plant['selling_price']} - {plant['harvest_time']} min",
-            callback_data=f"auto_plant_{plant['id']}"
-        )]
-        for plant in filtered_plants
-    ]
-    reply_markup = telegram.InlineKeyboardMarkup(keyboard)
-
-    await bot.send_message(chat_id=chat_id, text=f"Choose a plant to auto plant from {category.capitalize()}:", reply_markup=reply_markup)
+    await send_menu(chat_id=chat_id, text=text, reply_markup=reply_markup)
 
 async def handle_auto_planting_plant_selection(chat_id, callback_data):
     """Handle the auto planting plant selection for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-    plant_id = callback_data.split('_')[2]
-    cursor.execute("SELECT name FROM plants_listing WHERE id = ?", (plant_id,))
-    plant_name = cursor.fetchone()[0]
+    plant_id = int(callback_data.split('_')[2])
+    plant = await repository.get_plant(plant_id)
 
     #register the plant selection
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user_id = cursor.fetchone()[0]
-
-    # Check if the existing entry is already in the user_auto_planting table
-    cursor.execute("SELECT id FROM user_auto_planting WHERE user_id = ?", (user_id,))
-    existing_entry = cursor.fetchone()
-
-    if existing_entry:
-        cursor.execute("UPDATE user_auto_planting SET item_id = ? WHERE id = ?", (plant_id, existing_entry[0],))
-        conn.commit()
+    user = await get_known_user(chat_id)
+    existing_item_id = await repository.get_auto_planting(user)
+    await repository.set_auto_planting(user, plant_id)
+
+    if existing_item_id is not None:
         await bot.send_message(chat_id=chat_id, text='You have successfully changed your auto planting seeds.')
-    
     else:
-        cursor.execute("INSERT INTO user_auto_planting (user_id, item_id) VALUES (?, ?)", (user_id, plant_id))
-        conn.commit()
-        await bot.send_message(chat_id=chat_id, text=f'You have successfully selected {plant_name} to auto plant.')
-
-    conn.close()
-
-async def handle_manager_auto_harvest():
-    """Handle the manager auto harvest for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
+        await bot.send_message(chat_id=chat_id, text=f'You have successfully selected {plant["name"]} to auto plant.')
 
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT chat_id, manager_on_off FROM users")
-    users = cursor.fetchall()
-
-    for user in users:
-        chat_id = user[0]
-        manager_on_off = user[1]
-
-        if manager_on_off == 1:
-            await harvest_crops(chat_id)
-    
-    conn.commit()
-    conn.close()
-
-    await handle_manager_auto_planting()
-
-async def handle_manager_auto_planting():
-    """Handle the manager auto planting for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id, chat_id, manager_on_off FROM users")
-    users = cursor.fetchall()
-
-    for user in users:
-        user_id = user[0]
-        chat_id = user[1]
-        manager_on_off = user[2]
-
-        if manager_on_off == 1:
-            # Handle the max planting callback
-            cursor.execute("SELECT item_id FROM user_auto_planting WHERE user_id = ?", (user_id,))
-            item_id = cursor.fetchone()
-            plant_id = item_id[0]
-
-            if plant_id:
-                plant_id = int(plant_id)  # Ensure plant_id is an integer
+async def harvest_manager_users(users=None):
+    """Harvest the ready crops of every manager user, or only of the given ones."""
+    if users is not None and not users:
+        return
 
-                # Fetch the plant details for the description
-                cursor.execute("SELECT seed_purchase_price, emoji, name FROM plants_listing WHERE id = ?", (plant_id,))
-                price, emoji, name = cursor.fetchone()
+    # Large manager cycles can harvest the users in one batch instead of user by user (SQLite storage only)
+    if MANAGER_HARVEST_MODE != 'per_user' and STORAGE_BACKEND == 'sqlite':
+        await run_manager_harvest_batch(user_ids=[user['id'] for user in users] if users is not None else None)
+        return
 
-                # Fetch cashflow entries for the user
-                cursor.execute("SELECT amount FROM cashflow_ledger WHERE user_id = ?", (user_id,))
-                balance_response = cursor.fetchall()
+    # Automation is paused for users who blocked the bot
+    for user in users if users is not None else await repository.get_manager_users():
+        await harvest_crops(user['chat_id'], interactive=False)
 
-                # Calculate total balance
-                total_balance = sum(entry[0] for entry in balance_response) if balance_response else 0
+async def handle_manager_auto_harvest(users=None):
+    """Handle the manager auto harvest for every manager user, or only for the given ones (catch-up slices)."""
+    await harvest_manager_users(users)
+    await handle_manager_auto_planting(users)
 
-                # Calculate max quantity
-                max_affordable_quantity = int(total_balance // price) if price > 0 else 0
+async def handle_manager_auto_planting(users=None):
+    """Handle the manager auto planting for every manager user, or only for the given ones."""
+    # Automation is paused for users who blocked the bot
+    for user in users if users is not None else await repository.get_manager_users():
+        chat_id = user['chat_id']
 
-                # Fetch the user's current upgrade level
-                cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-                user_upgrades = cursor.fetchall()  # Fetch all upgrades
+        # Handle the max planting callback
+        plant_id = await repository.get_auto_planting(user)
 
-                # Determine the highest upgrade level
-                current_upgrade_level = 0  # Default to 0 if no upgrades
-                if user_upgrades:
-                    # Extract upgrade IDs
-                    upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
+        if plant_id:
+            # Fetch the plant details for the description
+            plant = await repository.get_plant(int(plant_id))
+            price, emoji, name = plant['seed_purchase_price'], plant['emoji'], plant['name']
 
-                    # Fetch levels for all upgrade IDs, filtering by category 'plot'
-                    cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), upgrade_ids + ['plot'])
-                    levels = cursor.fetchall()
+            # Calculate total balance
+            total_balance = await repository.get_balance(user)
 
-                    # Find the maximum level
-                    current_upgrade_level = max(level[0] for level in levels) if levels else 0
+            # Calculate max quantity
+            max_affordable_quantity = int(total_balance // price) if price > 0 else 0
 
-                    # Get available slots based on the current upgrade level
-                    available_slots = get_available_plots_slots(current_upgrade_level)
+            # Get available slots based on the user's plot upgrade level, 0 if they own only other upgrades
+            upgrade_ids = await repository.get_upgrade_ids(user)
+            current_upgrade_level = repository.get_upgrade_level(upgrade_ids, 'plot')
+            if upgrade_ids:
+                available_slots = get_available_plots_slots(current_upgrade_level)
 
-                    # Fetch crops for the user from the user_crops table
-                    cursor.execute("SELECT SUM(planted_quantity) FROM user_crops WHERE user_id = ? AND (status = 'planted' OR status = 'Ready for Harvest')", (user_id,))
-                    occupied_slots = cursor.fetchone()[0] or 0  # Default to 0 if no crops planted
+                # Fetch the number of occupied plots
+                occupied_slots = await repository.get_occupied_plots(user)
 
-                    # Ensure max quantity does not exceed available slots   
-                    max_quantity = min(max_affordable_quantity, available_slots - occupied_slots)
+                # Ensure max quantity does not exceed available slots   
+                max_quantity = min(max_affordable_quantity, available_slots - occupied_slots)
 
-                    if max_quantity > 0:
-                        # Deduct cashflow
-                        transaction_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Format as 'YYYY-MM-DD HH:MM:SS'
+                if max_quantity > 0:
+                    # Deduct cashflow
+                    transaction_date = int(time.time())  # Seconds since the epoch
 
-                        total_cost = max_quantity * price
-                            
-                        description = f'Planted {max_quantity} {emoji} {name}(s).'  # Use plant name and emoji
+                    total_cost = max_quantity * price
+                        
+                    description = f'Planted {max_quantity} {emoji} {name}(s).'  # Use plant name and emoji
 
-                        cursor.execute("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", 
-                                       (user_id, -total_cost, description, transaction_date))
+                    # Charge the ledger and plant the crop in one transaction, which checks the slots and balance again
+                    # so a concurrent planting for the same user cannot overfill the farm or overspend
+                    if await repository.record_planting(user, plant['id'], max_quantity, total_cost, description, transaction_date, available_slots):
+                        continue
 
-                        # Insert into user_crops
-                        cursor.execute("INSERT INTO user_crops (user_id, item_id, planted_at, status, planted_quantity) VALUES (?, ?, ?, ?, ?)",
-                                       (user_id, plant_id, transaction_date, 'planted', max_quantity))
+                    # Send a small-sized picture to the user, unless manager reports are paused under load
+                    if get_level() >= LEVEL_ESSENTIAL:
+                        continue
+                    photo_path = '../images/manager_planting.webp'  # Replace with the path to your image file
+                    await send_picture(bulk_bot, chat_id, photo_path, f'Farm Manager has directed to plant {max_quantity:,} {name}(s) for ${total_cost:,}!')
 
-                        # Commit the transaction
-                        conn.commit()  # Ensure changes are saved to the database
+async def check_auto_planting_status(chat_id):
+    """Check the auto planting status of the user's crops and update if ready for harvest."""
+    user = await get_known_user(chat_id)
 
-                        # Send a small-sized picture to the user
-                        photo_path = '../images/manager_planting.webp'  # Replace with the path to your image file
-                        await bot.send_photo(chat_id=chat_id, photo=open(photo_path, 'rb'), caption=f'Farm Manager has directed to plant {max_quantity:,} {name}(s) for ${total_cost:,}!')  # Optional caption
+    if user:
+        current_time = datetime.now()  # Get current local time
+        crops_ready = []  # Planted crops whose harvest time has passed
 
-    conn.commit()
-    conn.close()
+        for crop in await repository.get_crops(user):
+            # Fetch plant details using the item_id
+            plant = await repository.get_plant(crop['item_id'])
 
-async def check_auto_planting_status(chat_id):
-    """Check the auto planting status of the user's crops and update if ready for harvest."""
+            if plant and crop['status'] == CROP_PLANTED:
+                # Calculate harvest ready time
+                harvest_ready_time = datetime.fromtimestamp(crop['planted_at']) + timedelta(minutes=plant['harvest_time'])
 
-    conn = create_connection()  # Create a connection to the SQLite database
-    cursor = conn.cursor()
-
-    # Fetch user ID from the database
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
-
-    if user_id:
-        # Fetch crops for the user from the user_crops table
-        cursor.execute("SELECT * FROM user_crops WHERE user_id = ?", (user_id,))
-        crops_response = cursor.fetchall()
-        
-        if crops_response:
-            crops_status = []
-            current_time = datetime.now()  # Get current local time
-
-            # Get the user's current upgrade level
-            cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-            user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-            # Determine the highest upgrade level
-            current_upgrade_level = 0  # Default to 0 if no upgrades
-            if user_upgrades:
-                # Extract upgrade IDs
-                upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
-
-                # Fetch levels for all upgrade IDs, filtering by category 'plot'
-                cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), upgrade_ids + ['plot'])
-                levels = cursor.fetchall()
-
-                # Find the maximum level
-                current_upgrade_level = max(level[0] for level in levels) if levels else 0
-
-            for crop in crops_response:
-                # Skip crops that are already harvested
-                if crop[4] == 'Harvested':  # Assuming status is the fifth column
-                    continue
-
-                # Fetch plant details using the item_id
-                cursor.execute("SELECT * FROM plants_listing WHERE id = ?", (crop[2],))  # Assuming item_id is the third column
-                plant = cursor.fetchone()
-
-                if plant:
-                    # Convert planted_at to a local datetime
-                    planted_at = datetime.fromisoformat(crop[3].replace('Z', ''))  # Assuming planted_at is the fourth column
-                    # Calculate harvest ready time
-                    harvest_time_minutes = plant[7]  # Assuming harvest_time is the seventh column
-                    harvest_ready_time = planted_at + timedelta(minutes=harvest_time_minutes)  # Calculate harvest ready time
-
-                    # Initialize status variable
-                    status = ""
-
-                    # Check if the crop is ready for harvest
-                    if current_time >= harvest_ready_time:
-                        # Only update status if it is not already harvested
-                        if crop[4] == 'planted':  # Assuming status is the fifth column
-                            # Update the crop status to "Ready for Harvest"
-                            cursor.execute("UPDATE user_crops SET status = ? WHERE id = ?", ('Ready for Harvest', crop[0]))  # Assuming crop ID is the first column
-                            status = "Ready for Harvest"
-                        if crop[4] == 'Ready for Harvest':  # Assuming status is the fifth column
-                            status = "Ready for Harvest"
-                    else:
-                        # Calculate remaining time until harvest
-                        remaining_time = harvest_ready_time - current_time
-                        remaining_minutes = int(remaining_time.total_seconds() // 60)  # Convert to minutes
-                        status = f"Planted - {remaining_minutes} mins left"
-
-                    # Ensure crop quantity is treated as an integer
-                    quantity = int(crop[5])  # Assuming crop[5] is the quantity
-                    crops_status.append(f"{plant[3]} {plant[1]} - {status} - Qty: {quantity:,}")  # Assuming emoji is the third column and name is the second
-                else:
-                    crops_status.append(f"Crop ID: {crop[2]} - Status: {crop[4]} - Quantity: {crop[5]} (Plant details not found)")  # Assuming item_id is the third column
+                # Update the crop status to "Ready for Harvest" once the harvest time has passed
+                if current_time >= harvest_ready_time:
+                    crops_ready.append(crop['id'])
 
+        if crops_ready:
+            await repository.mark_crops_ready(user, crops_ready)
     else:
-        await bot.send_message(chat_id=chat_id, text='User not found.')
-
-    conn.commit()  # Commit any changes made
-    conn.close()  # Close the database connection
\ No newline at end of file
+        await bot.send_message(chat_id=chat_id, text='User not found.')
\ No newline at end of file
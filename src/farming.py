@@ -11,11 +11,25 @@ import asyncio
 from contextlib import asynccontextmanager
 import sys
 import io
-from database import create_connection, create_tables
-from telegram_bot import bot
+from database import create_tables, WEB_WORKERS, SHARED_STATE
+from telegram_bot import bot, initialize_bots, shutdown_bots, get_transport_stats, webhook_reply
 from rate_limiter import rate_limiter
-from background_task import check_ready_for_harvest
-from message_handler import handle_message
+from background_task import check_ready_for_harvest, get_catch_up_stats
+from message_handler import handle_message, handle_callback_query
+from leader_election import run_as_leader
+from conversation_state import load_user_state, save_user_state
+from harvest_batch import shutdown_harvest_executors
+from crops import run_occupied_plots_checker
+from broadcast import run_broadcast_worker
+from reachability import mark_reachable, run_reachability_prober
+from menu_cache import load_plant_data, catalog_reloaded_elsewhere
+from write_batcher import get_write_stats
+from repository import repository
+from user_mgnt import get_update_username, note_username, note_seen, flush_usernames, flush_last_seen, run_username_refresher
+from update_dedupe import accept_update, load_update_window, save_update_window, run_update_window_saver, get_dedupe_stats
+from backup import run_backup_job
+from manager_pipeline import run_manager_pipeline, get_pipeline_stats
+from overload import track_update, get_overload_stats, run_overload_controller
 
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 
@@ -51,6 +65,8 @@ logger.addHandler(file_handler)
 
 # Replace with your actual bot token
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+NGROK_ENABLED = os.getenv('NGROK_ENABLED', '1') == '1'  # Set to 0 when the app sits behind its own public URL
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL')  # Public URL to register when ngrok is disabled
 
 # Global variable to store ngrok process
 ngrok_process = None  # Declare the ngrok_process variable
@@ -99,33 +115,26 @@ async def process_queue():
         message_queue.task_done()  # Mark the task as done
 
 async def fetch_plant_data():
-    """Fetch plant data from the plants_listing table and store it in a global variable."""
-    global plant_data
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM plants_listing")
-    plants = cursor.fetchall()
-
-    if plants:
-        for plant in plants:
-            category = plant[2]  # Assuming category is the third column
-            if category not in plant_data:
-                plant_data[category] = []
-            plant_info = {
-                'id': plant[0],  # ID
-                'name': plant[1],  # Name
-                'emoji': plant[3],  # Emoji
-                'seed_purchase_price': plant[6],  # Seed purchase price
-                'min_harvesting_ratio': plant[4],  # Min harvesting ratio
-                'max_harvesting_ratio': plant[5],  # Max harvesting ratio
-                'harvest_time': plant[7],  # Harvest time
-                'selling_price': plant[8],  # Selling price
-                'upgrade_id': plant[9]  # Upgrade ID
-            }
-            plant_data[category].append(plant_info)
-
-    conn.close()
+    """Fetch plant data from the plants_listing table and store it in a global variable, with the upgrade catalog."""
+    load_plant_data(plant_data)
+
+async def run_webhook_tunnel():
+    """Open the ngrok tunnel and register the webhook, keeping the tunnel up until cancelled."""
+    global ngrok_process
+
+    if NGROK_ENABLED:
+        ngrok_process = start_ngrok()  # Start ngrok and store the process
+        ngrok_url = get_ngrok_url()  # Get ngrok URL
+        set_telegram_webhook(ngrok_url)  # Set the Telegram webhook
+    elif WEBHOOK_BASE_URL:
+        set_telegram_webhook(WEBHOOK_BASE_URL)  # Set the Telegram webhook
+
+    try:
+        await asyncio.Event().wait()  # Hold the tunnel open while this worker is the leader
+    finally:
+        if ngrok_process:
+            ngrok_process.terminate()  # Terminate the ngrok process
+            ngrok_process = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -133,17 +142,35 @@ async def lifespan(app: FastAPI):
 
     # Startup logic
     create_tables()  # Create necessary tables
-    ngrok_process = start_ngrok()  # Start ngrok and store the process
-    ngrok_url = get_ngrok_url()  # Get ngrok URL
-    set_telegram_webhook(ngrok_url)  # Set the Telegram webhook
+    await repository.open()  # Connect to the storage of the player data
+    await initialize_bots()  # Open the outbound connection pools
     
     # Fetch plant data on startup
     await fetch_plant_data()  # Load plant data into memory
 
+    # Remember the updates handled before a restart
+    load_update_window()
+    window_saver_task = asyncio.create_task(run_update_window_saver())
+
+    # Username changes are written in batches by every worker
+    username_refresher_task = asyncio.create_task(run_username_refresher())
+
+    # Every worker degrades its own replies when it falls behind
+    overload_task = asyncio.create_task(run_overload_controller())
+
     logger.info("Startup logic completed.")
 
-    # Start the check_ready_for_harvest task in the background
-    asyncio.create_task(check_ready_for_harvest(users_to_notify))  # Run the background task
+    # Only the elected leader worker runs the tunnel and the check_ready_for_harvest task,
+    # so crops are not harvested or notified once per worker
+    leader_task = asyncio.create_task(run_as_leader('background_jobs', [
+        run_webhook_tunnel,
+        lambda: check_ready_for_harvest(users_to_notify),
+        run_occupied_plots_checker,
+        run_broadcast_worker,
+        run_reachability_prober,
+        run_backup_job,
+        run_manager_pipeline,
+    ]))
 
     # Start the queue processing in the background
     asyncio.create_task(process_queue())
@@ -152,23 +179,79 @@ async def lifespan(app: FastAPI):
 
     # Shutdown logic
     logger.info("Shutting down the application...")
-    if ngrok_process:
-        ngrok_process.terminate()  # Terminate the ngrok process
+    leader_task.cancel()  # Stops the background jobs, closes the tunnel and releases the lease
+    await asyncio.gather(leader_task, return_exceptions=True)
+    window_saver_task.cancel()
+    save_update_window()  # Keep the latest updates for the next start
+    username_refresher_task.cancel()
+    overload_task.cancel()
+    flush_usernames()  # Write the username changes still queued
+    flush_last_seen()  # Write the last seen times still queued
+    shutdown_harvest_executors()  # Stop the manager harvest worker pools
+    await repository.close()  # Commit the writes still queued and close the connections
+    await shutdown_bots()  # Close the outbound connections
 
 # Assign the lifespan context to the app
 app = FastAPI(lifespan=lifespan)
 
+@app.get("/metrics")
+async def metrics():
+    """Expose this worker's outbound connection pool, update deduplication, write batching, catch-up, overload and manager pipeline counters for monitoring."""
+    return JSONResponse(content={"telegram": get_transport_stats(), "updates": get_dedupe_stats(), "writes": get_write_stats(), "catch_up": get_catch_up_stats(), "overload": get_overload_stats(), "manager_pipeline": get_pipeline_stats()})
+
 @app.post("/webhook")
 async def webhook(request: Request):
     update = await request.json()
     logger.info(f"Received update: {update}")
 
+    # Telegram redelivers updates it did not get a timely answer for; acknowledge them without handling them again
+    if not accept_update(update.get('update_id')):
+        return JSONResponse(content={"status": "ok"})
+
+    # Updates in progress count towards the queue depth the overload controller watches
+    with track_update():
+        async with webhook_reply() as reply:
+            if SHARED_STATE:
+                # Another worker may have handled the previous step of this conversation
+                response = await handle_update_with_shared_state(update)
+            else:
+                response = await handle_update(update, user_data)
+
+    # A handler that sent a single message gets it delivered with the webhook response, saving a round trip
+    if reply.payload is not None:
+        return JSONResponse(content=reply.payload)
+    return response
+
+async def handle_update_with_shared_state(update):
+    """Handle an update with the chat's conversation state loaded from and saved back to SQLite."""
+    if 'message' in update:
+        chat_id = update['message']['chat']['id']
+    elif 'callback_query' in update:
+        chat_id = update['callback_query']['message']['chat']['id']
+    else:
+        return JSONResponse(content={"status": "ok"})
+
+    shared_user_data = {chat_id: load_user_state(chat_id)}
+    try:
+        return await handle_update(update, shared_user_data)
+    finally:
+        save_user_state(chat_id, shared_user_data[chat_id])
+
+async def handle_update(update, user_data):
+    """Dispatch a message or callback query update to the message handler."""
+    # Pick up a catalog reloaded by an admin on another worker
+    if catalog_reloaded_elsewhere():
+        await fetch_plant_data()
+
     # Check if the update contains a message
     if 'message' in update:
         chat_id = update['message']['chat']['id']
         text = update['message'].get('text', '')  # Use .get() to avoid KeyError
 
         logger.info(f"Received message: {text} from chat_id: {chat_id}")
+        mark_reachable(chat_id)  # A user who writes to the bot has unblocked it
+        note_username(chat_id, get_update_username(update))  # Queue a username change for the next batched update
+        note_seen(chat_id)  # Catch-up after downtime serves recently seen users first
 
         # Rate limiting check
         if not rate_limiter(chat_id):
@@ -186,6 +269,9 @@ async def webhook(request: Request):
         callback_data = callback_query['data']
 
         logger.info(f"Received callback query: {callback_data} from chat_id: {chat_id}")
+        mark_reachable(chat_id)  # A user who taps a button has unblocked the bot
+        note_username(chat_id, get_update_username(update))  # Queue a username change for the next batched update
+        note_seen(chat_id)  # Catch-up after downtime serves recently seen users first
 
         # Rate limiting check
         if not rate_limiter(chat_id):
@@ -193,10 +279,11 @@ async def webhook(request: Request):
             return JSONResponse(content={"status": "ok"})  # Early return
 
         # Add the callback query to the queue
-        await handle_message(chat_id, None, update, callback_data, user_data, plant_data)  # For callback queries
+        await handle_callback_query(chat_id, update, callback_data, user_data, plant_data)  # For callback queries
 
     return JSONResponse(content={"status": "ok"})
 
 if __name__ == '__main__':
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Several workers need the import string so that each process can load the app itself
+    uvicorn.run('farming:app' if WEB_WORKERS > 1 else app, host="0.0.0.0", port=8000, workers=WEB_WORKERS)
\ No newline at end of file
@@ -1,43 +1,11 @@
 import telegram
-from database import create_connection
-from telegram_bot import bot
+from telegram_bot import send_menu
+from menu_cache import get_menu
+from repository import repository
 
-async def show_game_menu(chat_id):
-    """Display the game menu with wallet balance and options."""
-    conn = create_connection()  # Create a connection to the SQLite database
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id, manager_on_off FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id, manager_on_off = user[0], user[1] if user else (None, None)
-
-    # Fetch cashflow entries for the user
-    cursor.execute("SELECT amount FROM cashflow_ledger WHERE user_id = ?", (user_id,))
-    balance_response = cursor.fetchall()
-
-    # Calculate total balance
-    total_balance = sum(entry[0] for entry in balance_response) if balance_response else 0
-    total_balance = f"{total_balance:,}"
-
-    # Fetch all upgrade IDs for the user
-    cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-    user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-    # Determine the highest upgrade level of manager
-    current_manager_upgrade_level = 0  # Default to 0 if no upgrades
-    if user_upgrades:
-        # Extract upgrade IDs
-        upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
-
-        # Fetch levels for all upgrade IDs, filtering by category 'manager'
-        cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), (upgrade_ids + ['manager']))
-        levels = cursor.fetchall()
-
-        # Find the maximum level
-        current_manager_upgrade_level = max(level[0] for level in levels) if levels else 0
-
-    if current_manager_upgrade_level == 0:
+def build_game_menu_keyboard(has_manager, manager_on_off):
+    """Build the game menu keyboard for a user's manager state."""
+    if not has_manager:
         # Create inline keyboard for the game menu
         keyboard = [
             [telegram.InlineKeyboardButton("🌾 Plant Status", callback_data='plant_status')],
@@ -67,8 +35,23 @@ async def show_game_menu(chat_id):
             [telegram.InlineKeyboardButton("🚧 Upgrades", callback_data='upgrades')]
         ]
 
-    reply_markup = telegram.InlineKeyboardMarkup(keyboard)
+    return telegram.InlineKeyboardMarkup(keyboard)
+
+async def show_game_menu(chat_id):
+    """Display the game menu with wallet balance and options."""
+    # Fetch user ID, manager state and upgrade IDs based on chat_id
+    user, upgrade_ids = await repository.get_entitlements(chat_id)
+    manager_on_off = user['manager_on_off'] if user else None
+
+    # Calculate total balance
+    total_balance = await repository.get_balance(user) if user else 0
+    total_balance = f"{total_balance:,}"
+
+    # Determine the highest upgrade level of manager
+    current_manager_upgrade_level = repository.get_upgrade_level(upgrade_ids, 'manager')
 
-    await bot.send_message(chat_id=chat_id, text=f'Welcome to FFarm 🌾\n💰: ${total_balance}\nChoose an option:', reply_markup=reply_markup)
+    # The keyboard only depends on whether the user has a manager and whether it is on
+    has_manager = current_manager_upgrade_level > 0
+    _, reply_markup = get_menu('game_menu', None, (has_manager, manager_on_off), lambda: (None, build_game_menu_keyboard(has_manager, manager_on_off)))
 
-    conn.close()  # Close the database connection
\ No newline at end of file
+    await send_menu(chat_id=chat_id, text=f'Welcome to FFarm 🌾\n💰: ${total_balance}\nChoose an option:', reply_markup=reply_markup)
\ No newline at end of file
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from database import shard_connections
+from crops import harvest_crop_rows, CROP_READY
+from earnings import record_ledger_entries
+from harvest_rules import HARVEST_EVENTS, simulate_harvest_partition
+
+logger = logging.getLogger(__name__)
+
+# Manager harvest configuration
+MANAGER_HARVEST_MODE = os.getenv('MANAGER_HARVEST_MODE', 'per_user')  # per_user, inline, thread or process
+MANAGER_HARVEST_PARTITIONS = int(os.getenv('MANAGER_HARVEST_PARTITIONS', os.cpu_count() or 1))  # Number of partitions per cycle
+
+# Worker pools, created on first use
+executors = {}
+
+def get_executor(mode):
+    """Return the thread or process pool used for the given mode."""
+    if mode not in executors:
+        if mode == 'process':
+            # Spawn avoids forking a process that is running an event loop and open connections
+            executors[mode] = ProcessPoolExecutor(max_workers=MANAGER_HARVEST_PARTITIONS, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            executors[mode] = ThreadPoolExecutor(max_workers=MANAGER_HARVEST_PARTITIONS)
+    return executors[mode]
+
+def shutdown_harvest_executors():
+    """Shut down any worker pools started by the manager harvest."""
+    for executor in executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    executors.clear()
+
+def partition_due_crops(due_crops, balances, partition_count):
+    """Split due crops into partitions of compact arrays, keeping each user's crops in one partition."""
+    partitions = [
+        (random.getrandbits(63), array('q'), array('q'), array('d'), array('d'), array('q'), array('q'))
+        for _ in range(partition_count)
+    ]
+
+    for crop_id, user_id, planted_quantity, min_ratio, max_ratio, selling_price in due_crops:
+        _, crop_ids, planted_quantities, min_ratios, max_ratios, selling_prices, crop_balances = partitions[user_id % partition_count]
+        crop_ids.append(crop_id)
+        planted_quantities.append(planted_quantity)
+        min_ratios.append(min_ratio)
+        max_ratios.append(max_ratio)
+        selling_prices.append(selling_price)
+        crop_balances.append(balances.get(user_id, 0))
+
+    return [partition for partition in partitions if partition[1]]
+
+async def simulate_partitions(partitions, mode):
+    """Run simulate_harvest_partition over every partition in the event loop, a thread pool or a process pool."""
+    if mode == 'inline':
+        return [simulate_harvest_partition(partition) for partition in partitions]
+
+    loop = asyncio.get_running_loop()
+    executor = get_executor(mode)
+    return await asyncio.gather(*(loop.run_in_executor(executor, simulate_harvest_partition, partition) for partition in partitions))
+
+async def run_manager_harvest_batch(mode=MANAGER_HARVEST_MODE, user_ids=None):
+    """Harvest the ready crops of manager users in one batch and write the results in one transaction per shard.
+
+    Harvests every manager user, or only those with the given user ids.
+    """
+    from notifications import HarvestNotifier
+
+    notifier = HarvestNotifier()
+
+    # Only the crops and balances of the given users are read
+    user_ids = sorted(set(user_ids)) if user_ids is not None else None
+    user_filter = f"AND users.id IN ({','.join('?' * len(user_ids))})" if user_ids is not None else ""
+    user_params = user_ids or []
+
+    # Each shard holds the crops and ledger of its users, so every shard is harvested on its own
+    for conn in shard_connections():
+        cursor = conn.cursor()
+
+        # Fetch the ready crops of reachable users with the manager turned on, aggregated per user and plant,
+        # with the plant details needed to roll them
+        cursor.execute(f"""
+            SELECT GROUP_CONCAT(user_crops.id), user_crops.user_id, SUM(user_crops.planted_quantity), plants_listing.min_harvesting_ratio,
+                   plants_listing.max_harvesting_ratio, plants_listing.selling_price, plants_listing.name, users.chat_id
+            FROM user_crops
+            JOIN users ON users.id = user_crops.user_id
+            JOIN plants_listing ON plants_listing.id = user_crops.item_id
+            WHERE users.manager_on_off = 1 AND users.reachability = 'reachable' AND user_crops.status = {CROP_READY} {user_filter}
+            GROUP BY user_crops.user_id, user_crops.item_id
+        """, user_params)
+        due_crops = cursor.fetchall()
+
+        if not due_crops:
+            conn.close()
+            continue
+
+        # Fetch the balances of manager users (disasters depend on the balance before the harvest)
+        cursor.execute(f"""
+            SELECT cashflow_ledger.user_id, SUM(cashflow_ledger.amount)
+            FROM cashflow_ledger JOIN users ON users.id = cashflow_ledger.user_id
+            WHERE users.manager_on_off = 1 {user_filter}
+            GROUP BY cashflow_ledger.user_id
+        """, user_params)
+        balances = dict(cursor.fetchall())
+
+        # Roll the outcomes away from the event loop
+        started = time.perf_counter()
+        # Partitions refer to each aggregate by its index in due_crops
+        partitions = partition_due_crops([(index,) + crop[1:6] for index, crop in enumerate(due_crops)], balances, MANAGER_HARVEST_PARTITIONS)
+        results = await simulate_partitions(partitions, mode)
+        logger.info(f"Simulated {len(due_crops):,} aggregated manager harvests in {len(partitions)} partitions ({mode}) in {time.perf_counter() - started:.3f}s.")
+
+        # Write all outcomes of the shard in a single transaction
+        local_time = int(time.time())  # Transaction date in seconds since the epoch
+
+        for aggregate_indexes, event_codes, harvested_quantities, cashflow_amounts, manager_payrolls in results:
+            for i, aggregate_index in enumerate(aggregate_indexes):
+                crop_ids, user_id, _, _, _, _, plant_name, chat_id = due_crops[aggregate_index]
+
+                # Skip crops that were harvested by hand since they were fetched
+                if harvest_crop_rows(cursor, [int(crop_id) for crop_id in crop_ids.split(',')]) == 0:
+                    continue
+
+                if harvested_quantities[i] > 0:
+                    harvested_quantity_formatted = f"{harvested_quantities[i]:,}"  # Format for display
+                    record_ledger_entries(cursor, [
+                        (user_id, cashflow_amounts[i], f'Harvested {harvested_quantity_formatted} {plant_name}(s).', local_time),
+                        (user_id, -manager_payrolls[i], f'Manager payroll for harvesting {harvested_quantity_formatted} {plant_name}(s).', local_time),
+                    ])
+
+                notifier.add(chat_id, HARVEST_EVENTS[event_codes[i]], plant_name, harvested_quantities[i], cashflow_amounts[i], manager_payrolls[i])
+
+        conn.commit()
+        conn.close()
+
+    # Notify users once the results are durable, one report per user
+    await notifier.flush(manager=True)
+
+async def benchmark_mode(partitions, mode):
+    """Time one execution mode and measure the worst event loop stall while it runs."""
+    max_lag = 0.0
+    running = True
+
+    async def measure_lag():
+        nonlocal max_lag
+        while running:
+            expected = time.perf_counter() + 0.005
+            await asyncio.sleep(0.005)
+            max_lag = max(max_lag, time.perf_counter() - expected)
+
+    lag_task = asyncio.create_task(measure_lag())
+    await asyncio.sleep(0.01)  # Let the lag probe start
+
+    started = time.perf_counter()
+    await simulate_partitions(partitions, mode)
+    elapsed = time.perf_counter() - started
+
+    running = False
+    await lag_task
+    return elapsed, max_lag
+
+async def run_benchmark(sizes, users):
+    """Compare in-loop, thread and process execution of the manager harvest simulation."""
+    print(f"{'due crops':>10} {'mode':>8} {'total (s)':>10} {'max loop stall (ms)':>20}")
+    for size in sizes:
+        due_crops = [
+            (crop_id, random.randrange(users), random.randint(1, 10000), 1.0, 3.0, random.randint(1, 500))
+            for crop_id in range(size)
+        ]
+        balances = {user_id: random.randint(0, 2000000000) for user_id in range(users)}
+        partitions = partition_due_crops(due_crops, balances, MANAGER_HARVEST_PARTITIONS)
+
+        # Warm the pools up so process start-up is not counted
+        for mode in ('thread', 'process'):
+            await simulate_partitions(partitions[:1], mode)
+
+        for mode in ('inline', 'thread', 'process'):
+            elapsed, max_lag = await benchmark_mode(partitions, mode)
+            print(f"{size:>10,} {mode:>8} {elapsed:>10.3f} {max_lag * 1000:>20.1f}")
+
+    shutdown_harvest_executors()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the manager harvest simulation.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])  # Due crops per cycle
+    parser.add_argument('--users', type=int, default=2000)  # Manager users owning the crops
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.sizes, args.users))
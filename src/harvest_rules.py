@@ -0,0 +1,76 @@
+import random
+from array import array
+
+# Harvest factor events and their relative weights
+HARVEST_EVENTS = ['extreme_disaster', 'mild_disaster', 'minimum_harvest', 'normal_season', 'good_season']
+HARVEST_EVENT_WEIGHTS = [1, 4, 15, 60, 20]
+
+# Disasters only strike users whose balance is at least this high; others get a minimum harvest instead
+DISASTER_BALANCE_THRESHOLD = 1000000000
+
+# Share of the harvest income paid to the farm manager
+MANAGER_PAYROLL_RATE = 0.08
+
+# Photo and caption sent for each harvest event
+HARVEST_EVENT_MESSAGES = {
+    'extreme_disaster': ('../images/extreme_disaster.jpeg', '🌪️ Extreme disaster! All your crops have been destroyed!'),
+    'mild_disaster': ('../images/mild_disaster.jpeg', '🌪️ Mild disaster! Half of your crops have been destroyed!'),
+    'minimum_harvest': ('../images/minimum_harvest.jpeg', '🌾 Low season! Your crops have been grown at a minimum rate.'),
+    'normal_season': ('../images/normal_season.jpeg', '🌾 Normal season! Your crops have been grown at a normal rate.'),
+    'good_season': ('../images/good_season.jpeg', '🌾 Good season! Your crops have been grown at a good rate.'),
+}
+
+def roll_harvest(planted_quantity, min_ratio, max_ratio, total_balance, rng=random):
+    """Roll the harvest event for a crop and return (event, harvested quantity rounded up)."""
+    # Get a random factor for harvest event
+    harvest_event = rng.choices(HARVEST_EVENTS, weights=HARVEST_EVENT_WEIGHTS, k=1)[0]
+
+    # Disasters fall back to a minimum harvest for users below the threshold
+    if harvest_event in ('extreme_disaster', 'mild_disaster') and total_balance < DISASTER_BALANCE_THRESHOLD:
+        harvest_event = 'minimum_harvest'
+
+    # Determine the harvest quantity based on the event
+    if harvest_event == 'extreme_disaster':
+        harvested_quantity = 0  # All crops destroyed
+    elif harvest_event == 'mild_disaster':
+        harvested_quantity = int(planted_quantity * min_ratio * 0.5)  # Half of the crops destroyed
+    elif harvest_event == 'minimum_harvest':
+        harvested_quantity = planted_quantity * min_ratio  # Minimum harvest rate
+    elif harvest_event == 'normal_season':
+        harvested_quantity = planted_quantity * ((min_ratio + max_ratio) / 2)  # Average harvest rate
+    else:
+        harvested_quantity = planted_quantity * max_ratio  # Maximum harvest rate
+
+    harvested_quantity_rounded = int(harvested_quantity) + (1 if harvested_quantity % 1 > 0 else 0)  # Round up to the nearest whole number
+    return harvest_event, harvested_quantity_rounded
+
+def calculate_manager_payroll(cashflow_amount):
+    """Return the manager payroll owed for a harvest worth cashflow_amount."""
+    return int(cashflow_amount * MANAGER_PAYROLL_RATE)
+
+def simulate_harvest_partition(partition):
+    """Roll the harvest of a partition of due crops.
+
+    The partition is (seed, ids, planted_quantities, min_ratios, max_ratios, selling_prices, balances)
+    with one array entry per crop, where ids identify the crops to the caller. Returns compact arrays
+    (ids, event_codes, harvested_quantities, cashflow_amounts, manager_payrolls), where event_codes index
+    HARVEST_EVENTS. This function is pure so it can run in a worker thread or process.
+    """
+    seed, ids, planted_quantities, min_ratios, max_ratios, selling_prices, balances = partition
+    rng = random.Random(seed)
+
+    event_codes = array('b')
+    harvested_quantities = array('q')
+    cashflow_amounts = array('q')
+    manager_payrolls = array('q')
+
+    for i in range(len(ids)):
+        harvest_event, harvested_quantity = roll_harvest(planted_quantities[i], min_ratios[i], max_ratios[i], balances[i], rng)
+        cashflow_amount = harvested_quantity * selling_prices[i]
+
+        event_codes.append(HARVEST_EVENTS.index(harvest_event))
+        harvested_quantities.append(harvested_quantity)
+        cashflow_amounts.append(cashflow_amount)
+        manager_payrolls.append(calculate_manager_payroll(cashflow_amount))
+
+    return ids, event_codes, harvested_quantities, cashflow_amounts, manager_payrolls
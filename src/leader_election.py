@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from database import create_connection
+
+logger = logging.getLogger(__name__)
+
+# Leader election configuration
+LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', 30))  # Seconds a lease stays valid without a heartbeat
+HEARTBEAT_INTERVAL = float(os.getenv('LEADER_HEARTBEAT_INTERVAL', 10))  # Seconds between heartbeats
+
+# Unique identity of this worker process
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def try_acquire_lease(name, owner=WORKER_ID, ttl=LEASE_TTL):
+    """Acquire or renew the named lease. Return True if this owner holds it afterwards."""
+    now = time.time()
+    conn = create_connection()
+    cursor = conn.cursor()
+
+    # Take the lease if it is free, expired or already ours (renewal doubles as the heartbeat)
+    cursor.execute("""
+        INSERT INTO worker_leases (name, owner, expires_at, heartbeat_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at, heartbeat_at = excluded.heartbeat_at
+        WHERE worker_leases.owner = excluded.owner OR worker_leases.expires_at < ?
+    """, (name, owner, now + ttl, now, now))
+    acquired = cursor.rowcount == 1
+
+    conn.commit()
+    conn.close()
+    return acquired
+
+def release_lease(name, owner=WORKER_ID):
+    """Release the named lease if this owner holds it."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM worker_leases WHERE name = ? AND owner = ?", (name, owner))
+    conn.commit()
+    conn.close()
+
+def get_lease_holder(name):
+    """Return the current (unexpired) owner of the named lease, or None."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT owner FROM worker_leases WHERE name = ? AND expires_at >= ?", (name, time.time()))
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] if result else None
+
+async def run_as_leader(name, job_factories):
+    """Keep competing for the named lease and run the given jobs only while holding it."""
+    tasks = []
+
+    try:
+        while True:
+            try:
+                is_leader = try_acquire_lease(name)
+            except Exception as e:
+                # A failed heartbeat means we can no longer prove we are the leader
+                logger.error(f"Lease heartbeat for {name} failed: {e}")
+                is_leader = False
+
+            if is_leader and not tasks:
+                logger.info(f"Worker {WORKER_ID} became leader for {name}. Starting background jobs.")
+                tasks = [asyncio.create_task(job_factory()) for job_factory in job_factories]
+            elif not is_leader and tasks:
+                logger.warning(f"Worker {WORKER_ID} lost the {name} lease. Stopping background jobs.")
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                tasks = []
+
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+    finally:
+        # Stop the jobs and hand the lease over straight away on shutdown
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if tasks:
+            release_lease(name)
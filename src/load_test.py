@@ -0,0 +1,117 @@
+"""Webhook throughput test.
+
+Runs a stub Telegram Bot API so outbound calls stay local, and fires synthetic
+updates at the /webhook endpoint to measure how many updates per second the
+app handles. See the "Scaling" section of the README for the full procedure.
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from urllib.parse import parse_qsl
+import httpx
+from fastapi import FastAPI, Request
+
+# Stub Bot API that accepts every method
+stub_app = FastAPI()
+message_ids = itertools.count(1)
+
+@stub_app.post("/bot{token}/{method}")
+async def stub_method(token: str, method: str, request: Request):
+    """Answer any Bot API call with a minimal successful result."""
+    body = (await request.body()).decode('utf-8', 'replace')
+    form = dict(parse_qsl(body)) if 'urlencoded' in request.headers.get('content-type', '') else {}
+    chat_id = int(form.get('chat_id', 0) or 0)
+    result = {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'text': form.get('text', ''),
+    }
+    return {'ok': True, 'result': result if method.startswith(('send', 'edit')) else True}
+
+def build_message_update(update_id, chat_id, text):
+    """Build a Telegram message update."""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load_{chat_id}'},
+            'text': text,
+        },
+    }
+
+def build_callback_update(update_id, chat_id, data):
+    """Build a Telegram callback query update."""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': 'menu',
+            },
+        },
+    }
+
+async def run_load(url, updates, concurrency, chats):
+    """Register the synthetic chats, then send a mix of menu updates and report the throughput."""
+    update_ids = itertools.count(int(time.time()) * 1000)
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(update):
+            nonlocal failures
+            async with semaphore:
+                response = await client.post(url, json=update)
+                if response.status_code != 200:
+                    failures += 1
+
+        # Register every synthetic chat so the menus find a user
+        chat_ids = [900000000 + i for i in range(chats)]
+        await asyncio.gather(*(post(build_message_update(next(update_ids), chat_id, '/home')) for chat_id in chat_ids))
+
+        # Mix of the most common interactions: opening the game, planting and upgrades menus
+        workload = []
+        for i in range(updates):
+            chat_id = chat_ids[i % chats]
+            if i % 3 == 0:
+                workload.append(build_callback_update(next(update_ids), chat_id, 'show_game_menu'))
+            elif i % 3 == 1:
+                workload.append(build_callback_update(next(update_ids), chat_id, 'planting'))
+            else:
+                workload.append(build_message_update(next(update_ids), chat_id, '/upgrades'))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in workload))
+        elapsed = time.perf_counter() - start
+
+    print(f"{updates} updates in {elapsed:.2f}s - {updates / elapsed:,.0f} updates/s ({failures} failed)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stub_parser = subparsers.add_parser('stub', help='Run the stub Telegram Bot API')
+    stub_parser.add_argument('--port', type=int, default=8081)
+
+    run_parser = subparsers.add_parser('run', help='Send synthetic updates to the webhook')
+    run_parser.add_argument('--url', default='http://127.0.0.1:8000/webhook')
+    run_parser.add_argument('--updates', type=int, default=3000)
+    run_parser.add_argument('--concurrency', type=int, default=64)
+    run_parser.add_argument('--chats', type=int, default=1000)  # Enough chats to stay under the per-chat rate limit
+
+    args = parser.parse_args()
+    if args.command == 'stub':
+        import uvicorn
+        uvicorn.run(stub_app, host='127.0.0.1', port=args.port, log_level='warning')
+    else:
+        asyncio.run(run_load(args.url, args.updates, args.concurrency, args.chats))
@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import os
+import time
+import logging
+from collections import defaultdict
+from database import create_connection
+from farm_manager import harvest_manager_users, handle_manager_auto_planting
+from reachability import is_reachable
+from repository import repository, STORAGE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+# Manager pipeline configuration
+MANAGER_PIPELINE = os.getenv('MANAGER_PIPELINE', '1') == '1'  # Set to 0 to harvest and replant for managers only in the periodic rescan
+MANAGER_PIPELINE_SCAN_INTERVAL = float(os.getenv('MANAGER_PIPELINE_SCAN_INTERVAL', 5))  # Seconds between reads of the new plantings
+MANAGER_PIPELINE_QUEUE_SIZE = int(os.getenv('MANAGER_PIPELINE_QUEUE_SIZE', 1000))  # Users waiting for a stage before the previous stage waits
+MANAGER_PIPELINE_BATCH_SIZE = int(os.getenv('MANAGER_PIPELINE_BATCH_SIZE', 100))  # Users a stage handles at once
+MANAGER_PIPELINE_BATCH_WAIT = float(os.getenv('MANAGER_PIPELINE_BATCH_WAIT', 0.5))  # Seconds a stage waits for a batch to fill up
+MANAGER_PIPELINE_SWEEP_INTERVAL = int(os.getenv('MANAGER_PIPELINE_SWEEP_INTERVAL', 600))  # Seconds between the pipeline's rescans of every manager user
+
+# Progress of the pipeline on the leader worker, reported in GET /metrics
+pipeline_stats = {
+    'running': False,
+    'scheduled': 0,  # Growing crops of manager users waiting to mature
+    'checkpoints': {},  # Highest crop id read per shard
+    'saved_checkpoints': {},  # Crop id per shard a new leader resumes reading after, below every crop still in the pipeline
+    'matured': 0,
+    'harvested_users': 0,
+    'replanted_users': 0,
+    'swept_users': 0,
+    'harvest_queue': 0,
+    'replant_queue': 0,
+    'last_lag': None,  # Seconds from maturity to the end of the harvest, for the last batch
+    'max_lag': None,
+}
+
+scan_requested = asyncio.Event()  # Set by the replant stage so new plantings are scheduled straight away
+
+def get_pipeline_stats():
+    """Return the progress of the manager pipeline."""
+    return {name: dict(value) if isinstance(value, dict) else value for name, value in pipeline_stats.items()}
+
+def load_checkpoints():
+    """Return the checkpoints saved by the manager pipeline for this storage backend, per shard."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT shard, checkpoint FROM manager_pipeline_checkpoints WHERE storage = ?", (STORAGE_BACKEND,))
+    rows = cursor.fetchall()
+    conn.close()
+    return {None if shard == -1 else shard: checkpoint for shard, checkpoint in rows}  # -1 stands for the main database
+
+def save_checkpoints(checkpoints):
+    """Save the checkpoints a new leader's manager pipeline resumes reading after, per shard."""
+    now = int(time.time())
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT INTO manager_pipeline_checkpoints (storage, shard, checkpoint, saved_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(storage, shard) DO UPDATE SET checkpoint = excluded.checkpoint, saved_at = excluded.saved_at
+    """, [(STORAGE_BACKEND, -1 if shard is None else shard, checkpoint, now) for shard, checkpoint in checkpoints.items()])
+    conn.commit()
+    conn.close()
+
+def get_resume_checkpoints(checkpoints, pending):
+    """Return per shard the read checkpoint, lowered below every crop still waiting in the pipeline."""
+    resume = dict(checkpoints)
+    for shard, crop_id in pending:
+        resume[shard] = min(resume.get(shard, crop_id), crop_id - 1)
+    return resume
+
+async def get_batch(queue):
+    """Wait for an item, then take up to MANAGER_PIPELINE_BATCH_SIZE items arriving within MANAGER_PIPELINE_BATCH_WAIT seconds."""
+    items = [await queue.get()]
+    deadline = time.monotonic() + MANAGER_PIPELINE_BATCH_WAIT
+    while len(items) < MANAGER_PIPELINE_BATCH_SIZE:
+        if not queue.empty():
+            items.append(queue.get_nowait())
+            continue
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return items
+
+async def schedule_new_plantings(schedule, pending, checkpoints):
+    """Add the crops of manager users planted since the checkpoints to the schedule, ordered by maturity."""
+    crops, checkpoints = await repository.get_planted_crops_since(checkpoints)
+    if crops:
+        users = await repository.get_users({user_id for _, user_id, _, _ in crops})
+        for crop_id, user_id, ready_at, shard in crops:
+            user = users.get(user_id)
+            if user and user['manager_on_off'] == 1:
+                heapq.heappush(schedule, (ready_at, user_id, crop_id, shard))
+                pending.add((shard, crop_id))
+    pipeline_stats.update(scheduled=len(schedule), checkpoints=checkpoints)
+    return checkpoints
+
+async def run_maturity_stage(schedule, pending, checkpoints, harvest_queue):
+    """Read the new plantings and send each user's crops to the harvest stage as soon as they mature.
+
+    Plantings are read in id order past a checkpoint per shard, so each read only sees the crops planted since the
+    last one. A full harvest queue holds matured crops back until the harvest stage catches up. Every
+    MANAGER_PIPELINE_SCAN_INTERVAL seconds the checkpoints are saved below the crops still in the pipeline, so a
+    new leader resumes reading from the oldest crop not yet handled.
+    """
+    saved_checkpoints = dict(checkpoints)
+    next_save = 0
+
+    while True:
+        try:
+            checkpoints = await schedule_new_plantings(schedule, pending, checkpoints)
+        except Exception as e:
+            logger.error(f"Error reading the new plantings for the manager pipeline: {e}")
+
+        # Group the matured crops by user; a user's crops are all in one shard
+        now = time.time()
+        matured = defaultdict(list)
+        ready_at = {}
+        shards = {}
+        while schedule and schedule[0][0] <= now:
+            crop_ready_at, user_id, crop_id, shard = heapq.heappop(schedule)
+            matured[user_id].append(crop_id)
+            ready_at.setdefault(user_id, crop_ready_at)
+            shards[user_id] = shard
+
+        for user_id, crop_ids in matured.items():
+            await harvest_queue.put((user_id, crop_ids, ready_at[user_id], shards[user_id]))
+            pipeline_stats['matured'] += len(crop_ids)
+        pipeline_stats.update(scheduled=len(schedule), harvest_queue=harvest_queue.qsize())
+
+        if time.monotonic() >= next_save:
+            next_save = time.monotonic() + MANAGER_PIPELINE_SCAN_INTERVAL
+            resume_checkpoints = get_resume_checkpoints(checkpoints, pending)
+            if resume_checkpoints != saved_checkpoints:
+                try:
+                    save_checkpoints(resume_checkpoints)
+                    saved_checkpoints = resume_checkpoints
+                    pipeline_stats['saved_checkpoints'] = saved_checkpoints
+                except Exception as e:
+                    logger.error(f"Error saving the manager pipeline checkpoints: {e}")
+
+        # Sleep until the next crop matures, the next read, or a replant
+        timeout = MANAGER_PIPELINE_SCAN_INTERVAL
+        if schedule:
+            timeout = min(max(schedule[0][0] - time.time(), 0), timeout)
+        try:
+            await asyncio.wait_for(scan_requested.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        scan_requested.clear()
+
+async def run_sweep_stage(harvest_queue):
+    """Send every manager user to the harvest stage at start and every MANAGER_PIPELINE_SWEEP_INTERVAL seconds.
+
+    The rescan catches what the schedule missed, such as managers turned on while their crops were growing. It goes
+    through the harvest stage, so it never harvests or replants a user at the same time as the pipeline.
+    """
+    while True:
+        try:
+            users = await repository.get_manager_users()
+            for user in users:
+                await harvest_queue.put((user['id'], [], None, None))
+            pipeline_stats['swept_users'] += len(users)
+        except Exception as e:
+            logger.error(f"Error rescanning the manager users for the manager pipeline: {e}")
+        await asyncio.sleep(MANAGER_PIPELINE_SWEEP_INTERVAL)
+
+async def run_harvest_stage(schedule, pending, harvest_queue, replant_queue):
+    """Mark matured crops ready and harvest them, a batch of users at a time, then pass the users on to replant.
+
+    Crops merged with a later planting since they were scheduled are not mature yet and go back on the schedule.
+    Users from the rescan come without crops; their crops already marked ready are harvested.
+    """
+    while True:
+        batch = await get_batch(harvest_queue)
+        try:
+            crop_ids = defaultdict(list)
+            ready_at = {}
+            shards = {}
+            for user_id, user_crop_ids, user_ready_at, shard in batch:
+                crop_ids[user_id].extend(user_crop_ids)
+                pending.difference_update((shard, crop_id) for crop_id in user_crop_ids)  # Left to the rescan if this batch fails
+                if user_ready_at is not None:
+                    ready_at[user_id] = min(ready_at.get(user_id, user_ready_at), user_ready_at)
+                    shards[user_id] = shard
+
+            # Automation is paused for users who blocked the bot or turned their manager off since planting
+            users = [user for user in (await repository.get_users(crop_ids)).values() if user['manager_on_off'] == 1 and is_reachable(user['chat_id'])]
+            if not users:
+                continue
+
+            for user in users:
+                if crop_ids[user['id']]:
+                    await repository.mark_crops_ready(user, crop_ids[user['id']])
+                    for crop_id, user_id, crop_ready_at in await repository.get_planted_crops(user, crop_ids[user['id']]):
+                        heapq.heappush(schedule, (crop_ready_at, user_id, crop_id, shards[user_id]))
+                        pending.add((shards[user_id], crop_id))
+            await harvest_manager_users(users)
+
+            pipeline_stats['harvested_users'] += len(users)
+            scheduled_ready_at = [ready_at[user['id']] for user in users if user['id'] in ready_at]
+            if scheduled_ready_at:
+                lag = round(time.time() - min(scheduled_ready_at), 1)
+                pipeline_stats.update(last_lag=lag, max_lag=max(pipeline_stats['max_lag'] or 0, lag))
+
+            for user in users:
+                await replant_queue.put(user)
+        except Exception as e:
+            logger.error(f"Error harvesting for the manager pipeline: {e}")
+        finally:
+            pipeline_stats.update(harvest_queue=harvest_queue.qsize(), replant_queue=replant_queue.qsize())
+
+async def run_replant_stage(replant_queue):
+    """Replant the free plots of harvested users with their auto planting seeds, a batch of users at a time."""
+    while True:
+        batch = await get_batch(replant_queue)
+        try:
+            users = list({user['id']: user for user in batch}.values())
+            await handle_manager_auto_planting(users)
+            pipeline_stats['replanted_users'] += len(users)
+            scan_requested.set()  # Schedule the new crops without waiting for the next read
+        except Exception as e:
+            logger.error(f"Error replanting for the manager pipeline: {e}")
+        finally:
+            pipeline_stats['replant_queue'] = replant_queue.qsize()
+
+async def run_manager_pipeline():
+    """Run the maturity, harvest and replant stages, linked by bounded queues, and the rescan. Runs on the leader worker only."""
+    if not MANAGER_PIPELINE:
+        return
+
+    # Shared by the maturity and harvest stages: the growing crops as (ready_at, user_id, crop_id, shard), and the
+    # (shard, crop_id) of the crops scheduled or waiting for the harvest stage
+    schedule = []
+    pending = set()
+    checkpoints = load_checkpoints()
+    harvest_queue = asyncio.Queue(maxsize=MANAGER_PIPELINE_QUEUE_SIZE)
+    replant_queue = asyncio.Queue(maxsize=MANAGER_PIPELINE_QUEUE_SIZE)
+    pipeline_stats.update(running=True, checkpoints=checkpoints, saved_checkpoints=checkpoints)
+    try:
+        await asyncio.gather(run_maturity_stage(schedule, pending, checkpoints, harvest_queue), run_sweep_stage(harvest_queue),
+                             run_harvest_stage(schedule, pending, harvest_queue, replant_queue), run_replant_stage(replant_queue))
+    finally:
+        pipeline_stats['running'] = False
\ No newline at end of file
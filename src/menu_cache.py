@@ -0,0 +1,171 @@
+import os
+import time
+import logging
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+from database import create_connection
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of rendered menus kept in memory
+MENU_CACHE_SIZE = int(os.getenv('MENU_CACHE_SIZE', 1024))
+
+# Rendered menus: (menu, category, entitlements) -> (text, reply_markup)
+menu_cache = OrderedDict()
+
+# Seconds between checks whether another worker reloaded the catalogs
+CATALOG_CHECK_INTERVAL = float(os.getenv('CATALOG_CHECK_INTERVAL', 30))
+
+# Upgrade catalog used to resolve entitlements and serve the upgrade menus. Loaded on first use and never
+# changed in place; a reload replaces it as a whole
+UpgradeCatalog = namedtuple('UpgradeCatalog', [
+    'by_id',  # Upgrade id -> read-only upgrade (id, level, category, description, price)
+    'ladders',  # Category -> its upgrades ordered by level
+    'by_level',  # (category, level) -> upgrade
+    'category_ids',  # Category -> frozenset of its upgrade ids
+    'crops_upgrades',  # (id, description, price, plant name, plant category, emoji) of the crop upgrades and their plants
+    'crop_upgrade_ids',  # Frozenset of the crop upgrade ids
+    'unlocked_plants',  # Crop upgrade id -> frozenset of the ids of the plants it unlocks
+])
+upgrade_catalog = None
+
+# Catalog version this worker loaded, bumped in the database by a reload on any worker
+catalog_version = {'loaded': None, 'checked_at': 0.0}
+
+def get_menu(menu, category, entitlements, build):
+    """Return the cached (text, reply_markup) of a menu, rendering it with build() on a miss.
+
+    Inline keyboards are immutable, so one rendered menu can be sent to every user with the same entitlements.
+    """
+    key = (menu, category, entitlements)
+    cached = menu_cache.get(key)
+
+    if cached is None:
+        cached = build()
+        menu_cache[key] = cached
+        if len(menu_cache) > MENU_CACHE_SIZE:
+            menu_cache.popitem(last=False)  # Evict the least recently used menu
+    else:
+        menu_cache.move_to_end(key)
+
+    return cached
+
+def invalidate_menus():
+    """Forget every rendered menu and the upgrade catalog, e.g. after the plant or upgrade catalog changed."""
+    global upgrade_catalog
+    menu_cache.clear()
+    upgrade_catalog = None
+    logger.info("Menu cache invalidated.")
+
+def load_upgrade_catalog(cursor):
+    """Read upgrade_listings and the plants of the crop upgrades into an UpgradeCatalog."""
+    cursor.execute("SELECT id, level, category, description, price FROM upgrade_listings ORDER BY category, level, id")
+    upgrades = [MappingProxyType(dict(zip(('id', 'level', 'category', 'description', 'price'), row))) for row in cursor.fetchall()]
+
+    ladders, by_level = {}, {}
+    for upgrade in upgrades:
+        ladders.setdefault(upgrade['category'], []).append(upgrade)
+        by_level.setdefault((upgrade['category'], upgrade['level']), upgrade)  # The lowest id wins, like the old first row
+
+    # Fetch upgrades that is in the crops category and merge with the plants_listing table
+    cursor.execute("SELECT upgrade_listings.id, upgrade_listings.description, upgrade_listings.price, plants_listing.name, plants_listing.category, plants_listing.emoji FROM upgrade_listings LEFT JOIN plants_listing ON upgrade_listings.id = plants_listing.upgrade_id WHERE upgrade_listings.category = 'crops'")
+    crops_upgrades = tuple(tuple(row) for row in cursor.fetchall())
+
+    cursor.execute("SELECT upgrade_id, id FROM plants_listing WHERE upgrade_id IS NOT NULL")
+    unlocked_plants = {}
+    for upgrade_id, plant_id in cursor.fetchall():
+        unlocked_plants.setdefault(upgrade_id, set()).add(plant_id)
+
+    return UpgradeCatalog(
+        by_id=MappingProxyType({upgrade['id']: upgrade for upgrade in upgrades}),
+        ladders=MappingProxyType({category: tuple(ladder) for category, ladder in ladders.items()}),
+        by_level=MappingProxyType(by_level),
+        category_ids=MappingProxyType({category: frozenset(upgrade['id'] for upgrade in ladder) for category, ladder in ladders.items()}),
+        crops_upgrades=crops_upgrades,
+        crop_upgrade_ids=frozenset(upgrade['id'] for upgrade in ladders.get('crops', ())),
+        unlocked_plants=MappingProxyType({upgrade_id: frozenset(plant_ids) for upgrade_id, plant_ids in unlocked_plants.items()}),
+    )
+
+def get_upgrade_catalog(cursor):
+    """Return the upgrade catalog, loading it on first use."""
+    global upgrade_catalog
+
+    if upgrade_catalog is None:
+        upgrade_catalog = load_upgrade_catalog(cursor)
+
+    return upgrade_catalog
+
+def get_upgrade(cursor, upgrade_id):
+    """Return an upgrade of the catalog, or None."""
+    return get_upgrade_catalog(cursor).by_id.get(upgrade_id)
+
+def get_next_upgrade(cursor, category, level):
+    """Return the upgrade of a category at a level, or None if there is none."""
+    return get_upgrade_catalog(cursor).by_level.get((category, level))
+
+def get_upgrade_level(cursor, upgrade_ids, category):
+    """Return the highest level the user owns in an upgrade category (0 if none)."""
+    catalog = get_upgrade_catalog(cursor)
+    owned = catalog.category_ids.get(category, frozenset()) & upgrade_ids
+    return max((catalog.by_id[upgrade_id]['level'] for upgrade_id in owned), default=0)
+
+def get_crop_unlocks(cursor, upgrade_ids):
+    """Return the crop upgrades among the user's upgrades, the part of their entitlements that changes plant menus."""
+    return get_upgrade_catalog(cursor).crop_upgrade_ids & upgrade_ids
+
+def get_catalog_version(cursor):
+    """Return the catalog version in the database, 0 before the first reload."""
+    cursor.execute("SELECT version FROM catalog_version WHERE id = 1")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def bump_catalog_version(cursor):
+    """Tell every worker that the catalogs changed."""
+    cursor.execute("INSERT INTO catalog_version (id, version, reloaded_at) VALUES (1, 1, ?) ON CONFLICT(id) DO UPDATE SET version = version + 1, reloaded_at = excluded.reloaded_at", (int(time.time()),))
+
+def load_plant_data(plant_data):
+    """Load plants_listing into plant_data by category and the upgrade catalog, replacing the previous catalogs."""
+    global upgrade_catalog
+    conn = create_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT * FROM plants_listing")
+    plants = cursor.fetchall()
+
+    plant_data.clear()  # Reloading replaces the previous catalog
+
+    for plant in plants:
+        category = plant[2]  # Assuming category is the third column
+        if category not in plant_data:
+            plant_data[category] = []
+        plant_info = {
+            'id': plant[0],  # ID
+            'name': plant[1],  # Name
+            'emoji': plant[3],  # Emoji
+            'seed_purchase_price': plant[6],  # Seed purchase price
+            'min_harvesting_ratio': plant[4],  # Min harvesting ratio
+            'max_harvesting_ratio': plant[5],  # Max harvesting ratio
+            'harvest_time': plant[7],  # Harvest time
+            'selling_price': plant[8],  # Selling price
+            'upgrade_id': plant[9]  # Upgrade ID
+        }
+        plant_data[category].append(plant_info)
+
+    # Menus rendered from the previous catalog are stale
+    invalidate_menus()
+    upgrade_catalog = load_upgrade_catalog(cursor)
+    catalog_version.update(loaded=get_catalog_version(cursor), checked_at=time.monotonic())
+
+    conn.close()
+    return upgrade_catalog
+
+def catalog_reloaded_elsewhere():
+    """Return True if another worker reloaded the catalogs since this one loaded them, checking every CATALOG_CHECK_INTERVAL seconds."""
+    if time.monotonic() - catalog_version['checked_at'] < CATALOG_CHECK_INTERVAL:
+        return False
+
+    conn = create_connection()
+    version = get_catalog_version(conn.cursor())
+    conn.close()
+    catalog_version['checked_at'] = time.monotonic()
+    return version != catalog_version['loaded']
\ No newline at end of file
@@ -1,21 +1,52 @@
-from admin import show_admin_menu, select_admin_announcement_type, admin_announcement_text, admin_announcement_photo, send_admin_announcement_text, send_admin_announcement_photo
-from database import create_connection
-from datetime import datetime
+from admin import show_admin_menu, select_admin_announcement_type, admin_announcement_text, admin_announcement_photo, send_admin_announcement_text, send_admin_announcement_photo, reload_catalog
 from game_menu import show_game_menu
-from telegram_bot import bot
-from user_mgnt import register_user
+from telegram_bot import bot, current_edit_target
+from user_mgnt import register_user, get_known_entitlements
 from planting import show_planting_menu, show_plants, handle_plant_selection, check_planting_status
 from harvest_crops import harvest_crops
 from upgrades import show_upgrades_menu, handle_plot_upgrade, handle_crops_upgrade, handle_manager_upgrade, handle_upgrade_confirmation
 from farm_manager import show_manager_menu, handle_manager_on_off, handle_manager_on, handle_manager_off, handle_auto_planting, handle_change_auto_planting_category, show_auto_planting_plants, handle_auto_planting_plant_selection
 from rankings import show_rankings
+from notifications import show_notification_preferences, handle_notification_preference
+from broadcast import show_broadcast_jobs, handle_broadcast_control
+from analytics import show_economy_report
 from rate_limiter import rate_limiter
 from plots import get_available_plots_slots
+from repository import repository
+from crops import REFUSED_BALANCE, REFUSED_PLOTS
+from overload import send_picture
 from fastapi.responses import JSONResponse
+import asyncio
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Callback acknowledgements in flight, kept so they are not garbage collected
+pending_acknowledgements = set()
+
+async def acknowledge_callback(callback_query_id):
+    """Answer a callback query so the user's client stops its loading spinner."""
+    try:
+        await bot.answer_callback_query(callback_query_id=callback_query_id)
+    except Exception as e:
+        logger.warning(f"Failed to answer callback query {callback_query_id}: {e}")
+
+async def handle_callback_query(chat_id, update, callback_data, user_data, plant_data):
+    """Acknowledge a callback query at once, then handle it with menus replacing the pressed menu message."""
+    callback_query = update['callback_query']
+
+    # Answer without waiting, so a slow handler does not make the user tap again
+    task = asyncio.create_task(acknowledge_callback(callback_query['id']))
+    pending_acknowledgements.add(task)
+    task.add_done_callback(pending_acknowledgements.discard)
+
+    token = current_edit_target.set((chat_id, callback_query['message']['message_id']))
+    try:
+        await handle_message(chat_id, None, update, callback_data, user_data, plant_data)
+    finally:
+        current_edit_target.reset(token)
+
 async def handle_message(chat_id, text, update, callback_data, user_data, plant_data):
     # Your existing message handling logic goes here
     # For example, checking commands, processing user input, etc.
@@ -54,7 +85,7 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
             await check_planting_status(chat_id)  # Check planting status
 
         elif text == '/harvest':
-            await harvest_crops(chat_id)  # Call the harvest function
+            await harvest_crops(chat_id, interactive=True)  # Call the harvest function
 
         elif text == '/upgrades':
             await show_upgrades_menu(chat_id)  # Show upgrades menu
@@ -86,42 +117,24 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                 
                 total_cost = quantity * selected_plant['price']
 
-                conn = create_connection()  # Create a connection to the SQLite database
-                cursor = conn.cursor()
-
                 # Verify wallet balance
-                cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-                user = cursor.fetchone()
-                user_id = user[0] if user else None
-
-                # Fetch cashflow entries for the user
-                cursor.execute("SELECT amount FROM cashflow_ledger WHERE user_id = ?", (user_id,))
-                balance_response = cursor.fetchall()
-                total_balance = sum(entry[0] for entry in balance_response) if balance_response else 0
+                user, upgrade_ids = await get_known_entitlements(chat_id)
 
-                # Fetch the user's current upgrade level
-                cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-                user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-                # Determine the highest upgrade level   
-                current_upgrade_level = 0  # Default to 0 if no upgrades
-                if user_upgrades:
-                    # Extract upgrade IDs
-                    upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
+                if user is None:
+                    await bot.send_message(chat_id=chat_id, text='User not found.')
+                    return
 
-                    # Fetch levels for all upgrade IDs, filtering by category 'plot'
-                    cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), upgrade_ids + ['plot'])
-                    levels = cursor.fetchall()
+                user_id = user['id']
+                total_balance = await repository.get_balance(user)
 
-                    # Find the maximum level
-                    current_upgrade_level = max(level[0] for level in levels) if levels else 0
+                # Determine the highest upgrade level, 0 if no upgrades
+                current_upgrade_level = repository.get_upgrade_level(upgrade_ids, 'plot')
 
                 # Get available slots based on the current upgrade level
                 available_slots = get_available_plots_slots(current_upgrade_level)
 
-                # Fetch crops for the user from the user_crops table
-                cursor.execute("SELECT SUM(planted_quantity) FROM user_crops WHERE user_id = ? AND (status = 'planted' OR status = 'Ready for Harvest')", (user_id,))
-                occupied_slots = cursor.fetchone()[0] or 0  # Default to 0 if no crops planted
+                # Fetch the number of occupied plots
+                occupied_slots = await repository.get_occupied_plots(user)
 
                 # Check if the quantity exceeds available slots
                 if quantity > (available_slots - occupied_slots):
@@ -130,7 +143,7 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
 
                 if total_balance >= total_cost:
                     # Deduct cashflow
-                    transaction_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Format as 'YYYY-MM-DD HH:MM:SS'
+                    transaction_date = int(time.time())  # Seconds since the epoch
                     
                     # Fetch the plant details for the description
                     plant = next((plant for category in plant_data.values() for plant in category if plant['id'] == selected_plant['plant_id']), None)
@@ -140,23 +153,26 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                     else:
                         description = f'Planted {quantity} plants with ID {selected_plant["plant_id"]}.'  # Fallback description
 
-                    cursor.execute("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", 
-                                   (user_id, -total_cost, description, transaction_date))
-
                     # Insert into user_crops
-                    logger.info(f"user_id type: {type(user_id)}, item_id type: {type(selected_plant['plant_id'])}, planted_at type: {type(transaction_date)}, status type: {type('planted')}, planted_quantity type: {type(quantity)}")
+                    logger.info(f"user_id type: {type(user_id)}, item_id type: {type(selected_plant['plant_id'])}, planted_at type: {type(transaction_date)}, planted_quantity type: {type(quantity)}")
 
                     # Ensure correct data types
                     user_id = int(user_id) if user_id is not None else None  # Ensure user_id is an integer
                     item_id = int(selected_plant['plant_id'])  # Ensure item_id is an integer
                     quantity = int(quantity)  # Ensure quantity is an integer
 
-                    # Now perform the INSERT without specifying the id
-                    cursor.execute("INSERT INTO user_crops (user_id, item_id, planted_at, status, planted_quantity) VALUES (?, ?, ?, ?, ?)",
-                                   (user_id, item_id, transaction_date, 'planted', quantity))
+                    # Charge the ledger and plant the crop (merged into an existing planting that becomes ready at the same time),
+                    # committed together with the writes of other handlers. The slots and balance are checked again in
+                    # that transaction, as another planting may have used them since they were read above.
+                    refusal = await repository.record_planting(user, item_id, quantity, total_cost, description, transaction_date, available_slots)
 
-                    # Commit the transaction
-                    conn.commit()  # Ensure changes are saved to the database
+                    if refusal == REFUSED_PLOTS:
+                        await bot.send_message(chat_id=chat_id, text='You cannot plant more than the available slots.')
+                        return
+                    if refusal == REFUSED_BALANCE:
+                        await bot.send_message(chat_id=chat_id, text='You do not have enough balance to plant this quantity.')
+                        del user_data[chat_id]['selected_plant']
+                        return
 
                     # Log success
                     logger.info(f"Successfully inserted into user_crops: user_id={user_id}, item_id={item_id}, planted_at={transaction_date}, status='planted', planted_quantity={quantity}")
@@ -167,7 +183,7 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                     
                         # Send a small-sized picture to the user
                         photo_path = '../images/planted.webp'  # Replace with the path to your image file
-                        await bot.send_photo(chat_id=chat_id, photo=open(photo_path, 'rb'), caption='Happy planting! 🌱')  # Optional caption   
+                        await send_picture(bot, chat_id, photo_path, 'Happy planting! 🌱', decorative=True)
 
                     else:
                         await bot.send_message(chat_id=chat_id, text='Error: Plant not found.')
@@ -190,11 +206,13 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                 await show_plants(chat_id, callback_data, plant_data)
             elif callback_data.startswith('auto_planting_'):
                 category = callback_data.split('_')[2]  # Extract the category from the callback data
-                await show_auto_planting_plants(chat_id, category)
+                await show_auto_planting_plants(chat_id, category, plant_data)
             elif callback_data == 'show_game_menu':
                 await show_game_menu(chat_id)  # Show the game menu
             elif callback_data == 'rankings':
                 await show_rankings(chat_id)
+            elif callback_data.startswith('rankings_'):  # Switch the leaderboard window
+                await show_rankings(chat_id, callback_data[len('rankings_'):])
             elif callback_data == 'plant_status':  # Handle the plant status callback
                 await check_planting_status(chat_id)  # Check planting status
             elif callback_data == 'admin_announcement':
@@ -203,10 +221,18 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                 await admin_announcement_text(chat_id, user_data)
             elif callback_data == 'admin_announcement_photo':
                 await admin_announcement_photo(chat_id, user_data)
+            elif callback_data == 'admin_broadcasts':
+                await show_broadcast_jobs(chat_id)  # Show announcement progress
+            elif callback_data == 'admin_analytics':
+                await show_economy_report(chat_id)  # Show the economy report
+            elif callback_data == 'admin_reload_catalog':
+                await reload_catalog(chat_id, plant_data)  # Reload the plant and upgrade catalogs
+            elif callback_data.startswith('broadcast_'):
+                await handle_broadcast_control(chat_id, callback_data)  # Pause, resume or cancel an announcement
             elif callback_data == 'manager':
                 await show_manager_menu(chat_id)
             elif callback_data == 'harvest':  # Handle the harvest callback
-                await harvest_crops(chat_id)  # Call the harvest function
+                await harvest_crops(chat_id, interactive=True)  # Call the harvest function
             elif callback_data == 'upgrades':
                 await show_upgrades_menu(chat_id)  # Show upgrades menu
             elif callback_data == 'manager_on_off':
@@ -215,6 +241,11 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                 await handle_manager_on(chat_id)  # Handle manager on
             elif callback_data == 'manager_off':
                 await handle_manager_off(chat_id)  # Handle manager off
+            elif callback_data == 'manager_notifications':
+                await show_notification_preferences(chat_id)  # Show harvest notification preferences
+            elif callback_data.startswith('notification_pref_'):
+                preference = callback_data[len('notification_pref_'):]  # Extract the preference
+                await handle_notification_preference(chat_id, preference)
             elif callback_data == 'auto_planting':
                 await handle_auto_planting(chat_id)  # Handle auto planting
             elif callback_data == 'change_auto_planting':
@@ -250,47 +281,26 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                     price = int(price)
 
                     # Calculate the maximum quantity based on the user's balance
-                    conn = create_connection()
-                    cursor = conn.cursor()
-
-                    # Fetch user ID based on chat_id
-                    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-                    user = cursor.fetchone()
-                    user_id = user[0] if user else None
+                    user, upgrade_ids = await get_known_entitlements(chat_id)
 
-                    # Fetch cashflow entries for the user
-                    cursor.execute("SELECT amount FROM cashflow_ledger WHERE user_id = ?", (user_id,))
-                    balance_response = cursor.fetchall()
+                    if user is None:
+                        await bot.send_message(chat_id=chat_id, text='User not found.')
+                        return
 
                     # Calculate total balance
-                    total_balance = sum(entry[0] for entry in balance_response) if balance_response else 0
+                    total_balance = await repository.get_balance(user)
 
                     # Calculate max quantity
                     max_quantity = total_balance // price if price > 0 else 0
 
-                    # Fetch the user's current upgrade level
-                    cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-                    user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-                    # Determine the highest upgrade level
-                    current_upgrade_level = 0  # Default to 0 if no upgrades
-                    if user_upgrades:
-                        # Extract upgrade IDs
-                        upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
-
-                        # Fetch levels for all upgrade IDs, filtering by category 'plot'
-                        cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), upgrade_ids + ['plot'])
-                        levels = cursor.fetchall()
-
-                        # Find the maximum level
-                        current_upgrade_level = max(level[0] for level in levels) if levels else 0
+                    # Determine the highest upgrade level, 0 if no upgrades
+                    current_upgrade_level = repository.get_upgrade_level(upgrade_ids, 'plot')
 
                     # Get available slots based on the current upgrade level
                     available_slots = get_available_plots_slots(current_upgrade_level)
 
-                    # Fetch crops for the user from the user_crops table
-                    cursor.execute("SELECT SUM(planted_quantity) FROM user_crops WHERE user_id = ? AND (status = 'planted' OR status = 'Ready for Harvest')", (user_id,))
-                    occupied_slots = cursor.fetchone()[0] or 0  # Default to 0 if no crops planted
+                    # Fetch the number of occupied plots
+                    occupied_slots = await repository.get_occupied_plots(user)
 
                     # Ensure max quantity does not exceed available slots   
                     max_quantity = min(max_quantity, available_slots - occupied_slots)
@@ -303,7 +313,7 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                         # Check if the user can afford this total cost
                         if total_balance >= total_cost:
                             # Deduct cashflow
-                            transaction_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Format as 'YYYY-MM-DD HH:MM:SS'
+                            transaction_date = int(time.time())  # Seconds since the epoch
                             
                             # Fetch the plant details for the description
                             plant = next((plant for category in plant_data.values() for plant in category if plant['id'] == selected_plant['plant_id']), None)
@@ -313,21 +323,20 @@ async def handle_message(chat_id, text, update, callback_data, user_data, plant_
                             else:
                                 description = f'Planted {max_quantity} plants with ID {selected_plant["plant_id"]}.'  # Fallback description
 
-                            cursor.execute("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", 
-                                       (user_id, -total_cost, description, transaction_date))
-
-                            # Insert into user_crops
-                            cursor.execute("INSERT INTO user_crops (user_id, item_id, planted_at, status, planted_quantity) VALUES (?, ?, ?, ?, ?)",
-                                       (user_id, selected_plant['plant_id'], transaction_date, 'planted', max_quantity))
+                            # Charge the ledger and plant the crop, committed together with the writes of other handlers.
+                            # The slots and balance are checked again in that transaction.
+                            refusal = await repository.record_planting(user, selected_plant['plant_id'], max_quantity, total_cost, description, transaction_date, available_slots)
 
-                            # Commit the transaction
-                            conn.commit()  # Ensure changes are saved to the database
-
-                            await bot.send_message(chat_id=chat_id, text=f'You have successfully planted {max_quantity:,} {plant["name"]}(s)!')
+                            if refusal == REFUSED_PLOTS:
+                                await bot.send_message(chat_id=chat_id, text='You cannot plant more than the available slots.')
+                            elif refusal == REFUSED_BALANCE:
+                                await bot.send_message(chat_id=chat_id, text='You do not have enough balance to plant this quantity.')
+                            else:
+                                await bot.send_message(chat_id=chat_id, text=f'You have successfully planted {max_quantity:,} {plant["name"]}(s)!')
 
-                            # Send a small-sized picture to the user
-                            photo_path = '../images/planted.webp'  # Replace with the path to your image file
-                            await bot.send_photo(chat_id=chat_id, photo=open(photo_path, 'rb'), caption='Happy planting! 🌱')  # Optional caption
+                                # Send a small-sized picture to the user
+                                photo_path = '../images/planted.webp'  # Replace with the path to your image file
+                                await send_picture(bot, chat_id, photo_path, 'Happy planting! 🌱', decorative=True)
                         else:
                             await bot.send_message(chat_id=chat_id, text='You do not have enough balance to plant this quantity.')
                     else:
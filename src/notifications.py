@@ -0,0 +1,151 @@
+import logging
+import telegram
+from collections import defaultdict
+from database import create_connection
+from telegram_bot import bot, bulk_bot, send_menu
+from harvest_rules import HARVEST_EVENTS, HARVEST_EVENT_MESSAGES
+from reachability import is_reachable
+from overload import send_picture, get_level, LEVEL_SUMMARIZED, LEVEL_ESSENTIAL
+
+logger = logging.getLogger(__name__)
+
+# Harvest notification preferences
+NOTIFICATION_PREFERENCES = ['full', 'summary', 'silent']
+DEFAULT_NOTIFICATION_PREFERENCE = 'summary'
+
+# Telegram rejects photo captions longer than this
+CAPTION_LIMIT = 1024
+
+# Short labels for the harvest events in a report
+HARVEST_EVENT_LABELS = {
+    'extreme_disaster': '🌪️ Extreme disaster',
+    'mild_disaster': '🌪️ Mild disaster',
+    'minimum_harvest': '🌾 Low season',
+    'normal_season': '🌾 Normal season',
+    'good_season': '🌾 Good season',
+}
+
+class HarvestNotifier:
+    """Collect the harvest outcomes of a cycle and send one report per user."""
+
+    def __init__(self):
+        self.outcomes = defaultdict(list)  # chat_id -> [(harvest_event, plant_name, harvested_quantity, cashflow_amount, manager_payroll)]
+
+    def add(self, chat_id, harvest_event, plant_name, harvested_quantity, cashflow_amount, manager_payroll=0):
+        """Record the outcome of one harvested crop."""
+        self.outcomes[chat_id].append((harvest_event, plant_name, harvested_quantity, cashflow_amount, manager_payroll))
+
+    async def flush(self, manager=False, interactive=False):
+        """Send one photo per user summarizing the collected outcomes, honouring each user's preference.
+
+        Under load, reports are summaries only, and reports of automatic harvests are skipped at the essential level.
+        """
+        if not self.outcomes:
+            return
+
+        level = get_level()
+        if level >= LEVEL_ESSENTIAL and not interactive:
+            self.outcomes.clear()
+            return
+
+        preferences = get_notification_preferences(list(self.outcomes))
+
+        for chat_id, outcomes in self.outcomes.items():
+            preference = preferences.get(chat_id, DEFAULT_NOTIFICATION_PREFERENCE)
+
+            # A harvest the user asked for is always reported
+            if preference == 'silent' and interactive:
+                preference = 'summary'
+            if preference == 'silent' or not is_reachable(chat_id):
+                continue
+
+            try:
+                photo_path = choose_report_photo(outcomes, manager)
+                caption = build_harvest_report(outcomes, manager, preference == 'full' and level < LEVEL_SUMMARIZED)
+                await send_picture(bulk_bot, chat_id, photo_path, caption)
+            except Exception as e:
+                logger.error(f"Failed to send harvest report to {chat_id}: {e}")
+
+        self.outcomes.clear()
+
+def choose_report_photo(outcomes, manager):
+    """Pick the photo for a report: the worst disaster if any, otherwise the harvest photo."""
+    events = {outcome[0] for outcome in outcomes}
+    for harvest_event in ('extreme_disaster', 'mild_disaster'):
+        if harvest_event in events:
+            return HARVEST_EVENT_MESSAGES[harvest_event][0]
+    return '../images/manager_harvest.webp' if manager else '../images/harvested.webp'
+
+def build_harvest_report(outcomes, manager, full):
+    """Build the report caption for one user's harvest outcomes."""
+    event_counts = defaultdict(int)
+    harvested_by_plant = defaultdict(int)
+    total_income = 0
+    total_payroll = 0
+
+    for harvest_event, plant_name, harvested_quantity, cashflow_amount, manager_payroll in outcomes:
+        event_counts[harvest_event] += 1
+        harvested_by_plant[plant_name] += harvested_quantity
+        total_income += cashflow_amount
+        total_payroll += manager_payroll
+
+    lines = ['👨‍🌾 Manager harvest report' if manager else '🌾 Harvest report']
+    lines.append(', '.join(f'{HARVEST_EVENT_LABELS[harvest_event]} x{event_counts[harvest_event]}' for harvest_event in HARVEST_EVENTS if event_counts[harvest_event]))
+    lines.append('Harvested: ' + ', '.join(f'{quantity:,} {plant_name}(s)' for plant_name, quantity in harvested_by_plant.items()))
+    lines.append(f'Income: ${total_income:,}')
+    if total_payroll:
+        lines.append(f'Manager payroll: -${total_payroll:,}')
+        lines.append(f'Net: ${total_income - total_payroll:,}')
+
+    if full:
+        # One line per crop, cut off before the caption limit
+        crop_lines = [
+            f'• {HARVEST_EVENT_LABELS[harvest_event]}: {harvested_quantity:,} {plant_name}(s) for ${cashflow_amount:,}'
+            for harvest_event, plant_name, harvested_quantity, cashflow_amount, _ in outcomes
+        ]
+        length = len('\n'.join(lines)) + 1
+        for index, crop_line in enumerate(crop_lines):
+            remaining = len(crop_lines) - index
+            if length + len(crop_line) + 1 > CAPTION_LIMIT - 30:
+                lines.append(f'…and {remaining} more')
+                break
+            lines.append(crop_line)
+            length += len(crop_line) + 1
+
+    return '\n'.join(lines)[:CAPTION_LIMIT]
+
+def get_notification_preferences(chat_ids):
+    """Fetch the harvest notification preference of each chat."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_id, notification_pref FROM users WHERE chat_id IN ({})".format(','.join('?' * len(chat_ids))), chat_ids)
+    preferences = {chat_id: preference or DEFAULT_NOTIFICATION_PREFERENCE for chat_id, preference in cursor.fetchall()}
+    conn.close()
+    return preferences
+
+async def show_notification_preferences(chat_id):
+    """Display the harvest notification preference options."""
+    preference = get_notification_preferences([chat_id]).get(chat_id, DEFAULT_NOTIFICATION_PREFERENCE)
+
+    keyboard = [
+        [telegram.InlineKeyboardButton("📋 Full report", callback_data='notification_pref_full')],
+        [telegram.InlineKeyboardButton("🧾 Summary only", callback_data='notification_pref_summary')],
+        [telegram.InlineKeyboardButton("🔕 Silent", callback_data='notification_pref_silent')]
+    ]
+    reply_markup = telegram.InlineKeyboardMarkup(keyboard)
+
+    await send_menu(chat_id=chat_id, text=f'Manager harvest notifications are currently set to: {preference}.\nChoose how you want to be notified:', reply_markup=reply_markup)
+
+async def handle_notification_preference(chat_id, preference):
+    """Save the user's harvest notification preference."""
+    if preference not in NOTIFICATION_PREFERENCES:
+        await bot.send_message(chat_id=chat_id, text='Unknown notification preference.')
+        return
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET notification_pref = ? WHERE chat_id = ?", (preference, chat_id))
+    conn.commit()
+    conn.close()
+
+    await bot.send_message(chat_id=chat_id, text=f'Harvest notifications set to: {preference}.')
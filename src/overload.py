@@ -0,0 +1,125 @@
+import asyncio
+import os
+import time
+import logging
+from contextlib import contextmanager
+from telegram_bot import bot, bulk_bot
+from write_batcher import get_write_load
+
+logger = logging.getLogger(__name__)
+
+# Degradation levels, each keeping the savings of the levels below it
+LEVEL_NORMAL = 0
+LEVEL_TEXT_ONLY = 1  # Text messages instead of photos
+LEVEL_SUMMARIZED = 2  # Summarized statuses and harvest reports, rankings served from the last computation
+LEVEL_ESSENTIAL = 3  # Ready notifications, manager reports and announcements paused
+LEVEL_NAMES = {LEVEL_NORMAL: 'normal', LEVEL_TEXT_ONLY: 'text_only', LEVEL_SUMMARIZED: 'summarized', LEVEL_ESSENTIAL: 'essential'}
+
+# Overload controller configuration
+OVERLOAD_CONTROL = os.getenv('OVERLOAD_CONTROL', '1') == '1'  # Set to 0 to always run at the normal level
+OVERLOAD_SAMPLE_INTERVAL = float(os.getenv('OVERLOAD_SAMPLE_INTERVAL', 1))  # Seconds between samples of the signals
+OVERLOAD_STEP_UP_SAMPLES = int(os.getenv('OVERLOAD_STEP_UP_SAMPLES', 3))  # Overloaded samples in a row before degrading one level
+OVERLOAD_STEP_DOWN_SAMPLES = int(os.getenv('OVERLOAD_STEP_DOWN_SAMPLES', 30))  # Calm samples in a row before recovering one level
+OVERLOAD_RECOVERY_RATIO = float(os.getenv('OVERLOAD_RECOVERY_RATIO', 0.5))  # A sample is calm when every signal is below this share of its limit
+
+# Limit of each signal; a sample is overloaded when any signal reaches its limit
+OVERLOAD_LIMITS = {
+    'loop_lag_ms': float(os.getenv('OVERLOAD_LOOP_LAG_MS', 100)),  # Event loop delay
+    'queue_depth': int(os.getenv('OVERLOAD_QUEUE_DEPTH', 64)),  # Updates being handled plus writes waiting for a commit
+    'lock_wait_ms': float(os.getenv('OVERLOAD_LOCK_WAIT_MS', 250)),  # Average wait for the database write lock per commit
+    'rate_limited': int(os.getenv('OVERLOAD_RATE_LIMITED', 1)),  # Bot API 429 answers per sample
+}
+
+# This worker's degradation level and the last sampled signals, reported in GET /metrics
+overload_state = {'level': LEVEL_NORMAL, 'level_changes': 0, 'changed_at': None, 'signals': {}}
+
+updates_in_progress = 0  # Updates this worker is handling right now
+
+def get_level():
+    """Return this worker's current degradation level."""
+    return overload_state['level']
+
+def get_overload_stats():
+    """Return the degradation level, its name and the last sampled signals."""
+    stats = dict(overload_state)
+    stats['level_name'] = LEVEL_NAMES[stats['level']]
+    return stats
+
+@contextmanager
+def track_update():
+    """Count an update as in progress while it is handled."""
+    global updates_in_progress
+    updates_in_progress += 1
+    try:
+        yield
+    finally:
+        updates_in_progress -= 1
+
+async def send_picture(sender, chat_id, photo_path, caption, decorative=False):
+    """Send a photo with its caption, or only the caption as text once degraded.
+
+    Decorative photos follow a message that already says everything, so they are dropped instead.
+    """
+    if get_level() >= LEVEL_TEXT_ONLY:
+        if decorative:
+            return None
+        return await sender.send_message(chat_id=chat_id, text=caption)
+    return await sender.send_photo(chat_id=chat_id, photo=open(photo_path, 'rb'), caption=caption)
+
+def set_level(level):
+    """Move to a degradation level."""
+    logger.warning(f"Overload level {LEVEL_NAMES[overload_state['level']]} -> {LEVEL_NAMES[level]} (signals: {overload_state['signals']}).")
+    overload_state.update(level=level, level_changes=overload_state['level_changes'] + 1, changed_at=int(time.time()))
+
+def read_counters():
+    """Return the pending writes and the cumulative counters the signals are computed from."""
+    pending_writes, commits, total_lock_wait = get_write_load()
+    return {'pending_writes': pending_writes, 'commits': commits, 'total_lock_wait': total_lock_wait, 'rate_limited': bot.request.stats['rate_limited'] + bulk_bot.request.stats['rate_limited']}
+
+async def run_overload_controller():
+    """Sample the load signals of this worker and step the degradation level up or down.
+
+    The level rises one step after OVERLOAD_STEP_UP_SAMPLES overloaded samples in a row and falls one step after
+    OVERLOAD_STEP_DOWN_SAMPLES calm samples in a row. Samples in between hold the level, so it does not flap.
+    """
+    if not OVERLOAD_CONTROL:
+        return
+
+    previous = read_counters()
+    overloaded_samples = calm_samples = 0
+
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(OVERLOAD_SAMPLE_INTERVAL)
+        loop_lag = time.perf_counter() - started - OVERLOAD_SAMPLE_INTERVAL  # How late the loop woke us up
+
+        try:
+            counters = read_counters()
+            commits = counters['commits'] - previous['commits']
+            signals = {
+                'loop_lag_ms': round(max(loop_lag, 0) * 1000, 1),
+                'queue_depth': updates_in_progress + counters['pending_writes'],
+                'lock_wait_ms': round((counters['total_lock_wait'] - previous['total_lock_wait']) / commits * 1000, 1) if commits else 0.0,
+                'rate_limited': counters['rate_limited'] - previous['rate_limited'],
+            }
+            previous = counters
+            overload_state['signals'] = signals
+
+            # The busiest signal relative to its limit
+            pressure = max(signals[name] / limit for name, limit in OVERLOAD_LIMITS.items())
+            if pressure >= 1:
+                overloaded_samples, calm_samples = overloaded_samples + 1, 0
+            elif pressure < OVERLOAD_RECOVERY_RATIO:
+                overloaded_samples, calm_samples = 0, calm_samples + 1
+            else:
+                overloaded_samples = calm_samples = 0
+
+            level = get_level()
+            if overloaded_samples >= OVERLOAD_STEP_UP_SAMPLES and level < LEVEL_ESSENTIAL:
+                set_level(level + 1)
+                overloaded_samples = 0
+            elif calm_samples >= OVERLOAD_STEP_DOWN_SAMPLES and level > LEVEL_NORMAL:
+                set_level(level - 1)
+                calm_samples = 0
+        except Exception as e:
+            logger.error(f"Error sampling the overload signals: {e}")
\ No newline at end of file
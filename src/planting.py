@@ -1,22 +1,51 @@
 import telegram
-from telegram_bot import bot
-from database import create_connection
+from telegram_bot import bot, send_menu
 import logging
 from plots import get_available_plots_slots
+from crops import CROP_PLANTED, CROP_STATUS_NAMES
+from menu_cache import get_menu
+from repository import repository
+from user_mgnt import get_known_entitlements
+from overload import get_level, LEVEL_SUMMARIZED
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
-async def show_planting_menu(chat_id):
-    """Display the planting menu with options for fruits, vegetables, and grains."""
+def build_planting_menu():
+    """Build the planting menu with options for fruits, vegetables, and grains."""
     keyboard = [
         [telegram.InlineKeyboardButton("🍉 Fruits", callback_data='Fruits')],
         [telegram.InlineKeyboardButton("🥬 Vegetables", callback_data='Vegetables')],
         [telegram.InlineKeyboardButton("🌾 Grains", callback_data='Grain')]
     ]
-    reply_markup = telegram.InlineKeyboardMarkup(keyboard)
+    return 'Choose a category to plant:', telegram.InlineKeyboardMarkup(keyboard)
+
+async def show_planting_menu(chat_id):
+    """Display the planting menu with options for fruits, vegetables, and grains."""
+    text, reply_markup = get_menu('planting', None, None, build_planting_menu)
+
+    await send_menu(chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+def build_plants_keyboard(plants, callback_data):
+    """Build a keyboard with one button per plant, using callback_data(plant) for each button."""
+    keyboard = [
+        [telegram.InlineKeyboardButton(
+            f"{plant['emoji']} {plant['name']} - ⬇${plant['seed_purchase_price']}/⬆${plant['selling_price']} - {plant['harvest_time']} min",
+            callback_data=callback_data(plant)
+        )]
+        for plant in plants
+    ]
+    return telegram.InlineKeyboardMarkup(keyboard)
 
-    await bot.send_message(chat_id=chat_id, text='Choose a category to plant:', reply_markup=reply_markup)
+async def get_unlocked_plants(chat_id, category, plant_data):
+    """Return the user's crop unlocks and the plants of a category they can plant."""
+    # Fetch the user's upgrade IDs based on chat_id
+    _, upgrade_ids = await get_known_entitlements(chat_id)
+    crop_unlocks = repository.get_crop_unlocks(upgrade_ids)
+
+    # Filter the plants in the category to only include the ones with NULL upgrade_id or the plants with upgrade_id that is in the user_upgrades
+    filtered_plants = [plant for plant in plant_data[category] if plant['upgrade_id'] is None or plant['upgrade_id'] in crop_unlocks]
+    return crop_unlocks, filtered_plants
 
 async def show_plants(chat_id, category, plant_data):
     """Display specific plants based on the selected category."""
@@ -25,31 +54,14 @@ async def show_plants(chat_id, category, plant_data):
         await bot.send_message(chat_id=chat_id, text='No plants available in this category.')
         return
 
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
-
-    # Fetch all upgrade IDs for the user
-    cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-    user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-    # Filter the plants in the category to only include the ones with NULL upgrade_id or the plants with upgrade_id that is in the user_upgrades
-    filtered_plants = [plant for plant in plant_data[category] if plant['upgrade_id'] is None or plant['upgrade_id'] in [upgrade_id[0] for upgrade_id in user_upgrades]]
-    
-    keyboard = [
-        [telegram.InlineKeyboardButton(
-            f"{plant['emoji']} {plant['name']} - ⬇${plant['seed_purchase_price']}/⬆${plant['selling_price']} - {plant['harvest_time']} min",
-            callback_data=f"plant_{category}_{plant['id']}_{plant['seed_purchase_price']}"
-        )]
-        for plant in filtered_plants
-    ]
-    reply_markup = telegram.InlineKeyboardMarkup(keyboard)
+    # The menu only depends on which crop upgrades the user has unlocked
+    crop_unlocks, filtered_plants = await get_unlocked_plants(chat_id, category, plant_data)
+    text, reply_markup = get_menu('plants', category, crop_unlocks, lambda: (
+        f"Choose a plant to purchase from {category.capitalize()}:",
+        build_plants_keyboard(filtered_plants, lambda plant: f"plant_{category}_{plant['id']}_{plant['seed_purchase_price']}")
+    ))
 
-    await bot.send_message(chat_id=chat_id, text=f"Choose a plant to purchase from {category.capitalize()}:", reply_markup=reply_markup)
+    await send_menu(chat_id=chat_id, text=text, reply_markup=reply_markup)
 
 async def handle_plant_selection(chat_id, plant_id, price, user_data, plant_data):
     """Handle the selection of a plant for planting."""
@@ -67,42 +79,19 @@ async def handle_plant_selection(chat_id, plant_id, price, user_data, plant_data
     if plant:
         # Calculate the total cost of the plant
         total_cost = plant['seed_purchase_price']
-        conn = create_connection()
-        cursor = conn.cursor()
-        
-        # Fetch user ID based on chat_id
-        cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-        user = cursor.fetchone()
-        user_id = user[0] if user else None
+        user, upgrade_ids = await get_known_entitlements(chat_id)
+        if user is None:
+            await bot.send_message(chat_id=chat_id, text='User not found.')
+            return
 
-        # Fetch the user's current upgrade level
-        cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-        user_upgrades = cursor.fetchall()  # Fetch all upgrades
+        # Get available slots based on the current plot upgrade level
+        available_slots = get_available_plots_slots(repository.get_upgrade_level(upgrade_ids, 'plot'))
 
-        # Determine the highest upgrade level
-        current_upgrade_level = 0  # Default to 0 if no upgrades
-        if user_upgrades:
-            # Extract upgrade IDs
-            upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
-
-            # Fetch levels for all upgrade IDs, filtering by category 'plot'
-            cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), upgrade_ids + ['plot'])
-            levels = cursor.fetchall()
-
-            # Find the maximum level
-            current_upgrade_level = max(level[0] for level in levels) if levels else 0
-
-        # Get available slots based on the current upgrade level
-        available_slots = get_available_plots_slots(current_upgrade_level)
-
-        # Fetch crops for the user from the user_crops table
-        cursor.execute("SELECT SUM(planted_quantity) FROM user_crops WHERE user_id = ? AND (status = 'planted' OR status = 'Ready for Harvest')", (user_id,))
-        occupied_slots = cursor.fetchone()[0] or 0  # Default to 0 if no crops planted
+        # Fetch the number of occupied plots
+        occupied_slots = await repository.get_occupied_plots(user)
 
         # Calculate max quantity based on balance
-        cursor.execute("SELECT amount FROM cashflow_ledger WHERE user_id = ?", (user_id,))
-        balance_response = cursor.fetchall()
-        total_balance = sum(entry[0] for entry in balance_response) if balance_response else 0
+        total_balance = await repository.get_balance(user)
         max_quantity_by_balance = total_balance // total_cost if total_cost > 0 else 0
 
         # Check if the user can plant more crops by balance
@@ -137,74 +126,44 @@ async def check_planting_status(chat_id):
     """Check the planting status of the user's crops and update if ready for harvest."""
     logger.info(f"Checking planting status for user {chat_id}.")
     
-    conn = create_connection()  # Create a connection to the SQLite database
-    cursor = conn.cursor()
-
-    # Fetch user ID from the database
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
-
-    if user_id:
-        # Fetch crops for the user from the user_crops table
-        cursor.execute("SELECT * FROM user_crops WHERE user_id = ?", (user_id,))
-        crops_response = cursor.fetchall()
+    user, upgrade_ids = await get_known_entitlements(chat_id)
+
+    if user:
+        # Fetch the user's planted and ready crops
+        crops_response = await repository.get_crops(user)
         
         if crops_response:
             crops_status = []
             current_time = datetime.now()  # Get current local time
 
-            # Get the user's current upgrade level
-            cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-            user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-            # Determine the highest upgrade level
-            current_upgrade_level = 0  # Default to 0 if no upgrades
-            if user_upgrades:
-                # Extract upgrade IDs
-                upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
-
-                # Fetch levels for all upgrade IDs, filtering by category 'plot'
-                cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), upgrade_ids + ['plot'])
-                levels = cursor.fetchall()
-
-                # Find the maximum level
-                current_upgrade_level = max(level[0] for level in levels) if levels else 0
-
-            # Get available slots based on the current upgrade level
-            available_slots = get_available_plots_slots(current_upgrade_level)
+            # Get available slots based on the current plot upgrade level
+            available_slots = get_available_plots_slots(repository.get_upgrade_level(upgrade_ids, 'plot'))
 
             # Calculate occupied slots
-            occupied_slots = sum(crop[5] for crop in crops_response if crop[4] != 'Harvested')
+            occupied_slots = await repository.get_occupied_plots(user)
 
+            crops_ready = []  # Planted crops whose harvest time has passed
+            plant_totals = {}  # Plant label -> [ready quantity, growing quantity, minutes until the next is ready], sent instead under load
             for crop in crops_response:
-                # Skip crops that are already harvested
-                if crop[4] == 'Harvested':  # Assuming status is the fifth column
-                    continue
-
                 # Fetch plant details using the item_id
-                cursor.execute("SELECT * FROM plants_listing WHERE id = ?", (crop[2],))  # Assuming item_id is the third column
-                plant = cursor.fetchone()
+                plant = await repository.get_plant(crop['item_id'])
 
                 if plant:
                     # Convert planted_at to a local datetime
-                    planted_at = datetime.fromisoformat(crop[3].replace('Z', ''))  # Assuming planted_at is the fourth column
+                    planted_at = datetime.fromtimestamp(crop['planted_at'])
                     # Calculate harvest ready time
-                    harvest_time_minutes = plant[7]  # Assuming harvest_time is the seventh column
-                    harvest_ready_time = planted_at + timedelta(minutes=harvest_time_minutes)  # Calculate harvest ready time
+                    harvest_ready_time = planted_at + timedelta(minutes=plant['harvest_time'])
 
                     # Initialize status variable
                     status = ""
 
                     # Check if the crop is ready for harvest
                     if current_time >= harvest_ready_time:
-                        # Only update status if it is not already harvested
-                        if crop[4] == 'planted':  # Assuming status is the fifth column
+                        if crop['status'] == CROP_PLANTED:
                             # Update the crop status to "Ready for Harvest"
-                            cursor.execute("UPDATE user_crops SET status = ? WHERE id = ?", ('Ready for Harvest', crop[0]))  # Assuming crop ID is the first column
-                            status = "Ready for Harvest"
-                        if crop[4] == 'Ready for Harvest':  # Assuming status is the fifth column
-                            status = "Ready for Harvest"
+                            crops_ready.append(crop['id'])
+                        status = "Ready for Harvest"
+                        remaining_minutes = None
                     else:
                         # Calculate remaining time until harvest
                         remaining_time = harvest_ready_time - current_time
@@ -212,16 +171,30 @@ async def check_planting_status(chat_id):
                         status = f"Planted - {remaining_minutes} mins left"
 
                     # Ensure crop quantity is treated as an integer
-                    quantity = int(crop[5])  # Assuming crop[5] is the quantity
-                    crops_status.append(f"{plant[3]} {plant[1]} - {status} - Qty: {quantity:,}")  # Assuming emoji is the third column and name is the second
+                    quantity = int(crop['planted_quantity'])
+                    crops_status.append(f"{plant['emoji']} {plant['name']} - {status} - Qty: {quantity:,}")
+
+                    totals = plant_totals.setdefault(f"{plant['emoji']} {plant['name']}", [0, 0, None])
+                    if remaining_minutes is None:
+                        totals[0] += quantity
+                    else:
+                        totals[1] += quantity
+                        totals[2] = remaining_minutes if totals[2] is None else min(totals[2], remaining_minutes)
                 else:
-                    crops_status.append(f"Crop ID: {crop[2]} - Status: {crop[4]} - Quantity: {crop[5]} (Plant details not found)")  # Assuming item_id is the third column
+                    crops_status.append(f"Crop ID: {crop['item_id']} - Status: {CROP_STATUS_NAMES.get(crop['status'], crop['status'])} - Quantity: {crop['planted_quantity']} (Plant details not found)")
+
+            if crops_ready:
+                await repository.mark_crops_ready(user, crops_ready)
+
+            # Under load, one line per plant instead of one per crop
+            if get_level() >= LEVEL_SUMMARIZED:
+                crops_status = [
+                    f"{label} - Ready: {ready:,} - Growing: {growing:,}" + (f" - Next in {next_minutes} mins" if next_minutes is not None else "")
+                    for label, (ready, growing, next_minutes) in plant_totals.items()
+                ]
 
             await bot.send_message(chat_id=chat_id, text=f'Your planting status:\n' + '\n'.join(crops_status) + f'\nYou have {occupied_slots:,} / {available_slots:,} plots occupied.')
         else:
             await bot.send_message(chat_id=chat_id, text='You have not planted any crops yet.')
     else:
-        await bot.send_message(chat_id=chat_id, text='User not found.')
-
-    conn.commit()  # Commit any changes made
-    conn.close()  # Close the database connection
\ No newline at end of file
+        await bot.send_message(chat_id=chat_id, text='User not found.')
\ No newline at end of file
@@ -1,19 +1,47 @@
-from database import create_connection
+import time
+import telegram
 from telegram_bot import bot
+from repository import repository
+from earnings import RANKING_WINDOWS, RANKING_WINDOW_TITLES, get_window_start
+from overload import get_level, LEVEL_TEXT_ONLY, LEVEL_SUMMARIZED
 
-async def show_rankings(chat_id):
-    """Display the rankings menu with options for plant selection."""
-    conn = create_connection()
-    cursor = conn.cursor()
-    
-    # Fetch top 10 the username and total amount from the cashflow_ledger table, grouped by user_id, and order by the total amount in descending order
-    cursor.execute("SELECT users.username, SUM(cashflow_ledger.amount) FROM cashflow_ledger LEFT JOIN users ON cashflow_ledger.user_id = users.id GROUP BY users.id ORDER BY SUM(cashflow_ledger.amount) DESC LIMIT 10")
-    rankings = cursor.fetchall()
+# The last rankings this worker computed per window, served instead of a new computation while it sheds load
+last_rankings = {window: {'message': None, 'computed_at': None} for window in RANKING_WINDOWS}
 
-    rankings_message = "🏆 **Top 10 Rankings**:\n\n"  # Added header
+def get_rankings_keyboard():
+    """Return the buttons that switch between the leaderboard windows."""
+    keyboard = [[telegram.InlineKeyboardButton(title, callback_data=f'rankings_{window}') for window, title in RANKING_WINDOW_TITLES.items()]]
+    return telegram.InlineKeyboardMarkup(keyboard)
+
+async def show_rankings(chat_id, window='all'):
+    """Display the top 10 of a leaderboard window: today, the last 7 days or all time."""
+    if window not in RANKING_WINDOWS:
+        window = 'all'
+    reply_markup = get_rankings_keyboard()
+
+    if get_level() >= LEVEL_SUMMARIZED:
+        cached = last_rankings[window]
+        if cached['message'] is None:
+            await bot.send_message(chat_id=chat_id, text='Rankings are busy right now. Please try again in a few minutes.')
+        else:
+            computed_at = time.strftime('%H:%M', time.localtime(cached['computed_at']))
+            await bot.send_message(chat_id=chat_id, text=cached['message'] + f"\nAs of {computed_at}.", reply_markup=reply_markup)
+        return
+
+    # Fetch top 10 the username and net amount earned in the window, read from the daily rollups
+    rankings = await repository.get_rankings(10, get_window_start(window))
+
+    rankings_message = f"🏆 **Top 10 Rankings - {RANKING_WINDOW_TITLES[window]}**:\n\n"  # Added header
     for index, rank in enumerate(rankings, start=1):
         username = rank[0][:15] + '...' if len(rank[0]) > 15 else rank[0]  # Truncate long usernames
         rankings_message += f"{index}️⃣ {username} - ${rank[1]:,}\n"  # Added ordinal numbers
+    if not rankings:
+        rankings_message += "No earnings yet in this period.\n"
+    last_rankings[window].update(message=rankings_message, computed_at=time.time())
+
+    if get_level() >= LEVEL_TEXT_ONLY:
+        await bot.send_message(chat_id=chat_id, text=rankings_message, reply_markup=reply_markup)
+        return
 
     photo_path = '../images/rankings.jpeg'
-    await bot.send_photo(chat_id=chat_id, photo=photo_path, caption=rankings_message)
\ No newline at end of file
+    await bot.send_photo(chat_id=chat_id, photo=photo_path, caption=rankings_message, reply_markup=reply_markup)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import time
 from collections import defaultdict
+from database import create_connection, SHARED_STATE
 
 # Rate limiting configuration
 RATE_LIMIT = 20  # Maximum number of requests
@@ -9,14 +10,41 @@ TIME_FRAME = 60  # Time frame in seconds
 user_requests = defaultdict(list)
 
 def rate_limiter(chat_id):
+    # Workers have to agree on the request count, so keep it in SQLite when state is shared
+    if SHARED_STATE:
+        return shared_rate_limiter(chat_id)
+
     current_time = time.time()
     # Remove timestamps that are outside the time frame
     user_requests[chat_id] = [timestamp for timestamp in user_requests[chat_id] if current_time - timestamp < TIME_FRAME]
-    
+
     if len(user_requests[chat_id]) < RATE_LIMIT:
         # Allow the request
         user_requests[chat_id].append(current_time)
         return True
     else:
         # Deny the request
-        return False
\ No newline at end of file
+        return False
+
+def shared_rate_limiter(chat_id):
+    """Apply the same sliding window as rate_limiter, backed by the rate_limit_events table."""
+    current_time = time.time()
+    conn = create_connection()
+    cursor = conn.cursor()
+
+    # Take the write lock up front so the count and the insert are atomic across workers
+    cursor.execute("BEGIN IMMEDIATE")
+
+    # Remove timestamps that are outside the time frame
+    cursor.execute("DELETE FROM rate_limit_events WHERE chat_id = ? AND requested_at <= ?", (chat_id, current_time - TIME_FRAME))
+    cursor.execute("SELECT COUNT(*) FROM rate_limit_events WHERE chat_id = ?", (chat_id,))
+    request_count = cursor.fetchone()[0]
+
+    allowed = request_count < RATE_LIMIT
+    if allowed:
+        # Allow the request
+        cursor.execute("INSERT INTO rate_limit_events (chat_id, requested_at) VALUES (?, ?)", (chat_id, current_time))
+
+    conn.commit()
+    conn.close()
+    return allowed
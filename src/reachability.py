@@ -0,0 +1,110 @@
+import asyncio
+import os
+import time
+import logging
+from database import create_connection
+
+logger = logging.getLogger(__name__)
+
+# Reachability configuration
+REACHABILITY_PROBE_BASE = int(os.getenv('REACHABILITY_PROBE_BASE', 86400))  # Seconds before the first re-probe of an unreachable chat
+REACHABILITY_PROBE_MAX = int(os.getenv('REACHABILITY_PROBE_MAX', 30 * 86400))  # Longest wait between re-probes
+REACHABILITY_PROBE_INTERVAL = int(os.getenv('REACHABILITY_PROBE_INTERVAL', 300))  # Seconds between re-probe rounds
+REACHABILITY_PROBE_BATCH = int(os.getenv('REACHABILITY_PROBE_BATCH', 20))  # Chats probed per round, one per second
+REACHABILITY_REFRESH_INTERVAL = int(os.getenv('REACHABILITY_REFRESH_INTERVAL', 60))  # Seconds before the cached set is reloaded
+
+# Chats known to be unreachable: chat_id -> reachability, reloaded from users periodically since other workers update it too
+unreachable_chats = {}
+unreachable_loaded_at = 0.0
+
+def classify_forbidden(error):
+    """Map a Forbidden error from the Bot API to a reachability state."""
+    return 'deactivated' if 'deactivated' in str(error).lower() else 'blocked'
+
+def get_probe_delay(failures):
+    """Return the backoff before re-probing a chat that has failed `failures` times in a row."""
+    return min(REACHABILITY_PROBE_BASE * 2 ** max(failures - 1, 0), REACHABILITY_PROBE_MAX)
+
+def load_unreachable_chats():
+    """Reload the set of unreachable chats from the users table."""
+    global unreachable_chats, unreachable_loaded_at
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_id, reachability FROM users WHERE reachability != 'reachable'")
+    unreachable_chats = dict(cursor.fetchall())
+    conn.close()
+    unreachable_loaded_at = time.monotonic()
+
+def is_reachable(chat_id):
+    """Return False for chats that blocked the bot or were deactivated."""
+    if time.monotonic() - unreachable_loaded_at > REACHABILITY_REFRESH_INTERVAL:
+        try:
+            load_unreachable_chats()
+        except Exception as e:
+            logger.error(f"Error loading unreachable chats: {e}")
+    return chat_id not in unreachable_chats
+
+def mark_unreachable(chat_id, error):
+    """Record a failed delivery to a chat and schedule its next re-probe with exponential backoff."""
+    reachability = classify_forbidden(error)
+    now = time.time()
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE users SET reachability = ?, reachability_failed_at = ?, reachability_failures = reachability_failures + 1
+        WHERE chat_id = ?
+    """, (reachability, now, chat_id))
+    cursor.execute("SELECT reachability_failures FROM users WHERE chat_id = ?", (chat_id,))
+    result = cursor.fetchone()
+    if result:
+        cursor.execute("UPDATE users SET next_probe_at = ? WHERE chat_id = ?", (now + get_probe_delay(result[0]), chat_id))
+    conn.commit()
+    conn.close()
+
+    unreachable_chats[chat_id] = reachability
+    logger.info(f"Chat {chat_id} is {reachability}: {error}")
+
+def mark_reachable(chat_id, force=False):
+    """Clear a chat's unreachable state, e.g. when the user writes to the bot again."""
+    if is_reachable(chat_id) and not force:
+        return  # Nothing to clear, so no write on the common path
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE users SET reachability = 'reachable', reachability_failures = 0, next_probe_at = NULL
+        WHERE chat_id = ?
+    """, (chat_id,))
+    conn.commit()
+    conn.close()
+
+    unreachable_chats.pop(chat_id, None)
+    logger.info(f"Chat {chat_id} is reachable again.")
+
+async def run_reachability_prober():
+    """Periodically re-probe a few unreachable chats whose backoff has expired, with a typing action."""
+    from telegram_bot import bot
+
+    while True:
+        await asyncio.sleep(REACHABILITY_PROBE_INTERVAL)
+        try:
+            conn = create_connection()
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT chat_id FROM users WHERE reachability != 'reachable' AND next_probe_at <= ?
+                ORDER BY next_probe_at LIMIT ?
+            """, (time.time(), REACHABILITY_PROBE_BATCH))
+            chat_ids = [row[0] for row in cursor.fetchall()]
+            conn.close()
+
+            for chat_id in chat_ids:
+                try:
+                    # Blocked chats fail with Forbidden, which reschedules them through the request hook
+                    await bot.send_chat_action(chat_id=chat_id, action='typing')
+                    mark_reachable(chat_id, force=True)
+                except Exception as e:
+                    logger.info(f"Chat {chat_id} is still unreachable: {e}")
+                await asyncio.sleep(1)  # Stay well below the rate limits
+        except Exception as e:
+            logger.error(f"Error re-probing unreachable chats: {e}")
\ No newline at end of file
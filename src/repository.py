@@ -0,0 +1,907 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import time
+import logging
+from collections import Counter
+from database import create_connection, create_tables, connect_shard, get_shard, get_shard_path, DATABASE_NAME, DATABASE_SHARDS, SHARDED_TABLES
+from crops import record_planting, record_harvest, get_occupied_plots, check_occupied_plots, REFUSED_BALANCE, REFUSED_PLOTS, REFUSED_OWNED, CROP_PLANTED, CROP_READY, CROP_HARVESTED, CROP_READY_BUCKET_SECONDS, READY_BUCKET_SQL
+from menu_cache import get_upgrade_catalog, get_upgrade, get_next_upgrade, get_upgrade_level, get_crop_unlocks
+from write_batcher import get_write_batcher, close_write_batchers
+from earnings import record_ledger_entries, get_balance, roll_up_entries, get_day, DAILY_EARNINGS_SQL, DAILY_EARNINGS_SELECT_SQL
+
+logger = logging.getLogger(__name__)
+
+# Storage of the player data (ledger, crops, upgrades, auto planting): sqlite or postgres
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+POSTGRES_DSN = os.getenv('POSTGRES_DSN', 'postgresql://localhost/ffarm')  # Used with STORAGE_BACKEND=postgres
+POSTGRES_POOL_MIN_SIZE = int(os.getenv('POSTGRES_POOL_MIN_SIZE', 2))  # Connections each worker keeps open
+POSTGRES_POOL_MAX_SIZE = int(os.getenv('POSTGRES_POOL_MAX_SIZE', 10))  # Connections each worker opens at most
+REGISTRATION_GRANT_ATTEMPTS = int(os.getenv('REGISTRATION_GRANT_ATTEMPTS', 3))  # Tries at writing a new user's initial cash
+
+# Player data tables in PostgreSQL, with the same columns as in SQLite (see database.create_tables)
+POSTGRES_SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS cashflow_ledger (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        amount BIGINT,
+        description TEXT,
+        transaction_date BIGINT
+    );
+    CREATE INDEX IF NOT EXISTS idx_cashflow_ledger_user ON cashflow_ledger (user_id);
+
+    CREATE TABLE IF NOT EXISTS user_crops (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        item_id INTEGER,
+        planted_at BIGINT,
+        status SMALLINT,
+        planted_quantity BIGINT,
+        ready_bucket BIGINT
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_user_crops_planted_bucket ON user_crops (user_id, item_id, ready_bucket) WHERE status = {CROP_PLANTED};
+    CREATE INDEX IF NOT EXISTS idx_user_crops_user_status ON user_crops (user_id, status);
+    CREATE INDEX IF NOT EXISTS idx_user_crops_planted_at ON user_crops (planted_at) WHERE status = {CROP_PLANTED};
+
+    CREATE TABLE IF NOT EXISTS user_upgrades (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        upgrade_id INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_upgrades_user ON user_upgrades (user_id);
+
+    CREATE TABLE IF NOT EXISTS user_auto_planting (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL UNIQUE,
+        item_id INTEGER
+    );
+
+    CREATE TABLE IF NOT EXISTS plot_counters (
+        user_id BIGINT PRIMARY KEY,
+        occupied_plots BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS plants_listing (
+        id INTEGER PRIMARY KEY,
+        harvest_time INTEGER
+    );
+
+    {DAILY_EARNINGS_SQL.format(schema='').strip().replace('INTEGER', 'BIGINT')};
+    CREATE INDEX IF NOT EXISTS idx_user_daily_earnings_day ON user_daily_earnings (day);
+"""
+
+# Adds rolled up ledger entries to the users' days, as earnings.record_ledger_entries does in SQLite
+POSTGRES_DAILY_EARNINGS_UPSERT_SQL = """
+    INSERT INTO user_daily_earnings (user_id, day, income, spend, payroll, harvests, entries) VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        income = user_daily_earnings.income + excluded.income, spend = user_daily_earnings.spend + excluded.spend,
+        payroll = user_daily_earnings.payroll + excluded.payroll, harvests = user_daily_earnings.harvests + excluded.harvests,
+        entries = user_daily_earnings.entries + excluded.entries
+"""
+
+# Key of the advisory lock that keeps workers from creating the schema at the same time
+POSTGRES_SCHEMA_LOCK = 7_251_042
+
+def record_upgrade_purchase(cursor, user_id, upgrade_id, price, description, transaction_date):
+    """Charge an upgrade to the user's ledger and grant it. Submitted to the write batcher.
+
+    Ownership and the balance are checked in the same transaction. Return None once granted, or REFUSED_OWNED
+    or REFUSED_BALANCE.
+    """
+    cursor.execute("SELECT 1 FROM user_upgrades WHERE user_id = ? AND upgrade_id = ?", (user_id, upgrade_id))
+    if cursor.fetchone():
+        return REFUSED_OWNED
+    if get_balance(cursor, user_id) < price:
+        return REFUSED_BALANCE
+
+    record_ledger_entries(cursor, [(user_id, -price, description, transaction_date)])
+
+    # Insert the upgrade into user_upgrades
+    cursor.execute("INSERT INTO user_upgrades (user_id, upgrade_id) VALUES (?, ?)", (user_id, upgrade_id))
+    return None
+
+class Repository:
+    """Data access for the handlers, with rows returned as dicts keyed by column name.
+
+    Users and the plant and upgrade catalogs are always read from SQLite, together with the tables that
+    coordinate the workers (leases, broadcasts, reachability). Subclasses store the player data: ledger
+    entries, crops, plot counters, upgrades and auto planting choices. Methods taking a user expect a
+    dict from get_user, so implementations can route by chat_id.
+    """
+
+    def __init__(self):
+        self.connections = {}  # Shard (None for the main database) -> connection of this worker
+
+    async def open(self):
+        """Prepare the storage at startup."""
+
+    async def close(self):
+        """Release the connections at shutdown."""
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+    def connect(self, shard=None):
+        """Return this worker's SQLite connection to the main database, or to a shard with the main database attached."""
+        conn = self.connections.get(shard)
+        if conn is None:
+            conn = create_connection() if shard is None else connect_shard(shard)
+            conn.row_factory = sqlite3.Row
+            self.connections[shard] = conn
+        return conn
+
+    # Users
+
+    async def get_user(self, chat_id):
+        """Return the user of a chat (id, chat_id, username, manager_on_off), or None if not registered."""
+        row = self.connect().execute("SELECT id, chat_id, username, manager_on_off FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        return dict(row) if row else None
+
+    async def get_users(self, user_ids):
+        """Return the users with the given ids, by id."""
+        user_ids = list(user_ids)
+        users = {}
+        for start in range(0, len(user_ids), 500):  # Stay under SQLite's parameter limit
+            batch = user_ids[start:start + 500]
+            rows = self.connect().execute("SELECT id, chat_id, username, manager_on_off FROM users WHERE id IN ({})".format(','.join('?' * len(batch))), batch).fetchall()
+            users.update((row['id'], dict(row)) for row in rows)
+        return users
+
+    async def get_manager_users(self):
+        """Return the reachable users with their manager turned on. Automation is paused for users who blocked the bot."""
+        rows = self.connect().execute("SELECT id, chat_id, username, manager_on_off FROM users WHERE manager_on_off = 1 AND reachability = 'reachable'").fetchall()
+        return [dict(row) for row in rows]
+
+    async def get_active_user_ids(self, since):
+        """Return the ids of the users seen since a time (epoch seconds)."""
+        rows = self.connect().execute("SELECT id FROM users WHERE last_seen_at >= ?", (since,)).fetchall()
+        return [row['id'] for row in rows]
+
+    async def set_manager_on_off(self, chat_id, manager_on_off):
+        """Turn the farm manager of a chat on (1) or off (0)."""
+        conn = self.connect()
+        with conn:
+            conn.execute("UPDATE users SET manager_on_off = ? WHERE chat_id = ?", (manager_on_off, chat_id))
+
+    async def get_entitlements(self, chat_id):
+        """Return the user of a chat and the ids of the upgrades they own, or (None, empty set) if not registered."""
+        user = await self.get_user(chat_id)
+        if user is None:
+            return None, frozenset()
+        return user, await self.get_upgrade_ids(user)
+
+    # Catalog
+
+    async def get_plant(self, plant_id):
+        """Return a plant of the catalog, or None."""
+        row = self.connect().execute("SELECT * FROM plants_listing WHERE id = ?", (plant_id,)).fetchone()
+        return dict(row) if row else None
+
+    async def get_upgrade(self, upgrade_id):
+        """Return an upgrade of the catalog (id, level, category, description, price), or None."""
+        return get_upgrade(self.connect().cursor(), upgrade_id)
+
+    async def get_next_upgrade(self, category, level):
+        """Return the upgrade of a category at a level, or None if there is none."""
+        return get_next_upgrade(self.connect().cursor(), category, level)
+
+    def get_upgrade_level(self, upgrade_ids, category):
+        """Return the highest level among the upgrade ids in a category (0 if none)."""
+        return get_upgrade_level(self.connect().cursor(), upgrade_ids, category)
+
+    def get_crop_unlocks(self, upgrade_ids):
+        """Return the crop upgrades among the upgrade ids."""
+        return get_crop_unlocks(self.connect().cursor(), upgrade_ids)
+
+    def get_crops_upgrades(self):
+        """Return the crop upgrades of the catalog with their plants."""
+        return get_upgrade_catalog(self.connect().cursor()).crops_upgrades
+
+    # Ledger
+
+    async def get_rankings(self, limit, since_day=None):
+        """Return the (username, total) of the users with the highest ledger totals, all time or since a day."""
+        top_earners = await self.get_top_earners(limit, since_day)
+        users = await self.get_users(user_id for user_id, _ in top_earners)
+        return [(users[user_id]['username'] if user_id in users else None, total) for user_id, total in top_earners]
+
+class SQLiteRepository(Repository):
+    """Player data in the SQLite database, or in its shards (see shards.py).
+
+    Reads use this worker's connection to the user's shard. Plantings, harvests and upgrade purchases go
+    through the shard's write batcher, so they share group commits.
+    """
+
+    def shard_of(self, user):
+        """Return the shard holding a user's rows (None without sharding)."""
+        return get_shard(user['chat_id']) if DATABASE_SHARDS > 1 else None
+
+    def shards(self):
+        """Return every shard holding player data."""
+        return list(range(DATABASE_SHARDS)) if DATABASE_SHARDS > 1 else [None]
+
+    async def replicate_catalog(self):
+        """Refresh the shards' copies of the catalog tables after the catalogs changed."""
+        if DATABASE_SHARDS > 1:
+            from shards import replicate_catalog_to_shards
+            replicate_catalog_to_shards()
+
+    async def close(self):
+        await close_write_batchers()  # Commit the writes still queued
+        await super().close()
+
+    async def register_user(self, chat_id, username, created_at, amount, description):
+        """Insert a user unless they exist, with their initial cash in the same transaction. Return (user, registered)."""
+        conn = self.connect(get_shard(chat_id) if DATABASE_SHARDS > 1 else None)
+        with conn:
+            cursor = conn.execute("INSERT INTO users (chat_id, username, created_at) VALUES (?, ?, ?) ON CONFLICT(chat_id) DO NOTHING", (chat_id, username, created_at))
+            registered = cursor.rowcount == 1
+            if registered:
+                record_ledger_entries(conn, [(cursor.lastrowid, amount, description, created_at)])
+        return await self.get_user(chat_id), registered
+
+    async def get_entitlements(self, chat_id):
+        # One query over users and user_upgrades, both reachable from the chat's connection
+        row = self.connect(get_shard(chat_id) if DATABASE_SHARDS > 1 else None).execute("""
+            SELECT users.id, users.chat_id, users.username, users.manager_on_off, GROUP_CONCAT(user_upgrades.upgrade_id) AS upgrade_ids
+            FROM users LEFT JOIN user_upgrades ON user_upgrades.user_id = users.id
+            WHERE users.chat_id = ?
+            GROUP BY users.id
+        """, (chat_id,)).fetchone()
+
+        if row is None:
+            return None, frozenset()
+
+        user = dict(row)
+        upgrade_ids = user.pop('upgrade_ids')
+        return user, frozenset(int(upgrade_id) for upgrade_id in upgrade_ids.split(',')) if upgrade_ids else frozenset()
+
+    async def get_balance(self, user):
+        """Return the sum of a user's ledger entries."""
+        return self.connect(self.shard_of(user)).execute("SELECT COALESCE(SUM(amount), 0) FROM cashflow_ledger WHERE user_id = ?", (user['id'],)).fetchone()[0]
+
+    async def add_ledger_entry(self, user, amount, description, transaction_date):
+        """Add one entry to a user's ledger."""
+        conn = self.connect(self.shard_of(user))
+        with conn:
+            record_ledger_entries(conn, [(user['id'], amount, description, transaction_date)])
+
+    async def get_top_earners(self, limit, since_day=None):
+        """Return the (user_id, total) of the users with the highest ledger totals, all time or since a day."""
+        top_earners = []
+        for shard in self.shards():
+            # The overall top is among the top of every shard; the daily rollups add up to the ledger
+            rows = self.connect(shard).execute(f"""
+                SELECT user_id, SUM(income - spend - payroll) AS total FROM user_daily_earnings
+                {'WHERE day >= ?' if since_day is not None else ''} GROUP BY user_id ORDER BY total DESC LIMIT ?
+            """, ((since_day,) if since_day is not None else ()) + (limit,)).fetchall()
+            top_earners.extend((row['user_id'], row['total']) for row in rows)
+        return sorted(top_earners, key=lambda earner: earner[1], reverse=True)[:limit]
+
+    async def get_crops(self, user):
+        """Return a user's planted and ready crops (id, item_id, planted_at, status, planted_quantity)."""
+        rows = self.connect(self.shard_of(user)).execute(f"SELECT id, item_id, planted_at, status, planted_quantity FROM user_crops WHERE user_id = ? AND status IN ({CROP_PLANTED}, {CROP_READY}) ORDER BY id", (user['id'],)).fetchall()
+        return [dict(row) for row in rows]
+
+    async def mark_crops_ready(self, user, crop_ids):
+        """Mark planted crops of a user as ready for harvest, those whose harvest time has passed."""
+        now = int(time.time())
+        conn = self.connect(self.shard_of(user))
+        with conn:
+            # A row merged with a later planting since it was read matures later
+            conn.executemany(f"""
+                UPDATE user_crops SET status = {CROP_READY}
+                WHERE id = ? AND status = {CROP_PLANTED}
+                AND planted_at + (SELECT harvest_time FROM plants_listing WHERE plants_listing.id = user_crops.item_id) * 60 <= ?
+            """, [(crop_id, now) for crop_id in crop_ids])
+
+    async def get_planted_crops(self, user, crop_ids):
+        """Return (id, user_id, ready_at) of the given crops of a user that are still planted."""
+        placeholders = ','.join('?' * len(crop_ids))
+        rows = self.connect(self.shard_of(user)).execute(f"""
+            SELECT user_crops.id, user_crops.user_id, user_crops.planted_at + plants_listing.harvest_time * 60 AS ready_at
+            FROM user_crops
+            JOIN plants_listing ON plants_listing.id = user_crops.item_id
+            WHERE user_crops.id IN ({placeholders}) AND user_crops.user_id = ? AND user_crops.status = {CROP_PLANTED}
+        """, list(crop_ids) + [user['id']]).fetchall()
+        return [(row['id'], row['user_id'], row['ready_at']) for row in rows]
+
+    async def count_due_crops(self, now):
+        """Return the number of planted crops whose harvest time has passed, and of their owners."""
+        crops, user_ids = 0, set()
+        for shard in self.shards():
+            rows = self.connect(shard).execute(f"""
+                SELECT user_crops.user_id, COUNT(*) FROM user_crops
+                JOIN plants_listing ON plants_listing.id = user_crops.item_id
+                WHERE user_crops.status = {CROP_PLANTED} AND user_crops.planted_at + plants_listing.harvest_time * 60 <= ?
+                GROUP BY user_crops.user_id
+            """, (now,)).fetchall()
+            crops += sum(row[1] for row in rows)
+            user_ids.update(row[0] for row in rows)
+        return crops, len(user_ids)
+
+    async def mark_due_crops_ready(self, now, limit=None, active_since=None):
+        """Mark planted crops whose harvest time has passed as ready. Return the number marked per owner's user id.
+
+        With a limit, at most that many crops are marked: those of users seen since active_since first, then the
+        longest overdue.
+        """
+        if limit is None:
+            order, parameters = '', (0, now)
+        else:
+            order, parameters = 'ORDER BY active DESC, ready_at LIMIT ?', (active_since, now, limit)
+
+        due_crops = []
+        for shard in self.shards():
+            rows = self.connect(shard).execute(f"""
+                SELECT user_crops.id, user_crops.user_id, user_crops.planted_at + plants_listing.harvest_time * 60 AS ready_at,
+                       COALESCE((SELECT last_seen_at FROM users WHERE users.id = user_crops.user_id), 0) >= ? AS active
+                FROM user_crops
+                JOIN plants_listing ON plants_listing.id = user_crops.item_id
+                WHERE user_crops.status = {CROP_PLANTED} AND user_crops.planted_at + plants_listing.harvest_time * 60 <= ?
+                {order}
+            """, parameters).fetchall()
+            due_crops.extend((shard, row) for row in rows)
+
+        if limit is not None:
+            # The slice is taken from the first crops of every shard
+            due_crops = sorted(due_crops, key=lambda due_crop: (-due_crop[1]['active'], due_crop[1]['ready_at']))[:limit]
+
+        for shard in self.shards():
+            conn = self.connect(shard)
+            with conn:
+                conn.executemany(f"UPDATE user_crops SET status = {CROP_READY} WHERE id = ? AND status = {CROP_PLANTED}",
+                                 [(row['id'],) for crop_shard, row in due_crops if crop_shard == shard])
+        return dict(Counter(row['user_id'] for _, row in due_crops))
+
+    async def get_planted_crops_since(self, checkpoints):
+        """Return the planted crops with ids past each shard's checkpoint as (id, user_id, ready_at, shard), and the new checkpoints.
+
+        Ids only grow in commit order, since every write to a shard holds its write lock until it commits.
+        """
+        crops, checkpoints = [], dict(checkpoints)
+        for shard in self.shards():
+            conn = self.connect(shard)
+            highest = conn.execute("SELECT COALESCE(MAX(id), 0) FROM user_crops").fetchone()[0]
+            rows = conn.execute(f"""
+                SELECT user_crops.id, user_crops.user_id, user_crops.planted_at + plants_listing.harvest_time * 60 AS ready_at
+                FROM user_crops
+                JOIN plants_listing ON plants_listing.id = user_crops.item_id
+                WHERE user_crops.id > ? AND user_crops.id <= ? AND user_crops.status = {CROP_PLANTED}
+            """, (checkpoints.get(shard, 0), highest)).fetchall()
+            crops.extend((row['id'], row['user_id'], row['ready_at'], shard) for row in rows)
+            checkpoints[shard] = highest
+        return crops, checkpoints
+
+    async def get_ready_crops(self, user):
+        """Return a user's ready crops aggregated per plant (item_id, quantity, crop_ids)."""
+        rows = self.connect(self.shard_of(user)).execute(f"SELECT item_id, SUM(planted_quantity) AS quantity, GROUP_CONCAT(id) AS crop_ids FROM user_crops WHERE user_id = ? AND status = {CROP_READY} GROUP BY item_id", (user['id'],)).fetchall()
+        return [{'item_id': row['item_id'], 'quantity': row['quantity'], 'crop_ids': [int(crop_id) for crop_id in row['crop_ids'].split(',')]} for row in rows]
+
+    async def get_occupied_plots(self, user):
+        """Return the number of plots a user's planted and ready crops occupy."""
+        return get_occupied_plots(self.connect(self.shard_of(user)).cursor(), user['id'])
+
+    async def record_planting(self, user, item_id, quantity, total_cost, description, planted_at, available_plots):
+        """Charge a planting to the user's ledger and plant the crop in one transaction, unless the user lacks the
+        free plots or the balance. Return None once planted, or REFUSED_PLOTS or REFUSED_BALANCE.
+        """
+        return await get_write_batcher(user['chat_id']).submit(record_planting, user['id'], item_id, quantity, total_cost, description, planted_at, available_plots)
+
+    async def record_harvest(self, user, harvests):
+        """Mark the crops of each (crop_ids, ledger_entries) harvest as harvested and write its (user_id, amount,
+        description, transaction_date) ledger entries. A harvest whose crops are no longer all ready is not paid.
+        Return whether each harvest was recorded.
+        """
+        return await get_write_batcher(user['chat_id']).submit(record_harvest, harvests)
+
+    async def check_occupied_plots(self, fix=False):
+        """Compare the plot counters with the crops. Return the mismatches as (user_id, counter, actual)."""
+        return check_occupied_plots(fix)
+
+    async def get_upgrade_ids(self, user):
+        """Return the ids of the upgrades a user owns."""
+        rows = self.connect(self.shard_of(user)).execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user['id'],)).fetchall()
+        return frozenset(row[0] for row in rows)
+
+    async def record_upgrade_purchase(self, user, upgrade_id, price, description, transaction_date):
+        """Charge an upgrade to the user's ledger and grant it in one transaction, unless they own it or lack the
+        balance. Return None once granted, or REFUSED_OWNED or REFUSED_BALANCE.
+        """
+        return await get_write_batcher(user['chat_id']).submit(record_upgrade_purchase, user['id'], upgrade_id, price, description, transaction_date)
+
+    async def get_auto_planting(self, user):
+        """Return the plant a user's manager plants, or None."""
+        row = self.connect(self.shard_of(user)).execute("SELECT item_id FROM user_auto_planting WHERE user_id = ?", (user['id'],)).fetchone()
+        return row[0] if row else None
+
+    async def set_auto_planting(self, user, item_id):
+        """Choose the plant a user's manager plants."""
+        conn = self.connect(self.shard_of(user))
+        with conn:
+            existing_entry = conn.execute("SELECT id FROM user_auto_planting WHERE user_id = ?", (user['id'],)).fetchone()
+            if existing_entry:
+                conn.execute("UPDATE user_auto_planting SET item_id = ? WHERE id = ?", (item_id, existing_entry[0]))
+            else:
+                conn.execute("INSERT INTO user_auto_planting (user_id, item_id) VALUES (?, ?)", (user['id'], item_id))
+
+async def record_ledger_entries_postgres(conn, ledger_entries):
+    """Insert ledger entries and add them to the daily rollups, inside the caller's transaction."""
+    await conn.executemany("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES ($1, $2, $3, $4)", ledger_entries)
+    await conn.executemany(POSTGRES_DAILY_EARNINGS_UPSERT_SQL, roll_up_entries(ledger_entries))
+
+async def rebuild_daily_earnings_postgres(conn):
+    """Rebuild the daily rollups from the ledger if they do not add up to it, as earnings.create_daily_earnings does."""
+    ledger_totals = tuple(await conn.fetchrow("SELECT COUNT(*)::bigint, COALESCE(SUM(amount), 0)::bigint FROM cashflow_ledger"))
+    rollup_totals = tuple(await conn.fetchrow("SELECT COALESCE(SUM(entries), 0)::bigint, COALESCE(SUM(income - spend - payroll), 0)::bigint FROM user_daily_earnings"))
+    if rollup_totals != ledger_totals:
+        await conn.execute("DELETE FROM user_daily_earnings")
+        await conn.execute(f"INSERT INTO user_daily_earnings (user_id, day, income, spend, payroll, harvests, entries) {DAILY_EARNINGS_SELECT_SQL}")
+        logger.info(f"Rebuilt the daily earnings of {ledger_totals[0]:,} ledger entries.")
+
+class PostgresRepository(Repository):
+    """Player data in PostgreSQL, through an asyncpg connection pool per worker.
+
+    The plants catalog is copied from SQLite at startup and on a catalog reload, for the ready time of crops. Plot counters are kept
+    in plot_counters, as in the SQLite shards.
+    """
+
+    def __init__(self, dsn=POSTGRES_DSN, min_size=POSTGRES_POOL_MIN_SIZE, max_size=POSTGRES_POOL_MAX_SIZE, schema=None):
+        super().__init__()
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.schema = schema  # Search path of the pool's connections, the database's default if None
+        self.pool = None
+
+    async def open(self):
+        """Open the pool, create the tables if needed and refresh the catalog copy."""
+        import asyncpg  # Only needed with STORAGE_BACKEND=postgres
+
+        server_settings = {'search_path': self.schema} if self.schema else None
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size, server_settings=server_settings)
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Workers start together; one creates the tables while the others wait
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", POSTGRES_SCHEMA_LOCK)
+                await conn.execute(POSTGRES_SCHEMA)
+                await rebuild_daily_earnings_postgres(conn)
+                await self.copy_plants(conn)
+
+    async def copy_plants(self, conn):
+        """Replace the copy of the plants catalog with the ready times of the plants in SQLite."""
+        plants = [tuple(row) for row in self.connect().execute("SELECT id, harvest_time FROM plants_listing").fetchall()]
+        await conn.execute("DELETE FROM plants_listing")
+        await conn.executemany("INSERT INTO plants_listing (id, harvest_time) VALUES ($1, $2)", plants)
+
+    async def replicate_catalog(self):
+        """Refresh the copy of the plants catalog after the catalogs changed."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await self.copy_plants(conn)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        await super().close()
+
+    async def lock_user(self, conn, user):
+        """Lock the user's plot counter row until the transaction ends, so their plantings and purchases are checked
+        and written one at a time. Return their occupied plots.
+        """
+        await conn.execute("INSERT INTO plot_counters (user_id, occupied_plots) VALUES ($1, 0) ON CONFLICT (user_id) DO NOTHING", user['id'])
+        return await conn.fetchval("SELECT occupied_plots FROM plot_counters WHERE user_id = $1 FOR UPDATE", user['id'])
+
+    async def register_user(self, chat_id, username, created_at, amount, description):
+        """Insert a user unless they exist and grant their initial cash. Return (user, registered).
+
+        The user row is committed in SQLite first, so the SQLite write lock is never held while waiting on
+        PostgreSQL. The grant follows, at most once per user, and is retried; a grant lost to a crash is made
+        up the next time a worker registers the chat.
+        """
+        conn = self.connect()
+        with conn:
+            registered = conn.execute("INSERT INTO users (chat_id, username, created_at) VALUES (?, ?, ?) ON CONFLICT(chat_id) DO NOTHING", (chat_id, username, created_at)).rowcount == 1
+        user = await self.get_user(chat_id)
+
+        for attempt in range(REGISTRATION_GRANT_ATTEMPTS):
+            try:
+                await self.grant_initial_cash(user, amount, description, created_at)
+                break
+            except Exception as e:
+                if attempt == REGISTRATION_GRANT_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"Granting the initial cash of user {user['id']} failed, retrying: {e}")
+                await asyncio.sleep(0.1 * 2 ** attempt)
+        return user, registered
+
+    async def grant_initial_cash(self, user, amount, description, transaction_date):
+        """Write the user's initial cash unless their ledger already has it."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await self.lock_user(conn, user)  # Concurrent registrations of the chat grant one after the other
+                if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM cashflow_ledger WHERE user_id = $1 AND description = $2)", user['id'], description):
+                    await record_ledger_entries_postgres(conn, [(user['id'], amount, description, transaction_date)])
+
+    async def get_balance(self, user):
+        return await self.pool.fetchval("SELECT COALESCE(SUM(amount), 0)::bigint FROM cashflow_ledger WHERE user_id = $1", user['id'])
+
+    async def add_ledger_entry(self, user, amount, description, transaction_date):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await record_ledger_entries_postgres(conn, [(user['id'], amount, description, transaction_date)])
+
+    async def get_top_earners(self, limit, since_day=None):
+        rows = await self.pool.fetch(f"""
+            SELECT user_id, SUM(income - spend - payroll)::bigint AS total FROM user_daily_earnings
+            {'WHERE day >= $2' if since_day is not None else ''} GROUP BY user_id ORDER BY total DESC LIMIT $1
+        """, limit, *((since_day,) if since_day is not None else ()))
+        return [(row['user_id'], row['total']) for row in rows]
+
+    async def get_crops(self, user):
+        rows = await self.pool.fetch(f"SELECT id, item_id, planted_at, status, planted_quantity FROM user_crops WHERE user_id = $1 AND status IN ({CROP_PLANTED}, {CROP_READY}) ORDER BY id", user['id'])
+        return [dict(row) for row in rows]
+
+    async def mark_crops_ready(self, user, crop_ids):
+        await self.pool.execute(f"""
+            UPDATE user_crops SET status = {CROP_READY}
+            FROM plants_listing
+            WHERE plants_listing.id = user_crops.item_id AND user_crops.id = ANY($1::bigint[]) AND user_crops.status = {CROP_PLANTED}
+              AND user_crops.planted_at + plants_listing.harvest_time * 60 <= $2
+        """, list(crop_ids), int(time.time()))
+
+    async def get_planted_crops(self, user, crop_ids):
+        rows = await self.pool.fetch(f"""
+            SELECT user_crops.id, user_crops.user_id, user_crops.planted_at + plants_listing.harvest_time * 60 AS ready_at
+            FROM user_crops
+            JOIN plants_listing ON plants_listing.id = user_crops.item_id
+            WHERE user_crops.id = ANY($1::bigint[]) AND user_crops.user_id = $2 AND user_crops.status = {CROP_PLANTED}
+        """, list(crop_ids), user['id'])
+        return [(row['id'], row['user_id'], row['ready_at']) for row in rows]
+
+    async def count_due_crops(self, now):
+        row = await self.pool.fetchrow(f"""
+            SELECT COUNT(*) AS crops, COUNT(DISTINCT user_crops.user_id) AS users FROM user_crops
+            JOIN plants_listing ON plants_listing.id = user_crops.item_id
+            WHERE user_crops.status = {CROP_PLANTED} AND user_crops.planted_at + plants_listing.harvest_time * 60 <= $1
+        """, now)
+        return row['crops'], row['users']
+
+    async def mark_due_crops_ready(self, now, limit=None, active_since=None):
+        if limit is None:
+            rows = await self.pool.fetch(f"""
+                UPDATE user_crops SET status = {CROP_READY}
+                FROM plants_listing
+                WHERE plants_listing.id = user_crops.item_id AND user_crops.status = {CROP_PLANTED}
+                  AND user_crops.planted_at + plants_listing.harvest_time * 60 <= $1
+                RETURNING user_crops.user_id
+            """, now)
+        else:
+            # Users are in SQLite, so the recently seen ones are passed in
+            rows = await self.pool.fetch(f"""
+                WITH due AS (
+                    SELECT user_crops.id FROM user_crops
+                    JOIN plants_listing ON plants_listing.id = user_crops.item_id
+                    WHERE user_crops.status = {CROP_PLANTED} AND user_crops.planted_at + plants_listing.harvest_time * 60 <= $1
+                    ORDER BY user_crops.user_id = ANY($2::bigint[]) DESC, user_crops.planted_at + plants_listing.harvest_time * 60
+                    LIMIT $3
+                    FOR UPDATE OF user_crops SKIP LOCKED
+                )
+                UPDATE user_crops SET status = {CROP_READY}
+                FROM due WHERE user_crops.id = due.id
+                RETURNING user_crops.user_id
+            """, now, await self.get_active_user_ids(active_since), limit)
+        return dict(Counter(row['user_id'] for row in rows))
+
+    async def get_planted_crops_since(self, checkpoints):
+        # Sequence values can commit out of order, so a crop committed late below the checkpoint waits for the manager rescan
+        highest = await self.pool.fetchval("SELECT COALESCE(MAX(id), 0) FROM user_crops")
+        rows = await self.pool.fetch(f"""
+            SELECT user_crops.id, user_crops.user_id, user_crops.planted_at + plants_listing.harvest_time * 60 AS ready_at
+            FROM user_crops
+            JOIN plants_listing ON plants_listing.id = user_crops.item_id
+            WHERE user_crops.id > $1 AND user_crops.id <= $2 AND user_crops.status = {CROP_PLANTED}
+        """, checkpoints.get(None, 0), highest)
+        return [(row['id'], row['user_id'], row['ready_at'], None) for row in rows], {None: highest}
+
+    async def get_ready_crops(self, user):
+        rows = await self.pool.fetch(f"SELECT item_id, SUM(planted_quantity)::bigint AS quantity, array_agg(id ORDER BY id) AS crop_ids FROM user_crops WHERE user_id = $1 AND status = {CROP_READY} GROUP BY item_id", user['id'])
+        return [{'item_id': row['item_id'], 'quantity': row['quantity'], 'crop_ids': list(row['crop_ids'])} for row in rows]
+
+    async def get_occupied_plots(self, user):
+        return await self.pool.fetchval("SELECT COALESCE((SELECT occupied_plots FROM plot_counters WHERE user_id = $1), 0)", user['id'])
+
+    async def record_planting(self, user, item_id, quantity, total_cost, description, planted_at, available_plots):
+        ready_bucket = READY_BUCKET_SQL.format(
+            planted_at='$3::bigint',
+            harvest_time='(SELECT harvest_time FROM plants_listing WHERE id = $2)',
+            bucket=CROP_READY_BUCKET_SECONDS,
+        )
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if quantity > available_plots - await self.lock_user(conn, user):
+                    return REFUSED_PLOTS
+                if await conn.fetchval("SELECT COALESCE(SUM(amount), 0)::bigint FROM cashflow_ledger WHERE user_id = $1", user['id']) < total_cost:
+                    return REFUSED_BALANCE
+
+                await record_ledger_entries_postgres(conn, [(user['id'], -total_cost, description, planted_at)])
+
+                # Merged into the user's planted row for the same plant and ready bucket, as crops.plant_crop does
+                await conn.execute(f"""
+                    INSERT INTO user_crops (user_id, item_id, planted_at, status, planted_quantity, ready_bucket)
+                    VALUES ($1, $2, $3, {CROP_PLANTED}, $4, {ready_bucket})
+                    ON CONFLICT (user_id, item_id, ready_bucket) WHERE status = {CROP_PLANTED}
+                    DO UPDATE SET planted_quantity = user_crops.planted_quantity + excluded.planted_quantity,
+                                  planted_at = GREATEST(user_crops.planted_at, excluded.planted_at)
+                """, user['id'], item_id, planted_at, quantity)
+
+                await conn.execute("UPDATE plot_counters SET occupied_plots = occupied_plots + $2 WHERE user_id = $1", user['id'], quantity)
+        return None
+
+    async def record_harvest(self, user, harvests):
+        recorded = []
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for crop_ids, ledger_entries in harvests:
+                    crop_ids = list(dict.fromkeys(crop_ids))
+
+                    # Lock the rows, so a concurrent harvest waits and then finds them harvested
+                    locked = await conn.fetch(f"SELECT id FROM user_crops WHERE id = ANY($1::bigint[]) AND status = {CROP_READY} FOR UPDATE", crop_ids)
+                    if len(locked) != len(crop_ids):
+                        recorded.append(False)  # Rows harvested in the meantime are left alone and not paid again
+                        continue
+
+                    harvested = await conn.fetch(f"""
+                        UPDATE user_crops SET status = {CROP_HARVESTED}
+                        WHERE id = ANY($1::bigint[]) AND status = {CROP_READY}
+                        RETURNING id, user_id, planted_quantity
+                    """, crop_ids)
+                    freed = Counter()
+                    for row in harvested:
+                        freed[row['user_id']] += row['planted_quantity']
+                    await conn.executemany("UPDATE plot_counters SET occupied_plots = occupied_plots - $2 WHERE user_id = $1", list(freed.items()))
+
+                    # Paid only for the rows this update moved from ready to harvested
+                    if len(harvested) == len(crop_ids) and ledger_entries:
+                        await record_ledger_entries_postgres(conn, ledger_entries)
+                    recorded.append(len(harvested) == len(crop_ids))
+        return recorded
+
+    async def check_occupied_plots(self, fix=False):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Hold the counters while correcting so no planting or harvest slips in between the check and the fix
+                if fix:
+                    await conn.execute("LOCK TABLE plot_counters IN SHARE ROW EXCLUSIVE MODE")
+
+                mismatches = [tuple(row) for row in await conn.fetch(f"""
+                    SELECT COALESCE(counters.user_id, active.user_id), counters.occupied_plots, COALESCE(active.quantity, 0)
+                    FROM plot_counters AS counters FULL JOIN (
+                        SELECT user_id, SUM(planted_quantity)::bigint AS quantity FROM user_crops
+                        WHERE status IN ({CROP_PLANTED}, {CROP_READY}) GROUP BY user_id
+                    ) AS active ON active.user_id = counters.user_id
+                    WHERE COALESCE(counters.occupied_plots, 0) != COALESCE(active.quantity, 0)
+                """)]
+
+                for user_id, counter, actual in mismatches:
+                    logger.warning(f"occupied_plots of user {user_id} is {counter} but their crops occupy {actual} plots.")
+
+                if fix and mismatches:
+                    await conn.executemany("""
+                        INSERT INTO plot_counters (user_id, occupied_plots) VALUES ($1, $2)
+                        ON CONFLICT (user_id) DO UPDATE SET occupied_plots = excluded.occupied_plots
+                    """, [(user_id, actual) for user_id, _, actual in mismatches])
+                    logger.info(f"Corrected occupied_plots for {len(mismatches)} users.")
+
+        return mismatches
+
+    async def get_upgrade_ids(self, user):
+        rows = await self.pool.fetch("SELECT upgrade_id FROM user_upgrades WHERE user_id = $1", user['id'])
+        return frozenset(row['upgrade_id'] for row in rows)
+
+    async def record_upgrade_purchase(self, user, upgrade_id, price, description, transaction_date):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await self.lock_user(conn, user)
+                if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM user_upgrades WHERE user_id = $1 AND upgrade_id = $2)", user['id'], upgrade_id):
+                    return REFUSED_OWNED
+                if await conn.fetchval("SELECT COALESCE(SUM(amount), 0)::bigint FROM cashflow_ledger WHERE user_id = $1", user['id']) < price:
+                    return REFUSED_BALANCE
+
+                await record_ledger_entries_postgres(conn, [(user['id'], -price, description, transaction_date)])
+                await conn.execute("INSERT INTO user_upgrades (user_id, upgrade_id) VALUES ($1, $2)", user['id'], upgrade_id)
+        return None
+
+    async def get_auto_planting(self, user):
+        return await self.pool.fetchval("SELECT item_id FROM user_auto_planting WHERE user_id = $1", user['id'])
+
+    async def set_auto_planting(self, user, item_id):
+        await self.pool.execute("""
+            INSERT INTO user_auto_planting (user_id, item_id) VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE SET item_id = excluded.item_id
+        """, user['id'], item_id)
+
+    async def copy_from_sqlite(self):
+        """Copy the player data of the SQLite database (or its shards) into empty PostgreSQL tables. Return the row counts."""
+        async with self.pool.acquire() as conn:
+            if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM cashflow_ledger)"):
+                raise SystemExit("The PostgreSQL tables already hold player data.")
+
+            sources = [get_shard_path(shard) for shard in range(DATABASE_SHARDS)] if DATABASE_SHARDS > 1 else [DATABASE_NAME]
+            counts = dict.fromkeys(SHARDED_TABLES + ('plot_counters',), 0)
+            async with conn.transaction():
+                for source in sources:
+                    sqlite_conn = sqlite3.connect(source)
+                    for table in SHARDED_TABLES:
+                        columns = [row[1] for row in await conn.fetch("SELECT ordinal_position, column_name FROM information_schema.columns WHERE table_name = $1 AND table_schema = current_schema() ORDER BY ordinal_position", table)]
+                        # Ids are assigned afresh, shard ids overlap and nothing refers to them
+                        columns.remove('id')
+                        rows = sqlite_conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id").fetchall()
+                        await conn.copy_records_to_table(table, records=rows, columns=columns)
+                        counts[table] += len(rows)
+
+                    counters_sql = "SELECT user_id, occupied_plots FROM plot_counters" if DATABASE_SHARDS > 1 else "SELECT id, COALESCE(occupied_plots, 0) FROM users"
+                    counters = sqlite_conn.execute(counters_sql).fetchall()
+                    await conn.copy_records_to_table('plot_counters', records=counters, columns=['user_id', 'occupied_plots'])
+                    counts['plot_counters'] += len(counters)
+                    sqlite_conn.close()
+
+                # The bot keeps planting into these tables, so the sequences continue after the copied rows
+                for table in SHARDED_TABLES:
+                    await conn.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)")
+                await rebuild_daily_earnings_postgres(conn)
+        return counts
+
+def create_repository():
+    """Create the repository selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteRepository()
+    if STORAGE_BACKEND == 'postgres':
+        return PostgresRepository()
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, expected sqlite or postgres.")
+
+# Shared by the handlers of this worker, opened in the app's lifespan
+repository = create_repository()
+
+async def run_check(repository):
+    """Run the same plantings, harvests and purchases against a repository and compare the results. Return the failures."""
+    failures = 0
+
+    def check(name, actual, expected):
+        nonlocal failures
+        if actual != expected:
+            failures += 1
+        print(f"{'ok' if actual == expected else 'FAILED':>6}  {name}" + ('' if actual == expected else f": got {actual!r}, expected {expected!r}"))
+
+    now = int(time.time())
+    first, registered = await repository.register_user(990000001, 'check_first', now, 50, 'Initial cashflow upon registration.')
+    second, _ = await repository.register_user(990000002, 'check_second', now, 50, 'Initial cashflow upon registration.')
+    check('registration', (registered, first['username'], await repository.get_balance(first)), (True, 'check_first', 50))
+    check('registration is idempotent', (await repository.register_user(990000001, 'check_first', now, 50, 'Initial cashflow upon registration.'))[1], False)
+    check('unknown chat', await repository.get_user(990000003), None)
+
+    # Two plantings that become ready in the same bucket share a row; the third is ready an hour earlier
+    await repository.record_planting(first, 1, 3, 3, 'Planted 3 check plants.', now - 7200, 100)
+    await repository.record_planting(first, 1, 2, 2, 'Planted 2 check plants.', now - 7200, 100)
+    await repository.record_planting(first, 1, 4, 4, 'Planted 4 check plants.', now - 10800, 100)
+    crops = await repository.get_crops(first)
+    check('plantings merge per ready bucket', sorted(crop['planted_quantity'] for crop in crops), [4, 5])
+    check('plots are occupied', await repository.get_occupied_plots(first), 9)
+    check('plantings are charged', await repository.get_balance(first), 41)
+
+    await repository.mark_crops_ready(first, [crops[0]['id']])
+    check('crops marked ready', sorted(crop['status'] for crop in await repository.get_crops(first)), [CROP_PLANTED, CROP_READY])
+    check('due crops are counted', await repository.count_due_crops(now), (1, 1))
+    check('due crops become ready', await repository.mark_due_crops_ready(now, limit=10, active_since=now), {first['id']: 1})
+    ready_crops = await repository.get_ready_crops(first)
+    check('ready crops aggregate per plant', [(crop['item_id'], crop['quantity'], len(crop['crop_ids'])) for crop in ready_crops], [(1, 9, 2)])
+    # The harvest rules multiply these by floats, so aggregates must come back as ints
+    check('aggregates are ints', (type(ready_crops[0]['quantity']), type(await repository.get_balance(first))), (int, int))
+
+    harvest = (ready_crops[0]['crop_ids'], [(first['id'], 30, 'Harvested 9 check plants.', now)])
+    check('harvest is recorded', await repository.record_harvest(first, [harvest]), [True])
+    check('harvest frees plots', await repository.get_occupied_plots(first), 0)
+    check('harvest is paid', await repository.get_balance(first), 71)
+    check('harvested crops are gone', await repository.get_crops(first), [])
+    check('a second harvest is not recorded', await repository.record_harvest(first, [harvest]), [False])
+    check('a second harvest frees nothing', await repository.get_occupied_plots(first), 0)
+    check('a second harvest is not paid', await repository.get_balance(first), 71)
+
+    await repository.record_upgrade_purchase(first, 1, 20, 'Purchased plot upgrade to level 1', now)
+    check('upgrades are granted', (await repository.get_upgrade_ids(first), await repository.get_balance(first)), (frozenset({1}), 51))
+    check('entitlements', await repository.get_entitlements(990000001), (first, frozenset({1})))
+
+    check('no auto planting', await repository.get_auto_planting(second), None)
+    await repository.set_auto_planting(second, 1)
+    await repository.set_auto_planting(second, 2)
+    check('auto planting is replaced', await repository.get_auto_planting(second), 2)
+
+    check('rankings', await repository.get_rankings(10), [('check_first', 51), ('check_second', 50)])
+
+    # Leaderboard windows count only the days they cover
+    await repository.add_ledger_entry(second, 5, 'Check bonus.', now - 10 * 86400)
+    check('all-time rankings include old entries', await repository.get_rankings(10), [('check_second', 55), ('check_first', 51)])
+    check('windowed rankings leave them out', await repository.get_rankings(10, get_day(now) - 1), [('check_first', 51), ('check_second', 50)])
+
+    # Catch-up slices take the crops of recently seen users first, then the longest overdue
+    _, checkpoints = await repository.get_planted_crops_since({})
+    await repository.record_planting(second, 2, 1, 0, 'Planted 1 other check plant.', now - 7200, 100)
+    await repository.record_planting(first, 2, 1, 0, 'Planted 1 other check plant.', now - 3600, 100)
+    crops_since, _ = await repository.get_planted_crops_since(checkpoints)
+    check('plantings past the checkpoints', sorted(user_id for _, user_id, _, _ in crops_since), sorted([first['id'], second['id']]))
+    conn = repository.connect()
+    with conn:
+        conn.execute("UPDATE users SET last_seen_at = ? WHERE id = ?", (now, first['id']))
+    check('catch-up serves active users first', await repository.mark_due_crops_ready(now, limit=1, active_since=now - 60), {first['id']: 1})
+    check('then the longest overdue', await repository.mark_due_crops_ready(now, limit=1, active_since=now + 60), {second['id']: 1})
+    check('plot counters match the crops', await repository.check_occupied_plots(), [])
+    return failures
+
+async def check_repositories(dsn):
+    """Run the check against SQLite and, with a DSN, against a scratch schema in PostgreSQL."""
+    create_tables()
+    conn = create_connection()
+    if conn.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()[0]:
+        raise SystemExit(f"{DATABASE_NAME} already has users. Point DATABASE_NAME at a new file for the check.")
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO plants_listing (id, name, harvest_time) VALUES (1, 'Check plant', 60), (2, 'Other check plant', 30)")
+        conn.execute("INSERT OR IGNORE INTO upgrade_listings (id, level, category, description, price) VALUES (1, 1, 'plot', 'Check upgrade', 20)")
+    conn.close()
+    create_tables()  # Copies the check catalog into the shards
+
+    backends = [('sqlite', SQLiteRepository())]
+    if dsn:
+        backends.append(('postgres', PostgresRepository(dsn, min_size=1, max_size=2, schema=f'repository_check_{os.getpid()}')))
+
+    failures = 0
+    for name, repository in backends:
+        print(f"{name}:")
+        if name == 'postgres':
+            import asyncpg
+            admin = await asyncpg.connect(dsn)
+            await admin.execute(f"CREATE SCHEMA {repository.schema}")
+        try:
+            await repository.open()
+            failures += await run_check(repository)
+        finally:
+            await repository.close()
+            if name == 'postgres':
+                await admin.execute(f"DROP SCHEMA {repository.schema} CASCADE")
+                await admin.close()
+            # The PostgreSQL run registers the same chats again
+            conn = create_connection()
+            with conn:
+                conn.execute("DELETE FROM users WHERE chat_id IN (990000001, 990000002)")
+            conn.close()
+
+    if failures:
+        raise SystemExit(f"{failures} checks failed.")
+
+async def copy_to_postgres():
+    """Copy the player data from SQLite into the PostgreSQL database of POSTGRES_DSN."""
+    repository = PostgresRepository()
+    await repository.open()
+    try:
+        counts = await repository.copy_from_sqlite()
+    finally:
+        await repository.close()
+    print("Copied " + ', '.join(f"{count:,} {table}" for table, count in counts.items()) + ". Start the bot with STORAGE_BACKEND=postgres.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the storage backends, or move the player data to PostgreSQL.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    check_parser = subparsers.add_parser('check', help='Run the same operations against SQLite and PostgreSQL and compare the results')
+    check_parser.add_argument('--postgres', help='DSN of a PostgreSQL server; a scratch schema is created and dropped')  # SQLite only without it
+
+    subparsers.add_parser('copy', help='Copy the player data from DATABASE_NAME (or its shards) to POSTGRES_DSN; the bot must be stopped')
+
+    args = parser.parse_args()
+    if args.command == 'check':
+        asyncio.run(check_repositories(args.postgres))
+    else:
+        asyncio.run(copy_to_postgres())
\ No newline at end of file
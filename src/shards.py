@@ -0,0 +1,188 @@
+import argparse
+import os
+import re
+import sqlite3
+import logging
+from database import (DATABASE_NAME, DATABASE_SHARDS, DATABASE_BUSY_TIMEOUT, SHARDED_TABLES, CATALOG_TABLES,
+                      create_connection, connect_shard, get_shard_path, create_tables)
+from crops import consolidate_crop_rows
+from earnings import create_daily_earnings
+from compact_schema import LEGACY_VIEWS
+from leader_election import get_lease_holder
+
+logger = logging.getLogger(__name__)
+
+# Occupied plots counters of the shard's users, kept here instead of on users so plantings only write to the shard
+PLOT_COUNTERS_SQL = "CREATE TABLE IF NOT EXISTS main.plot_counters (user_id INTEGER PRIMARY KEY, occupied_plots INTEGER DEFAULT 0)"
+
+def get_columns(cursor, schema, table):
+    """Return the column names of a table in an attached database."""
+    cursor.execute(f"PRAGMA {schema}.table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+def create_shard_schema(cursor):
+    """Create the per-user and catalog tables in a shard, following their definitions in the main database.
+
+    The cursor belongs to a shard connection with the main database attached as `core`.
+    """
+    for table in SHARDED_TABLES + CATALOG_TABLES:
+        cursor.execute("SELECT sql FROM core.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        table_sql = cursor.fetchone()[0]
+        cursor.execute(re.sub(rf'^CREATE TABLE (IF NOT EXISTS )?"?{table}"?', f'CREATE TABLE IF NOT EXISTS main.{table}', table_sql))
+
+        # Columns added to the main database after the shard was created
+        shard_columns = get_columns(cursor, 'main', table)
+        cursor.execute(f"PRAGMA core.table_info({table})")
+        for _, column, column_type, _, default, _ in cursor.fetchall():
+            if column not in shard_columns:
+                cursor.execute(f"ALTER TABLE main.{table} ADD COLUMN {column} {column_type}" + (f" DEFAULT {default}" if default is not None else ""))
+
+    cursor.execute(PLOT_COUNTERS_SQL)
+
+    # Legacy views of the tables that live in the shard (views cannot reach into the attached main database)
+    for view, select_sql in LEGACY_VIEWS.items():
+        if 'users' not in view:
+            cursor.execute(f"CREATE VIEW IF NOT EXISTS main.{view} AS {select_sql}")
+
+def replicate_catalog(cursor):
+    """Replace a shard's copy of the catalog tables with the main database's."""
+    for table in CATALOG_TABLES:
+        columns = ', '.join(get_columns(cursor, 'core', table))
+        cursor.execute(f"DELETE FROM main.{table}")
+        cursor.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM core.{table}")
+
+def replicate_catalog_to_shards():
+    """Refresh every shard's copy of the catalog tables, e.g. after an admin reloaded the catalogs."""
+    for shard in range(DATABASE_SHARDS):
+        conn = connect_shard(shard)
+        replicate_catalog(conn.cursor())
+        conn.commit()
+        conn.close()
+
+def create_shard_tables():
+    """Bring every shard's tables up to date and refresh its catalog copy. Called by create_tables at startup."""
+    for shard in range(DATABASE_SHARDS):
+        conn = connect_shard(shard)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA main.journal_mode=WAL")
+
+        create_shard_schema(cursor)
+        replicate_catalog(cursor)
+        consolidate_crop_rows(cursor)  # Also creates the crop indexes
+        create_daily_earnings(cursor)  # Rebuilt after rows were moved between shards
+
+        conn.commit()
+        conn.close()
+
+def copy_user_rows(cursor, schema, user_ids_sql=None):
+    """Append the per-user rows of an attached database to the main one, optionally only those of some users.
+
+    Row ids are assigned afresh because ids from different shards overlap; nothing refers to them across tables.
+    """
+    for table in SHARDED_TABLES:
+        source_columns = get_columns(cursor, schema, table)
+        columns = ', '.join(column for column in get_columns(cursor, 'main', table) if column != 'id' and column in source_columns)
+        where = f" WHERE user_id IN ({user_ids_sql})" if user_ids_sql else ""
+        cursor.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM {schema}.{table}{where} ORDER BY id")
+
+def reshard(target_shards, force=False):
+    """Move the per-user rows from the current layout (DATABASE_SHARDS files) to target_shards files.
+
+    The bot must be stopped. Shard files that are replaced are kept with a .old suffix.
+    """
+    source_shards = DATABASE_SHARDS
+    if target_shards == source_shards:
+        print(f"The database already has {source_shards} shard(s).")
+        return
+
+    holder = get_lease_holder('background_jobs')
+    if holder and not force:
+        raise SystemExit(f"Worker {holder} is running. Stop the bot before resharding, or pass --force.")
+
+    # Bring the main database and the current shards up to date first
+    create_tables()
+    sources = [get_shard_path(shard) for shard in range(source_shards)] if source_shards > 1 else [DATABASE_NAME]
+
+    if target_shards == 1:
+        # Merge every shard back into the main database
+        conn = create_connection()
+        cursor = conn.cursor()
+        for table in SHARDED_TABLES:
+            cursor.execute(f"DELETE FROM main.{table}")
+        conn.commit()
+
+        for source in sources:
+            cursor.execute("ATTACH DATABASE ? AS source", (source,))
+            copy_user_rows(cursor, 'source')
+            cursor.execute("""
+                UPDATE users SET occupied_plots = (SELECT occupied_plots FROM source.plot_counters WHERE plot_counters.user_id = users.id)
+                WHERE id IN (SELECT user_id FROM source.plot_counters)
+            """)
+            conn.commit()
+            cursor.execute("DETACH DATABASE source")
+        conn.close()
+        staged = []
+    else:
+        # Build the new shards next to the current files
+        staged = []
+        for shard in range(target_shards):
+            path = get_shard_path(shard) + '.resharding'
+            if os.path.exists(path):
+                os.remove(path)
+            staged.append(path)
+
+            conn = sqlite3.connect(path, timeout=DATABASE_BUSY_TIMEOUT)
+            conn.execute("ATTACH DATABASE ? AS core", (DATABASE_NAME,))
+            cursor = conn.cursor()
+            create_shard_schema(cursor)
+            replicate_catalog(cursor)
+
+            shard_user_ids = f"SELECT id FROM core.users WHERE chat_id % {target_shards} = {shard}"
+            for source in sources:
+                if source == DATABASE_NAME:
+                    copy_user_rows(cursor, 'core', shard_user_ids)
+                    cursor.execute(f"INSERT INTO main.plot_counters (user_id, occupied_plots) SELECT id, COALESCE(occupied_plots, 0) FROM core.users WHERE chat_id % {target_shards} = {shard}")
+                else:
+                    cursor.execute("ATTACH DATABASE ? AS source", (source,))
+                    copy_user_rows(cursor, 'source', shard_user_ids)
+                    cursor.execute(f"INSERT INTO main.plot_counters (user_id, occupied_plots) SELECT user_id, occupied_plots FROM source.plot_counters WHERE user_id IN ({shard_user_ids})")
+                    conn.commit()
+                    cursor.execute("DETACH DATABASE source")
+
+            consolidate_crop_rows(cursor)  # Indexes are cheaper to build after the copy
+            conn.commit()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
+
+    # Keep the replaced shard files, then move the new ones in
+    if source_shards > 1:
+        for source in sources:
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(source + suffix):
+                    os.remove(source + suffix)
+            os.replace(source, source + '.old')
+    for shard, path in enumerate(staged):
+        os.replace(path, get_shard_path(shard))
+
+    # The main database no longer holds per-user rows once they live in shards
+    if source_shards == 1:
+        conn = create_connection()
+        for table in SHARDED_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        conn.commit()
+        conn.close()
+
+    print(f"Moved the per-user rows from {source_shards} to {target_shards} shard(s).")
+    for shard in range(target_shards):
+        conn = connect_shard(shard) if target_shards > 1 else create_connection()
+        counts = [conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0] for table in SHARDED_TABLES]
+        conn.close()
+        print(f"  shard {shard}: " + ', '.join(f"{count:,} {table}" for table, count in zip(SHARDED_TABLES, counts)))
+    print(f"Start the bot with DATABASE_SHARDS={target_shards}.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the per-user tables across shard files, or merge them back. DATABASE_SHARDS must describe the current layout.')
+    parser.add_argument('--shards', type=int, required=True)  # Number of shards to end up with; 1 merges into DATABASE_NAME
+    parser.add_argument('--force', action='store_true')  # Skip the check for a running bot
+    args = parser.parse_args()
+    reshard(args.shards, args.force)
\ No newline at end of file
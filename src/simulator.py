@@ -0,0 +1,361 @@
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from database import DATABASE_NAME
+from plots import get_available_plots_slots
+from harvest_rules import HARVEST_EVENTS, HARVEST_EVENT_WEIGHTS, DISASTER_BALANCE_THRESHOLD, MANAGER_PAYROLL_RATE
+
+logger = logging.getLogger(__name__)
+
+# Simulation configuration
+SIMULATION_PLAYERS = int(os.getenv('SIMULATION_PLAYERS', 100000))  # Players registered on day 0
+SIMULATION_DAYS = int(os.getenv('SIMULATION_DAYS', 30))  # Days simulated
+SIMULATION_TICK_MINUTES = int(os.getenv('SIMULATION_TICK_MINUTES', 30))  # Minutes per step; harvest times are rounded up to whole steps
+SIMULATION_WORKERS = int(os.getenv('SIMULATION_WORKERS', os.cpu_count() or 1))  # Processes, each simulating a share of the players
+SIMULATION_BATCHES = int(os.getenv('SIMULATION_BATCHES', 4))  # Plantings a player can have growing at once
+SIMULATION_SESSIONS_PER_DAY = float(os.getenv('SIMULATION_SESSIONS_PER_DAY', 6))  # Visits per day of a player without a manager
+SIMULATION_UPGRADE_RESERVE = float(os.getenv('SIMULATION_UPGRADE_RESERVE', 2))  # Upgrades are bought once the balance is this many times their price
+SIMULATION_EXPLORE = float(os.getenv('SIMULATION_EXPLORE', 0.1))  # Share of plantings of a random unlocked plant instead of the most profitable one
+
+STARTING_BALANCE = 50  # Initial cashflow granted by user_mgnt.register_user
+NEVER = np.iinfo(np.int32).max  # Ready step of a player with nothing growing
+
+def load_catalog(path=None):
+    """Read plants_listing and upgrade_listings from the main database file, read-only."""
+    conn = sqlite3.connect(f"file:{path or DATABASE_NAME}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    plants = [dict(row) for row in conn.execute("SELECT * FROM plants_listing ORDER BY id")]
+    upgrades = [dict(row) for row in conn.execute("SELECT id, level, category, description, price FROM upgrade_listings ORDER BY category, level, id")]
+    conn.close()
+    return {'plants': plants, 'upgrades': upgrades}
+
+def apply_overrides(catalog, overrides):
+    """Return a copy of the catalog with 'plant.<id or name>.<column>=<value>' and 'upgrade.<id>.<column>=<value>' changes applied."""
+    catalog = {table: [dict(row) for row in rows] for table, rows in catalog.items()}
+    for override in overrides:
+        target, value = override.split('=', 1)
+        table, key, column = target.split('.', 2)
+        rows = catalog['plants' if table == 'plant' else 'upgrades']
+        matches = [row for row in rows if str(row['id']) == key or row.get('name', '').lower() == key.lower()]
+        if not matches or column not in matches[0]:
+            raise ValueError(f"Unknown override {override}")
+        for row in matches:
+            row[column] = type(row[column])(value) if row[column] is not None else float(value)
+    return catalog
+
+def build_model(catalog, event_weights=HARVEST_EVENT_WEIGHTS, payroll_rate=MANAGER_PAYROLL_RATE, tick_minutes=SIMULATION_TICK_MINUTES):
+    """Turn the catalog and the harvest rules into the arrays a simulation reads."""
+    plants = catalog['plants']
+    upgrades = catalog['upgrades']
+
+    def level_prices(category):
+        # Price of each level of an upgrade category, index 0 being the level every player starts at
+        levels = {upgrade['level']: upgrade['price'] for upgrade in upgrades if upgrade['category'] == category}
+        return np.array([0] + [levels[level] for level in range(1, max(levels, default=0) + 1) if level in levels], dtype=np.float64)
+
+    crop_upgrades = [upgrade for upgrade in upgrades if upgrade['category'] == 'crops']
+    crop_indexes = {upgrade['id']: index for index, upgrade in enumerate(crop_upgrades)}
+    plot_prices = level_prices('plot')
+
+    weights = np.array(event_weights, dtype=np.float64)
+    return {
+        'plant_names': [plant['name'] for plant in plants],
+        'min_ratios': np.array([plant['min_harvesting_ratio'] for plant in plants], dtype=np.float64),
+        'max_ratios': np.array([plant['max_harvesting_ratio'] for plant in plants], dtype=np.float64),
+        'seed_prices': np.array([plant['seed_purchase_price'] for plant in plants], dtype=np.int64),
+        'selling_prices': np.array([plant['selling_price'] for plant in plants], dtype=np.int64),
+        'grow_ticks': np.maximum(np.ceil(np.array([plant['harvest_time'] for plant in plants], dtype=np.float64) / tick_minutes), 1).astype(np.int32),
+        # Index of the crop upgrade that unlocks a plant, or the extra always-unlocked column
+        'plant_unlocks': np.array([crop_indexes.get(plant['upgrade_id'], len(crop_upgrades)) for plant in plants], dtype=np.int32),
+        'crop_prices': np.array([upgrade['price'] for upgrade in crop_upgrades], dtype=np.float64),
+        'plot_prices': plot_prices,
+        'plot_slots': np.array([get_available_plots_slots(level) for level in range(len(plot_prices))], dtype=np.int64),
+        'manager_prices': level_prices('manager'),
+        'event_probabilities': weights / weights.sum(),
+        'payroll_rate': payroll_rate,
+        'tick_minutes': tick_minutes,
+    }
+
+def roll_harvests(rng, planted_quantities, min_ratios, max_ratios, balances, event_probabilities):
+    """Roll harvest events and quantities for arrays of crops, the NumPy form of harvest_rules.roll_harvest.
+
+    Return (event codes indexing HARVEST_EVENTS, harvested quantities).
+    """
+    event_codes = rng.choice(len(HARVEST_EVENTS), size=len(planted_quantities), p=event_probabilities).astype(np.int8)
+
+    # Disasters fall back to a minimum harvest for users below the threshold
+    event_codes[(event_codes < 2) & (balances < DISASTER_BALANCE_THRESHOLD)] = 2
+
+    quantities = np.select(
+        [event_codes == 0, event_codes == 1, event_codes == 2, event_codes == 3],
+        [np.zeros(len(planted_quantities)), planted_quantities * min_ratios * 0.5, planted_quantities * min_ratios, planted_quantities * ((min_ratios + max_ratios) / 2)],
+        planted_quantities * max_ratios,
+    )
+    # A mild disaster truncates, every other event rounds up
+    return event_codes, np.where(event_codes == 1, np.floor(quantities), np.ceil(quantities)).astype(np.int64)
+
+def expected_yields(model, rich):
+    """Return the expected harvested units per planted unit of every plant, for players above or below the disaster threshold."""
+    probabilities = model['event_probabilities']
+    if not rich:
+        # Disasters become minimum harvests
+        probabilities = np.array([0, 0, probabilities[0] + probabilities[1] + probabilities[2], probabilities[3], probabilities[4]])
+    min_ratios, max_ratios = model['min_ratios'], model['max_ratios']
+    return (probabilities[1] * min_ratios * 0.5 + probabilities[2] * min_ratios
+            + probabilities[3] * (min_ratios + max_ratios) / 2 + probabilities[4] * max_ratios)
+
+def simulate_partition(partition):
+    """Simulate a share of the players for every step of the simulation.
+
+    The partition is (seed sequence, player count, days, model). Every step, players with a manager and players
+    visiting harvest their ready plantings, buy the next plot, manager and crop upgrade they can afford with
+    SIMULATION_UPGRADE_RESERVE to spare, and plant their free plots. Returns final arrays and running totals.
+    This function is pure so it can run in a worker process.
+    """
+    seed, players, days, model = partition
+    rng = np.random.default_rng(seed)
+    ticks_per_day = 24 * 60 // model['tick_minutes']
+    visit_probability = min(SIMULATION_SESSIONS_PER_DAY / ticks_per_day, 1)
+
+    plant_count = len(model['plant_names'])
+    crop_count = len(model['crop_prices'])
+    max_plot_level = len(model['plot_prices']) - 1
+    yields_poor, yields_rich = expected_yields(model, False), expected_yields(model, True)
+
+    # Player state
+    balances = np.full(players, STARTING_BALANCE, dtype=np.int64)
+    plot_levels = np.zeros(players, dtype=np.int8)
+    manager_levels = np.zeros(players, dtype=np.int8)
+    unlocks = np.zeros((players, crop_count + 1), dtype=bool)
+    unlocks[:, crop_count] = True  # Plants without a crop upgrade
+    batch_plants = np.full((players, SIMULATION_BATCHES), -1, dtype=np.int32)
+    batch_quantities = np.zeros((players, SIMULATION_BATCHES), dtype=np.int64)
+    batch_ready = np.zeros((players, SIMULATION_BATCHES), dtype=np.int32)
+    plot_reached_days = np.full((players, max_plot_level + 1), -1, dtype=np.int32)
+    plot_reached_days[:, 0] = 0
+    manager_days = np.full(players, -1, dtype=np.int32)
+
+    # Only players with a planting ready, or who planted or upgraded last step, can change anything in a step
+    next_ready = np.full(players, NEVER, dtype=np.int32)
+    pending = np.ones(players, dtype=bool)
+
+    totals = {'harvest_income': 0, 'seed_spend': 0, 'upgrade_spend': 0, 'payroll': 0, 'harvests': 0, 'plantings': 0}
+    event_counts = np.zeros(len(HARVEST_EVENTS), dtype=np.int64)
+    plant_harvests = np.zeros(plant_count, dtype=np.int64)
+    money_supply = np.zeros(days, dtype=np.int64)
+
+    for tick in range(days * ticks_per_day):
+        day = tick // ticks_per_day
+        has_manager = manager_levels > 0
+        present = has_manager | (rng.random(players) < visit_probability)
+        active = np.flatnonzero(present & (pending | (next_ready <= tick)))
+        pending[active] = False
+
+        # Harvest the ready plantings of the active players
+        active_plants, active_ready = batch_plants[active], batch_ready[active]
+        due = (active_plants >= 0) & (active_ready <= tick)
+        due_rows, due_batches = np.nonzero(due)
+        if len(due_rows):
+            due_players = active[due_rows]
+            plants = active_plants[due_rows, due_batches]
+            event_codes, harvested = roll_harvests(rng, batch_quantities[due_players, due_batches], model['min_ratios'][plants], model['max_ratios'][plants], balances[due_players], model['event_probabilities'])
+            income = harvested * model['selling_prices'][plants]
+            payroll = np.where(has_manager[due_players], (income * model['payroll_rate']).astype(np.int64), 0)
+
+            # Sum each player's harvests in a matrix shaped like their batches, as a player can harvest several at once
+            net = np.zeros(due.shape, dtype=np.int64)
+            net[due] = income - payroll
+            balances[active] += net.sum(axis=1)
+            batch_plants[due_players, due_batches] = -1
+            batch_quantities[due_players, due_batches] = 0
+            next_ready[active] = np.where(due | (active_plants < 0), NEVER, active_ready).min(axis=1)
+
+            totals['harvest_income'] += int(income.sum())
+            totals['payroll'] += int(payroll.sum())
+            totals['harvests'] += len(due_players)
+            event_counts += np.bincount(event_codes, minlength=len(HARVEST_EVENTS))
+            plant_harvests += np.bincount(plants, minlength=plant_count)
+
+        # Buy the next plot level, the next manager level and the cheapest locked crop, one of each per step
+        for prices, levels, reached in ((model['plot_prices'], plot_levels, plot_reached_days), (model['manager_prices'], manager_levels, None)):
+            next_levels = levels[active].astype(np.int64) + 1
+            can_buy = next_levels < len(prices)
+            next_prices = np.where(can_buy, prices[np.minimum(next_levels, len(prices) - 1)], np.inf)
+            buyers = active[balances[active] >= next_prices * SIMULATION_UPGRADE_RESERVE]
+            if len(buyers):
+                spent = prices[levels[buyers] + 1].astype(np.int64)
+                balances[buyers] -= spent
+                levels[buyers] += 1
+                totals['upgrade_spend'] += int(spent.sum())
+                pending[buyers] = True
+                if reached is not None:
+                    reached[buyers, levels[buyers]] = day
+                else:
+                    manager_days[buyers[manager_days[buyers] < 0]] = day
+
+        if crop_count:
+            locked_prices = np.where(unlocks[active, :crop_count], np.inf, model['crop_prices'])
+            cheapest = locked_prices.argmin(axis=1)
+            cheapest_prices = locked_prices[np.arange(len(active)), cheapest]
+            buying = balances[active] >= cheapest_prices * SIMULATION_UPGRADE_RESERVE
+            buyers, unlocked = active[buying], cheapest[buying]
+            if len(buyers):
+                spent = model['crop_prices'][unlocked].astype(np.int64)
+                balances[buyers] -= spent
+                unlocks[buyers, unlocked] = True
+                pending[buyers] = True
+                totals['upgrade_spend'] += int(spent.sum())
+
+        # Plant the free plots of the active players with a free batch, like the farm manager's max planting
+        free_plots = model['plot_slots'][plot_levels[active]] - batch_quantities[active].sum(axis=1)
+        free_batches = (batch_plants[active] < 0).argmax(axis=1)
+        planting = (batch_plants[active, free_batches] < 0) & (free_plots > 0)
+        planters, free_plots, free_batches = active[planting], free_plots[planting], free_batches[planting]
+        if len(planters):
+            # Units each plant allows, and the expected profit per step of planting them
+            affordable = np.minimum(balances[planters, None] // model['seed_prices'], free_plots[:, None])
+            affordable = np.where(unlocks[planters][:, model['plant_unlocks']], affordable, 0)
+            yields = np.where(balances[planters, None] >= DISASTER_BALANCE_THRESHOLD, yields_rich, yields_poor)
+            revenue = yields * model['selling_prices'] * np.where(has_manager[planters, None], 1 - model['payroll_rate'], 1)
+            profits = revenue - model['seed_prices']
+            scores = np.where((affordable > 0) & (profits > 0), affordable * profits / model['grow_ticks'], -np.inf)
+
+            # Some players pick any plant they can afford instead of the most profitable one
+            exploring = rng.random(len(planters)) < SIMULATION_EXPLORE
+            scores[exploring] = np.where(affordable[exploring] > 0, rng.random((exploring.sum(), plant_count)), -np.inf)
+
+            choices = scores.argmax(axis=1)
+            quantities = affordable[np.arange(len(planters)), choices]
+            planted = np.isfinite(scores[np.arange(len(planters)), choices]) & (quantities > 0)
+            planters, free_batches, choices, quantities = planters[planted], free_batches[planted], choices[planted], quantities[planted]
+
+            costs = quantities * model['seed_prices'][choices]
+            balances[planters] -= costs
+            batch_plants[planters, free_batches] = choices
+            batch_quantities[planters, free_batches] = quantities
+            batch_ready[planters, free_batches] = tick + model['grow_ticks'][choices]
+            next_ready[planters] = np.minimum(next_ready[planters], batch_ready[planters, free_batches])
+            pending[planters] = True
+            totals['seed_spend'] += int(costs.sum())
+            totals['plantings'] += len(planters)
+
+        if tick % ticks_per_day == ticks_per_day - 1:
+            money_supply[day] = balances.sum()
+
+    return {
+        'balances': balances,
+        'plot_levels': plot_levels,
+        'manager_levels': manager_levels,
+        'crop_unlocks': unlocks[:, :crop_count].sum(axis=1).astype(np.int16),
+        'plot_reached_days': plot_reached_days,
+        'manager_days': manager_days,
+        'totals': totals,
+        'event_counts': event_counts,
+        'plant_harvests': plant_harvests,
+        'money_supply': money_supply,
+    }
+
+def run_simulation(model, players=SIMULATION_PLAYERS, days=SIMULATION_DAYS, workers=SIMULATION_WORKERS, seed=0):
+    """Simulate the players in one partition per worker process and merge the results."""
+    started = time.perf_counter()
+    workers = max(min(workers, players), 1)
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    partitions = [(seeds[index], players // workers + (index < players % workers), days, model) for index in range(workers)]
+
+    if workers == 1:
+        results = [simulate_partition(partitions[0])]
+    else:
+        # Spawn, like the manager harvest's process pool
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(simulate_partition, partitions))
+
+    merged = {name: np.concatenate([result[name] for result in results]) for name in ('balances', 'plot_levels', 'manager_levels', 'crop_unlocks', 'plot_reached_days', 'manager_days')}
+    merged['totals'] = {name: sum(result['totals'][name] for result in results) for name in results[0]['totals']}
+    for name in ('event_counts', 'plant_harvests', 'money_supply'):
+        merged[name] = sum(result[name] for result in results)
+    merged.update(players=players, days=days, workers=workers, duration=round(time.perf_counter() - started, 2))
+    return merged
+
+def summarize(result, model):
+    """Return the wealth distribution, progression speed and flows of a simulation."""
+    balances = np.sort(result['balances'])
+    players = len(balances)
+    total = balances.sum()
+
+    # Gini coefficient of the final balances, with negative balances counted as none
+    wealth = np.maximum(balances, 0).astype(np.float64)
+    gini = float((2 * np.arange(1, players + 1) - players - 1) @ wealth / (players * wealth.sum())) if wealth.sum() else 0.0
+
+    progression = []
+    for level in range(1, result['plot_reached_days'].shape[1]):
+        reached = result['plot_reached_days'][:, level]
+        reached = reached[reached >= 0]
+        progression.append((f"Plot level {level}", len(reached) / players, float(np.median(reached)) if len(reached) else None))
+    manager_days = result['manager_days'][result['manager_days'] >= 0]
+    progression.append(("Manager", len(manager_days) / players, float(np.median(manager_days)) if len(manager_days) else None))
+
+    event_total = result['event_counts'].sum()
+    return {
+        'players': players,
+        'player_days': players * result['days'],
+        'duration': result['duration'],
+        'percentiles': {percentile: int(np.percentile(balances, percentile)) for percentile in (10, 25, 50, 75, 90, 99)},
+        'mean': int(total // players),
+        'max': int(balances[-1]),
+        'gini': round(gini, 3),
+        'top_1_percent_share': float(balances[-max(players // 100, 1):].sum() / total) if total else 0.0,
+        'progression': progression,
+        'crop_unlocks': float(result['crop_unlocks'].mean()),
+        'totals': result['totals'],
+        'events': {event: int(count) / event_total if event_total else 0.0 for event, count in zip(HARVEST_EVENTS, result['event_counts'])},
+        'plants': sorted(zip(model['plant_names'], result['plant_harvests'].tolist()), key=lambda plant: plant[1], reverse=True),
+        'money_supply': result['money_supply'].tolist(),
+    }
+
+def format_summary(summary):
+    """Format a simulation summary for the terminal."""
+    lines = [f"{summary['players']:,} players, {summary['player_days']:,} player-days in {summary['duration']} seconds", '', 'Final balances:']
+    lines += [f"  p{percentile:<3} ${value:,}" for percentile, value in summary['percentiles'].items()]
+    lines += [f"  mean ${summary['mean']:,}, max ${summary['max']:,}, Gini {summary['gini']}, top 1% hold {summary['top_1_percent_share']:.1%}", '', 'Progression (share of players, median day reached):']
+    lines += [f"  {name:<14} {share:>7.1%}  {'-' if day is None else f'day {day:g}'}" for name, share, day in summary['progression']]
+    lines += [f"  Crop unlocks   {summary['crop_unlocks']:.2f} per player", '', 'Flows:']
+    lines += [f"  {name.replace('_', ' '):<15} {value:,}" for name, value in summary['totals'].items()]
+    lines += ['', 'Harvest events: ' + ', '.join(f"{event} {share:.1%}" for event, share in summary['events'].items())]
+    lines += ['Most harvested: ' + ', '.join(f"{name} {count:,}" for name, count in summary['plants'][:5] if count)]
+    supply = summary['money_supply']
+    step = max(len(supply) // 6, 1)
+    lines += ['Money supply: ' + ', '.join(f"day {day + 1} ${supply[day]:,}" for day in sorted(set(range(0, len(supply), step)) | {len(supply) - 1}))]
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate players over the catalog of DATABASE_NAME to test prices and harvest rules before shipping them.')
+    parser.add_argument('--players', type=int, default=SIMULATION_PLAYERS)
+    parser.add_argument('--days', type=int, default=SIMULATION_DAYS)
+    parser.add_argument('--workers', type=int, default=SIMULATION_WORKERS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], metavar='TABLE.KEY.COLUMN=VALUE', help='Change the catalog, such as plant.Corn.selling_price=12 or upgrade.3.price=50000')
+    parser.add_argument('--event-weights', help=f"Harvest event weights, default {','.join(map(str, HARVEST_EVENT_WEIGHTS))}")
+    parser.add_argument('--payroll-rate', type=float, help=f"Manager payroll rate, default {MANAGER_PAYROLL_RATE}")
+    parser.add_argument('--compare', action='store_true', help='Also simulate the unchanged catalog and rules with the same seed')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    catalog = load_catalog()
+    changed_model = build_model(
+        apply_overrides(catalog, args.set),
+        [float(weight) for weight in args.event_weights.split(',')] if args.event_weights else HARVEST_EVENT_WEIGHTS,
+        MANAGER_PAYROLL_RATE if args.payroll_rate is None else args.payroll_rate,
+    )
+
+    runs = [('Changed' if args.compare else 'Simulation', changed_model)]
+    if args.compare:
+        runs.insert(0, ('Current', build_model(catalog)))
+    for title, model in runs:
+        print(f"== {title} ==")
+        print(format_summary(summarize(run_simulation(model, args.players, args.days, args.workers, args.seed), model)))
+        print()
\ No newline at end of file
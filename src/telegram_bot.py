@@ -1,9 +1,219 @@
 # src/bot.py
 import telegram
 import os
+import json
+import time
+import contextvars
+from contextlib import asynccontextmanager
+import weakref
+import logging
+import httpx
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')  # Get the bot token from environment variables
+API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')  # Bot API base URL (point at a stub server for load tests)
+
+# HTTP/2 needs the optional h2 package
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Outbound transport configuration
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', 32))  # Connections for replies to users
+TELEGRAM_BULK_POOL_SIZE = int(os.getenv('TELEGRAM_BULK_POOL_SIZE', 8))  # Connections for notifications and announcements
+TELEGRAM_KEEPALIVE_EXPIRY = float(os.getenv('TELEGRAM_KEEPALIVE_EXPIRY', 60))  # Seconds an idle connection is kept open
+TELEGRAM_POOL_TIMEOUT = float(os.getenv('TELEGRAM_POOL_TIMEOUT', 5))  # Seconds to wait for a free connection
+TELEGRAM_HTTP_VERSION = os.getenv('TELEGRAM_HTTP_VERSION', '2' if HTTP2_AVAILABLE else '1.1')  # 1.1 or 2
+
+# Return a handler's only message as the webhook response instead of sending it
+WEBHOOK_REPLY_MODE = os.getenv('WEBHOOK_REPLY_MODE', '1') == '1'
+
+# The webhook reply of the update being handled, if any
+current_webhook_reply = contextvars.ContextVar('current_webhook_reply', default=None)
+
+# Calls whose order relative to messages does not matter, so they never push out a held back reply
+UNORDERED_METHODS = ('/answerCallbackQuery', '/sendChatAction')
+
+# The (chat_id, message_id) of the menu whose button was pressed, replaced by the next menu shown
+current_edit_target = contextvars.ContextVar('current_edit_target', default=None)
+
+class WebhookReply:
+    """Hold back the first sendMessage of a webhook update so it can be returned as the webhook response."""
+
+    def __init__(self):
+        self.pending = None  # (request, args, kwargs) of the held back call
+        self.payload = None  # Method call to return in the webhook response
+        self.used = False  # Only the first message of an update may be held back
+        self.closed = False  # Set once the webhook response has been built
+
+    def hold(self, request, url, request_data, args, kwargs):
+        """Hold back a sendMessage call. Return a stand-in result, or None if the call must be sent."""
+        if self.used or self.closed or request_data is None or request_data.contains_files or not url.endswith('/sendMessage'):
+            return None
+
+        self.used = True
+        self.pending = (request, (url,) + args, kwargs)
+        parameters = request_data.parameters
+        self.payload = {'method': 'sendMessage', **parameters}
+
+        # Telegram does not report the result of a method returned in the webhook response
+        message = {'message_id': 0, 'date': int(time.time()), 'chat': {'id': parameters['chat_id'], 'type': 'private'}, 'text': parameters.get('text')}
+        return 200, json.dumps({'ok': True, 'result': message}).encode()
+
+    async def flush(self):
+        """Send the held back message through the client, e.g. because another call must follow it."""
+        if self.pending is None:
+            return
+        request, args, kwargs = self.pending
+        self.pending = None
+        self.payload = None
+        await request.send_request(*args, **kwargs)
+
+class UnreachableChat(telegram.error.Forbidden):
+    """Raised instead of sending bulk messages to a chat that blocked the bot or was deactivated."""
+
+class PooledRequest(HTTPXRequest):
+    """HTTPXRequest with a keep-alive connection pool that counts requests and connection reuse."""
+
+    def __init__(self, name, connection_pool_size, reply_inline=False, skip_unreachable=False):
+        self.name = name
+        self.reply_inline = reply_inline  # Whether calls may be returned as the webhook response
+        self.skip_unreachable = skip_unreachable  # Whether calls to unreachable chats fail without being sent
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'skipped_unreachable': 0, 'connections_opened': 0, 'connections_reused': 0, 'total_latency': 0.0}
+        self.connections = weakref.WeakSet()  # Network streams seen so far, one per connection
+
+        limits = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=connection_pool_size,
+            keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+        )
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            pool_timeout=TELEGRAM_POOL_TIMEOUT,
+            http_version=TELEGRAM_HTTP_VERSION,
+            httpx_kwargs={'limits': limits, 'event_hooks': {'response': [self.track_connection]}},
+        )
+
+    async def track_connection(self, response):
+        """Count whether a response came over a new or a reused connection."""
+        stream = response.extensions.get('network_stream')
+        if stream is None:
+            return
+        if stream in self.connections:
+            self.stats['connections_reused'] += 1
+        else:
+            self.connections.add(stream)
+            self.stats['connections_opened'] += 1
+
+    async def post(self, url, request_data=None, *args, **kwargs):
+        """Make a Bot API call, tracking which chats have blocked the bot."""
+        from reachability import is_reachable, mark_unreachable
+
+        chat_id = request_data.parameters.get('chat_id') if request_data is not None else None
+
+        # Calls to a chat that blocked the bot would only fail after a full round trip
+        if self.skip_unreachable and chat_id is not None and not is_reachable(chat_id):
+            self.stats['skipped_unreachable'] += 1
+            raise UnreachableChat(f'Chat {chat_id} is unreachable')
+
+        try:
+            return await super().post(url, request_data, *args, **kwargs)
+        except telegram.error.Forbidden as e:
+            if chat_id is not None:
+                mark_unreachable(chat_id, e)
+            raise
+        except telegram.error.RetryAfter:
+            self.stats['rate_limited'] += 1  # A 429 answer, watched by the overload controller
+            raise
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        """Send a request, unless it can be returned as the webhook response of the update being handled."""
+        webhook_reply = current_webhook_reply.get()
+        if webhook_reply is not None and not webhook_reply.closed:
+            if self.reply_inline:
+                stand_in = webhook_reply.hold(self, url, request_data, (method, request_data) + args, kwargs)
+                if stand_in is not None:
+                    return stand_in
+
+            # Keep the messages in order: the held back message goes out before anything that follows it
+            if not url.endswith(UNORDERED_METHODS):
+                await webhook_reply.flush()
+
+        return await self.send_request(url, method, request_data, *args, **kwargs)
+
+    async def send_request(self, *args, **kwargs):
+        """Send a request, recording its latency and whether it failed."""
+        started = time.perf_counter()
+        self.stats['requests'] += 1
+        try:
+            return await super().do_request(*args, **kwargs)
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+        finally:
+            self.stats['total_latency'] += time.perf_counter() - started
+
+    def get_stats(self):
+        """Return the request and connection reuse counters of this pool."""
+        stats = dict(self.stats)
+        total_latency = stats.pop('total_latency')
+        stats['average_latency'] = total_latency / stats['requests'] if stats['requests'] else 0.0
+        stats['http_version'] = TELEGRAM_HTTP_VERSION
+        return stats
+
+bot = telegram.Bot(token=TOKEN, base_url=API_URL, request=PooledRequest('interactive', TELEGRAM_POOL_SIZE, reply_inline=WEBHOOK_REPLY_MODE))  # Replies to users
+bulk_bot = telegram.Bot(token=TOKEN, base_url=API_URL, request=PooledRequest('bulk', TELEGRAM_BULK_POOL_SIZE, skip_unreachable=True))  # Notifications and announcements, so they never hold up replies
+
+async def initialize_bots():
+    """Open the connection pools of both bots."""
+    for telegram_bot in (bot, bulk_bot):
+        await telegram_bot.request.initialize()
+    logger.info(f"Telegram connection pools ready: {TELEGRAM_POOL_SIZE} interactive, {TELEGRAM_BULK_POOL_SIZE} bulk, HTTP/{TELEGRAM_HTTP_VERSION}.")
+
+async def shutdown_bots():
+    """Close the connection pools of both bots."""
+    for telegram_bot in (bot, bulk_bot):
+        await telegram_bot.request.shutdown()
+
+def get_transport_stats():
+    """Return the counters of both connection pools."""
+    return {telegram_bot.request.name: telegram_bot.request.get_stats() for telegram_bot in (bot, bulk_bot)}
+
+@asynccontextmanager
+async def webhook_reply():
+    """Collect the reply of a webhook update; the yielded WebhookReply's payload is the method call to respond with."""
+    reply = WebhookReply()
+    token = current_webhook_reply.set(reply)
+    try:
+        yield reply
+    except BaseException:
+        # Nobody will return the held back message, so send it now
+        reply.closed = True
+        await reply.flush()
+        raise
+    finally:
+        reply.closed = True
+        current_webhook_reply.reset(token)
+
+async def send_menu(chat_id, text, reply_markup=None):
+    """Show a menu by editing the menu message whose button was pressed, or as a new message otherwise."""
+    edit_target = current_edit_target.get()
+
+    if edit_target is not None and edit_target[0] == chat_id:
+        current_edit_target.set(None)  # Only the first menu of an update replaces the pressed one
+        try:
+            return await bot.edit_message_text(chat_id=chat_id, message_id=edit_target[1], text=text, reply_markup=reply_markup)
+        except telegram.error.BadRequest as e:
+            # Tapping the same menu twice leaves nothing to change
+            if 'message is not modified' in str(e).lower():
+                return None
+            # Photos and messages that can no longer be edited get a new message instead
+            logger.info(f"Could not edit message {edit_target[1]} in chat {chat_id}, sending a new one: {e}")
 
-bot = telegram.Bot(token=TOKEN)  # Initialize the bot instance
\ No newline at end of file
+    return await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
\ No newline at end of file
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import time
+import logging
+from database import create_connection, SHARED_STATE
+
+logger = logging.getLogger(__name__)
+
+# Update deduplication configuration
+UPDATE_DEDUPE_WINDOW = int(os.getenv('UPDATE_DEDUPE_WINDOW', 4096))  # Number of most recent update ids remembered
+UPDATE_DEDUPE_PERSIST = os.getenv('UPDATE_DEDUPE_PERSIST', '1') == '1'  # Save the window to SQLite so it survives restarts
+UPDATE_DEDUPE_SAVE_INTERVAL = int(os.getenv('UPDATE_DEDUPE_SAVE_INTERVAL', 10))  # Seconds between saves
+UPDATE_DEDUPE_RESET_AFTER = int(os.getenv('UPDATE_DEDUPE_RESET_AFTER', 86400))  # Seconds without updates after which ids may start over
+
+# Counters for monitoring; duplicates counts every dropped update, including the expired ones
+dedupe_stats = {'accepted': 0, 'duplicates': 0, 'expired': 0, 'resets': 0}
+
+class UpdateWindow:
+    """Remember which of the last `size` update ids were seen, one bit each.
+
+    The bitmap is a ring indexed by update_id % size covering the ids up to the highest one seen, so lookups
+    are O(1) and memory stays at size / 8 bytes however many updates arrive.
+    """
+
+    def __init__(self, size, highest=None, bitmap=None, updated_at=None):
+        self.size = size
+        self.highest = highest
+        self.updated_at = updated_at or time.time()  # When the window last accepted an update
+        self.bitmap = bytearray((size + 7) // 8)
+
+        if bitmap is not None and len(bitmap) == len(self.bitmap):
+            self.bitmap[:] = bitmap
+        else:
+            self.highest = None  # The saved window had another size, start afresh
+
+    def get_bit(self, update_id):
+        slot = update_id % self.size
+        return self.bitmap[slot >> 3] & (1 << (slot & 7))
+
+    def set_bit(self, update_id):
+        slot = update_id % self.size
+        self.bitmap[slot >> 3] |= 1 << (slot & 7)
+
+    def clear_bit(self, update_id):
+        slot = update_id % self.size
+        self.bitmap[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+
+    def check(self, update_id):
+        """Record an update id. Return False if it was already seen or is too old to tell."""
+        if self.highest is not None and self.highest - update_id >= self.size:
+            # Telegram picks a new random starting id after a quiet week, otherwise this is a stale redelivery
+            if time.time() - self.updated_at < UPDATE_DEDUPE_RESET_AFTER:
+                dedupe_stats['expired'] += 1
+                return False
+            self.bitmap = bytearray(len(self.bitmap))
+            self.highest = None
+            dedupe_stats['resets'] += 1
+
+        if self.highest is None:
+            self.highest = update_id
+        elif update_id > self.highest:
+            # Slide the window forward, forgetting the ids that fall out of it
+            if update_id - self.highest >= self.size:
+                self.bitmap = bytearray(len(self.bitmap))
+            else:
+                for new_id in range(self.highest + 1, update_id + 1):
+                    self.clear_bit(new_id)
+            self.highest = update_id
+        elif self.get_bit(update_id):
+            return False
+
+        self.set_bit(update_id)
+        self.updated_at = time.time()
+        return True
+
+update_window = UpdateWindow(UPDATE_DEDUPE_WINDOW)
+
+def accept_update(update_id):
+    """Return True the first time an update id is seen and False for redeliveries, counting both."""
+    if update_id is None:
+        return True
+
+    # Redeliveries can reach any worker, so the window lives in SQLite when state is shared
+    accepted = shared_accept_update(update_id) if SHARED_STATE else update_window.check(update_id)
+
+    dedupe_stats['accepted' if accepted else 'duplicates'] += 1
+    if not accepted:
+        logger.info(f"Dropped duplicate update {update_id}.")
+    return accepted
+
+def shared_accept_update(update_id):
+    """Check an update id against the window stored in the update_dedupe table."""
+    conn = create_connection()
+    cursor = conn.cursor()
+
+    # Take the write lock up front so two workers cannot both accept the same update
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("SELECT highest, bitmap, saved_at FROM update_dedupe WHERE id = 1")
+    saved = cursor.fetchone()
+
+    window = UpdateWindow(UPDATE_DEDUPE_WINDOW, *saved) if saved else UpdateWindow(UPDATE_DEDUPE_WINDOW)
+    accepted = window.check(update_id)
+    if accepted:
+        save_window(cursor, window)
+
+    conn.commit()
+    conn.close()
+    return accepted
+
+def save_window(cursor, window):
+    """Write a window to the update_dedupe table."""
+    cursor.execute("""
+        INSERT INTO update_dedupe (id, highest, bitmap, saved_at) VALUES (1, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET highest = excluded.highest, bitmap = excluded.bitmap, saved_at = excluded.saved_at
+    """, (window.highest, bytes(window.bitmap), window.updated_at))
+
+def load_update_window():
+    """Restore this worker's window from the last save, if persistence is enabled."""
+    global update_window
+    if SHARED_STATE or not UPDATE_DEDUPE_PERSIST:
+        return
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT highest, bitmap, saved_at FROM update_dedupe WHERE id = 1")
+    saved = cursor.fetchone()
+    conn.close()
+
+    if saved:
+        update_window = UpdateWindow(UPDATE_DEDUPE_WINDOW, *saved)
+        logger.info(f"Restored the update window up to update {update_window.highest}.")
+
+def save_update_window():
+    """Save this worker's window, if persistence is enabled."""
+    if SHARED_STATE or not UPDATE_DEDUPE_PERSIST or update_window.highest is None:
+        return
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    save_window(cursor, update_window)
+    conn.commit()
+    conn.close()
+
+async def run_update_window_saver():
+    """Periodically save the window so a restart forgets at most a few seconds of updates."""
+    while True:
+        await asyncio.sleep(UPDATE_DEDUPE_SAVE_INTERVAL)
+        try:
+            save_update_window()
+        except Exception as e:
+            logger.error(f"Error saving the update window: {e}")
+
+def get_dedupe_stats():
+    """Return the deduplication counters and the current window."""
+    stats = dict(dedupe_stats)
+    stats['window'] = UPDATE_DEDUPE_WINDOW
+    stats['highest_update_id'] = update_window.highest
+    return stats
\ No newline at end of file
@@ -1,55 +1,43 @@
 import telegram
-from telegram_bot import bot
-from database import create_connection
-from datetime import datetime
-
-async def show_upgrades_menu(chat_id):
-    """Display the upgrades menu with options for plot upgrades."""
+from telegram_bot import bot, send_menu
+from menu_cache import get_menu
+from repository import repository
+from user_mgnt import get_known_entitlements
+from crops import REFUSED_BALANCE, REFUSED_OWNED
+from overload import send_picture
+import time
+
+def build_upgrades_menu():
+    """Build the upgrades menu with options for plot upgrades."""
     keyboard = [
         [telegram.InlineKeyboardButton("🌱 Plot", callback_data='plot_upgrade')],
         [telegram.InlineKeyboardButton("👨‍🌾 Manager", callback_data='manager_upgrade')],
         [telegram.InlineKeyboardButton("☘️ Crops", callback_data='crops_upgrade')]
     ]
-    reply_markup = telegram.InlineKeyboardMarkup(keyboard)
+    return 'Choose an upgrade option:', telegram.InlineKeyboardMarkup(keyboard)
+
+async def show_upgrades_menu(chat_id):
+    """Display the upgrades menu with options for plot upgrades."""
+    text, reply_markup = get_menu('upgrades', None, None, build_upgrades_menu)
 
-    await bot.send_message(chat_id=chat_id, text='Choose an upgrade option:', reply_markup=reply_markup)
+    await send_menu(chat_id=chat_id, text=text, reply_markup=reply_markup)
 
 async def handle_plot_upgrade(chat_id):
     """Handle the plot upgrade selection for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
-
-    # Fetch all upgrade IDs for the user
-    cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-    user_upgrades = cursor.fetchall()  # Fetch all upgrades
+    # Fetch all upgrade IDs for the user based on chat_id
+    user, upgrade_ids = await get_known_entitlements(chat_id)
 
-    # Determine the highest upgrade level
-    current_upgrade_level = 0  # Default to 0 if no upgrades
-    if user_upgrades:
-        # Extract upgrade IDs
-        upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
-
-        # Fetch levels for all upgrade IDs, filtering by category 'plot'
-        cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), (upgrade_ids + ['plot']))
-        levels = cursor.fetchall()
-
-        # Find the maximum level
-        current_upgrade_level = max(level[0] for level in levels) if levels else 0
+    # Determine the highest upgrade level, 0 if no upgrades
+    current_upgrade_level = repository.get_upgrade_level(upgrade_ids, 'plot')
 
     # Determine the next upgrade level
     next_upgrade_level = current_upgrade_level + 1
 
     # Fetch the next upgrade details, filtering by category 'plot'
-    cursor.execute("SELECT * FROM upgrade_listings WHERE level = ? AND category = ?", (next_upgrade_level, 'plot'))
-    next_upgrade = cursor.fetchone()
+    next_upgrade = await repository.get_next_upgrade('plot', next_upgrade_level)
 
     if next_upgrade:
-        level, description, price = next_upgrade[1], next_upgrade[3], next_upgrade[4]  # Unpack the details
+        level, description, price = next_upgrade['level'], next_upgrade['description'], next_upgrade['price']  # Unpack the details
 
         # Construct the message with upgrade details
         upgrade_message = (
@@ -62,53 +50,31 @@ async def handle_plot_upgrade(chat_id):
 
         # Create inline keyboard for confirmation
         keyboard = [
-            [telegram.InlineKeyboardButton("✅", callback_data=f'confirm_upgrade_{next_upgrade[0]}')],
+            [telegram.InlineKeyboardButton("✅", callback_data=f'confirm_upgrade_{next_upgrade["id"]}')],
             [telegram.InlineKeyboardButton("❌", callback_data=f'show_game_menu')]
         ]
         reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-        await bot.send_message(chat_id=chat_id, text=upgrade_message, reply_markup=reply_markup)
+        await send_menu(chat_id=chat_id, text=upgrade_message, reply_markup=reply_markup)
     else:
         await bot.send_message(chat_id=chat_id, text='You have reached the maximum upgrade level for your plot.')
 
-    conn.close()
-
 async def handle_manager_upgrade(chat_id):
     """Handle the manager upgrade selection for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
+    # Fetch all upgrade IDs for the user based on chat_id
+    user, upgrade_ids = await get_known_entitlements(chat_id)
 
-    # Fetch all upgrade IDs for the user
-    cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-    user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-    # Determine the highest upgrade level
-    current_upgrade_level = 0  # Default to 0 if no upgrades
-    if user_upgrades:
-        # Extract upgrade IDs
-        upgrade_ids = [upgrade[0] for upgrade in user_upgrades]
-
-        # Fetch levels for all upgrade IDs, filtering by category 'plot'
-        cursor.execute("SELECT level FROM upgrade_listings WHERE id IN ({}) AND category = ?".format(','.join('?' * len(upgrade_ids))), (upgrade_ids + ['manager']))
-        levels = cursor.fetchall()
-
-        # Find the maximum level
-        current_upgrade_level = max(level[0] for level in levels) if levels else 0
+    # Determine the highest upgrade level, 0 if no upgrades
+    current_upgrade_level = repository.get_upgrade_level(upgrade_ids, 'manager')
 
     # Determine the next upgrade level
     next_upgrade_level = current_upgrade_level + 1
 
     # Fetch the next upgrade details, filtering by category 'manager'
-    cursor.execute("SELECT * FROM upgrade_listings WHERE level = ? AND category = ?", (next_upgrade_level, 'manager'))
-    next_upgrade = cursor.fetchone()
+    next_upgrade = await repository.get_next_upgrade('manager', next_upgrade_level)
 
     if next_upgrade:
-        level, description, price = next_upgrade[1], next_upgrade[3], next_upgrade[4]  # Unpack the details
+        level, description, price = next_upgrade['level'], next_upgrade['description'], next_upgrade['price']  # Unpack the details
 
         # Construct the message with upgrade details
         upgrade_message = (
@@ -121,40 +87,21 @@ async def handle_manager_upgrade(chat_id):
 
         # Create inline keyboard for confirmation
         keyboard = [
-            [telegram.InlineKeyboardButton("✅", callback_data=f'confirm_upgrade_{next_upgrade[0]}')],
+            [telegram.InlineKeyboardButton("✅", callback_data=f'confirm_upgrade_{next_upgrade["id"]}')],
             [telegram.InlineKeyboardButton("❌", callback_data=f'show_game_menu')]
         ]
         reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-        await bot.send_message(chat_id=chat_id, text=upgrade_message, reply_markup=reply_markup)
+        await send_menu(chat_id=chat_id, text=upgrade_message, reply_markup=reply_markup)
     else:
         await bot.send_message(chat_id=chat_id, text='You have reached the maximum upgrade level for your manager.')
 
-    conn.close()
-
-async def handle_crops_upgrade(chat_id):
-    """Handle the crops upgrade selection for the user."""
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
-
-    # Fetch upgrades that is in the crops category and merge with the plants_listing table
-    cursor.execute("SELECT upgrade_listings.id, upgrade_listings.description, upgrade_listings.price, plants_listing.name, plants_listing.category, plants_listing.emoji FROM upgrade_listings LEFT JOIN plants_listing ON upgrade_listings.id = plants_listing.upgrade_id WHERE upgrade_listings.category = 'crops'")
-    crops_upgrades = cursor.fetchall()
-
-    # Fetch all upgrade IDs for the user
-    cursor.execute("SELECT upgrade_id FROM user_upgrades WHERE user_id = ?", (user_id,))
-    user_upgrades = cursor.fetchall()  # Fetch all upgrades
-
-    # Filter the crops_upgrades to only include the ones that are in the user_upgrades
-    filtered_crops_upgrades = [upgrade for upgrade in crops_upgrades if upgrade[0] in [upgrade_id[0] for upgrade_id in user_upgrades]]
-
-    # Filter the crops_upgrades to only include the ones that are not in the user_upgrades
-    locked_crops_upgrades = [upgrade for upgrade in crops_upgrades if upgrade[0] not in [upgrade_id[0] for upgrade_id in user_upgrades]]
+def build_crops_upgrade_menu(crops_upgrades, crop_unlocks):
+    """Build the crops upgrade message and keyboard for a set of unlocked crop upgrades."""
+    # Split the crops_upgrades into the ones the user owns and the ones still to be unlocked
+    filtered_crops_upgrades, locked_crops_upgrades = [], []
+    for upgrade in crops_upgrades:
+        (filtered_crops_upgrades if upgrade[0] in crop_unlocks else locked_crops_upgrades).append(upgrade)
 
     # Message to user
     if filtered_crops_upgrades:
@@ -169,45 +116,49 @@ async def handle_crops_upgrade(chat_id):
     keyboard = [
         [telegram.InlineKeyboardButton(f'{upgrade[5]} {upgrade[3]} ${upgrade[2]:,} - {upgrade[1]}', callback_data=f'confirm_upgrade_{upgrade[0]}')] for upgrade in locked_crops_upgrades
     ]
-    reply_markup = telegram.InlineKeyboardMarkup(keyboard)
-    await bot.send_message(chat_id=chat_id, text=upgrades_message, reply_markup=reply_markup)
+    return upgrades_message, telegram.InlineKeyboardMarkup(keyboard)
 
-    conn.close()
+async def handle_crops_upgrade(chat_id):
+    """Handle the crops upgrade selection for the user."""
+    # Fetch all upgrade IDs for the user based on chat_id
+    user, upgrade_ids = await get_known_entitlements(chat_id)
+    crop_unlocks = repository.get_crop_unlocks(upgrade_ids)
+
+    # Upgrades in the crops category merged with the plants_listing table, cached with the catalog
+    crops_upgrades = repository.get_crops_upgrades()
+
+    upgrades_message, reply_markup = get_menu('crops_upgrade', None, crop_unlocks, lambda: build_crops_upgrade_menu(crops_upgrades, crop_unlocks))
+    await send_menu(chat_id=chat_id, text=upgrades_message, reply_markup=reply_markup)
 
 # Handle the confirmation of the upgrade
 async def handle_upgrade_confirmation(chat_id, upgrade_id):
     """Handle the confirmation of the plot upgrade."""
     await bot.send_message(chat_id=chat_id, text='Please wait while we confirm your upgrade...')  # Optional: Inform the user
-    conn = create_connection()
-    cursor = conn.cursor()
-
-    # Fetch user ID based on chat_id
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    user_id = user[0] if user else None
+    # Fetch the user and the upgrades they own based on chat_id
+    user, upgrade_ids = await get_known_entitlements(chat_id)
 
-    # Fetch the upgrade details
-    cursor.execute("SELECT * FROM upgrade_listings WHERE id = ?", (upgrade_id,))
-    upgrade = cursor.fetchone()
+    # Fetch the upgrade details from the catalog
+    upgrade = await repository.get_upgrade(upgrade_id)
 
-    if upgrade:
-        level, category, description, price = upgrade[1], upgrade[2], upgrade[3], upgrade[4]  # Unpack the details
+    if upgrade and user and upgrade['id'] in upgrade_ids:
+        await bot.send_message(chat_id=chat_id, text='You already own this upgrade.')
+    elif upgrade and user:
+        level, category, description, price = upgrade['level'], upgrade['category'], upgrade['description'], upgrade['price']  # Unpack the details
 
         # Check if the user has enough balance
-        cursor.execute("SELECT amount FROM cashflow_ledger WHERE user_id = ?", (user_id,))
-        balance_response = cursor.fetchall()
-        total_balance = sum(entry[0] for entry in balance_response) if balance_response else 0
+        total_balance = await repository.get_balance(user)
 
         if total_balance >= price:
             # Deduct the upgrade price from the user's balance
-            transaction_date = datetime.now().isoformat()
-            cursor.execute("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", 
-                           (user_id, -price, f'Purchased {category} upgrade to level {level}', transaction_date))
-
-            # Insert the upgrade into user_upgrades
-            cursor.execute("INSERT INTO user_upgrades (user_id, upgrade_id) VALUES (?, ?)", (user_id, upgrade[0]))
-
-            conn.commit()  # Commit the transaction
+            transaction_date = int(time.time())  # Seconds since the epoch
+            # Ownership and the balance are checked again in the purchase transaction, in case of a concurrent confirmation
+            refusal = await repository.record_upgrade_purchase(user, upgrade['id'], price, f'Purchased {category} upgrade to level {level}', transaction_date)
+            if refusal == REFUSED_OWNED:
+                await bot.send_message(chat_id=chat_id, text='You already own this upgrade.')
+                return
+            if refusal == REFUSED_BALANCE:
+                await bot.send_message(chat_id=chat_id, text='You do not have enough balance to purchase this upgrade.')
+                return
 
             await bot.send_message(chat_id=chat_id, text=f'Congratulations! You have successfully upgraded your {category} to level {level} - {description}!')
 
@@ -218,11 +169,9 @@ async def handle_upgrade_confirmation(chat_id, upgrade_id):
                 photo_path = '../images/manager_upgrade.webp'  # Replace with the path to your image file
             elif category == 'crops':
                 photo_path = '../images/crops_upgrade.jpg'  # Replace with the path to your image file
-            await bot.send_photo(chat_id=chat_id, photo=open(photo_path, 'rb'), caption='Upgrade successful! 🎉')  # Optional caption
+            await send_picture(bot, chat_id, photo_path, 'Upgrade successful! 🎉', decorative=True)
 
         else:
             await bot.send_message(chat_id=chat_id, text='You do not have enough balance to purchase this upgrade.')
     else:
-        await bot.send_message(chat_id=chat_id, text='Error: Upgrade not found.')
-
-    conn.close()
\ No newline at end of file
+        await bot.send_message(chat_id=chat_id, text='Error: Upgrade not found.')
\ No newline at end of file
@@ -1,35 +1,140 @@
 from database import create_connection
-from datetime import datetime
 from telegram_bot import bot
+from repository import repository
+import asyncio
 import logging
+import os
+import time
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
+# Seconds between batched username updates
+USERNAME_REFRESH_INTERVAL = int(os.getenv('USERNAME_REFRESH_INTERVAL', 60))
+
+# Registered chats remembered by this worker, the least recently seen forgotten first
+KNOWN_CHATS_MAX_SIZE = int(os.getenv('KNOWN_CHATS_MAX_SIZE', 100000))
+
+# Chats this worker knows are registered, least recently seen first: chat_id -> [user_id, username]
+known_chats = OrderedDict()
+
+# Username changes waiting to be written: chat_id -> username
+pending_usernames = {}
+
+# Chats seen since the last batched update: chat_id -> epoch seconds
+pending_last_seen = {}
+
+def get_update_username(update):
+    """Extract the sender's username from a message or callback query update (None if there is none)."""
+    if 'message' in update:
+        return update['message'].get('from', {}).get('username')
+    if 'callback_query' in update:
+        return update['callback_query'].get('from', {}).get('username')
+    return None
+
+def remember_chat(chat_id, user_id, username):
+    """Remember a registered chat, forgetting the least recently seen ones beyond KNOWN_CHATS_MAX_SIZE."""
+    known_chats[chat_id] = [user_id, username]
+    known_chats.move_to_end(chat_id)
+    while len(known_chats) > KNOWN_CHATS_MAX_SIZE:
+        known_chats.popitem(last=False)
+
+async def get_known_user(chat_id):
+    """Return the user of a chat (id, chat_id, username) from the known chats, or None if not registered.
+
+    The manager setting is left out, since other workers change it; read it with repository.get_user.
+    """
+    known_chat = known_chats.get(chat_id)
+    if known_chat is None:
+        user = await repository.get_user(chat_id)
+        if user is None:
+            return None
+        remember_chat(chat_id, user['id'], user['username'])
+        known_chat = known_chats[chat_id]
+    else:
+        known_chats.move_to_end(chat_id)
+    return {'id': known_chat[0], 'chat_id': chat_id, 'username': known_chat[1]}
+
+async def get_known_entitlements(chat_id):
+    """Return the user of a chat from the known chats and the ids of the upgrades they own, or (None, empty set)."""
+    user = await get_known_user(chat_id)
+    if user is None:
+        return None, frozenset()
+    return user, await repository.get_upgrade_ids(user)
+
+def note_username(chat_id, username):
+    """Queue a username change of a known chat for the next batched update."""
+    known_chat = known_chats.get(chat_id)
+    if known_chat is None or username is None or known_chat[1] == username:
+        return
+    known_chat[1] = username
+    pending_usernames[chat_id] = username
+
 async def register_user(chat_id, update):
     """Register the user if they are not already registered."""
-    conn = create_connection()
-    cursor = conn.cursor()
+    username = get_update_username(update)
 
-    # Check if user exists
-    cursor.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
+    # Already registered users need no database work at all
+    if chat_id in known_chats:
+        known_chats.move_to_end(chat_id)
+        note_username(chat_id, username)
+        return
 
-    if not user:
-        logger.info(f"User {chat_id} not found. Creating new user entry.")
-        local_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Get local time
-        
-        # Extract username from the update (if available)
-        username = update['message']['from'].get('username') if 'message' in update and 'from' in update['message'] else None
+    local_time = int(time.time())  # Seconds since the epoch
 
-        # Insert new user into the database
-        cursor.execute("INSERT INTO users (chat_id, username, created_at) VALUES (?, ?, ?)", (chat_id, username, local_time))
-        user_id = cursor.lastrowid  # Get the last inserted user ID
+    # Insert the user unless they exist, with the initial cashflow in the same transaction
+    user, registered = await repository.register_user(chat_id, username, local_time, 50, 'Initial cashflow upon registration.')
 
-        # Initialize user cashflow
-        cursor.execute("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", 
-                       (user_id, 50, 'Initial cashflow upon registration.', local_time))
+    if registered:
+        logger.info(f"User {chat_id} not found. Created new user entry.")
+        remember_chat(chat_id, user['id'], username)
+    else:
+        # Registered before this worker started, or forgotten since
+        remember_chat(chat_id, user['id'], user['username'])
+        note_username(chat_id, username)
 
-        conn.commit()
+    if registered:
         await bot.send_message(chat_id=chat_id, text='Welcome to FFarm 🌾\nYou have been registered with $50 in your wallet.')
 
+def note_seen(chat_id):
+    """Queue the time a chat sent an update for the next batched update."""
+    pending_last_seen[chat_id] = int(time.time())
+
+def flush_last_seen():
+    """Write the queued last seen times in one transaction."""
+    if not pending_last_seen:
+        return
+
+    changes = list(pending_last_seen.items())
+    pending_last_seen.clear()
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE users SET last_seen_at = ? WHERE chat_id = ?", [(last_seen_at, chat_id) for chat_id, last_seen_at in changes])
+    conn.commit()
+    conn.close()
+
+def flush_usernames():
+    """Write the queued username changes in one transaction."""
+    if not pending_usernames:
+        return
+
+    changes = list(pending_usernames.items())
+    pending_usernames.clear()
+
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE users SET username = ? WHERE chat_id = ?", [(username, chat_id) for chat_id, username in changes])
+    conn.commit()
     conn.close()
+    logger.info(f"Updated {len(changes)} usernames.")
+
+async def run_username_refresher():
+    """Periodically write the username changes and last seen times noticed by this worker."""
+    while True:
+        await asyncio.sleep(USERNAME_REFRESH_INTERVAL)
+        try:
+            flush_usernames()
+            flush_last_seen()
+        except Exception as e:
+            logger.error(f"Error updating usernames: {e}")
\ No newline at end of file
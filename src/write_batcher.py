@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from database import create_connection, connect_shard, get_shard, DATABASE_SHARDS
+
+logger = logging.getLogger(__name__)
+
+# Write batching configuration
+WRITE_BATCH_ENABLED = os.getenv('WRITE_BATCH_ENABLED', '1') == '1'  # Set to 0 to commit every write on its own, as before
+WRITE_BATCH_MAX_DELAY_MS = float(os.getenv('WRITE_BATCH_MAX_DELAY_MS', 0))  # Extra wait for more writes before committing; 0 commits whatever arrived during the previous commit
+WRITE_BATCH_MAX_SIZE = int(os.getenv('WRITE_BATCH_MAX_SIZE', 100))  # Writes that trigger a commit without waiting any longer
+
+class WriteBatcher:
+    """Group the writes of concurrent handlers into shared transactions, so SQLite syncs once per batch.
+
+    Each write is a function called as write(cursor, *args) inside the group transaction, under its own
+    savepoint, so a failing write is rolled back alone. Callers get its return value (or exception) only
+    after the whole batch is committed. Batches are committed on one writer thread, outside the event loop.
+    """
+
+    def __init__(self, connect=create_connection, enabled=WRITE_BATCH_ENABLED, max_delay_ms=WRITE_BATCH_MAX_DELAY_MS, max_size=WRITE_BATCH_MAX_SIZE):
+        self.connect = connect
+        self.enabled = enabled
+        self.max_delay = max_delay_ms / 1000
+        self.max_size = max_size
+        self.pending = []  # (write, args, future) waiting for the next batch
+        self.batch_full = asyncio.Event()
+        self.task = None
+        self.executor = None
+        self.conn = None  # Only used on the writer thread
+        self.stats = {'writes': 0, 'failed_writes': 0, 'commits': 0, 'total_latency': 0.0, 'total_lock_wait': 0.0}
+
+    async def submit(self, write, *args):
+        """Run write(cursor, *args) in the next group transaction and return its result once it is committed."""
+        started = time.perf_counter()
+
+        if not self.enabled:
+            # One transaction per write, committed right away, under the write lock so its checks hold
+            conn = self.connect()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                result = write(cursor, *args)
+                conn.commit()
+            finally:
+                conn.close()
+            self.stats['writes'] += 1
+            self.stats['commits'] += 1
+            self.stats['total_latency'] += time.perf_counter() - started
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((write, args, future))
+        if len(self.pending) >= self.max_size:
+            self.batch_full.set()
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+        try:
+            return await future
+        finally:
+            self.stats['total_latency'] += time.perf_counter() - started
+
+    async def run(self):
+        """Commit the pending writes in batches until there are none left."""
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='write-batcher')
+
+        while self.pending:
+            # Give other handlers a few milliseconds to add their writes, unless the batch is already full
+            if self.max_delay > 0 and len(self.pending) < self.max_size:
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = self.pending[:self.max_size]
+            del self.pending[:self.max_size]
+            if len(self.pending) < self.max_size:
+                self.batch_full.clear()
+
+            try:
+                outcomes = await loop.run_in_executor(self.executor, self.commit_batch, batch)
+            except Exception as e:
+                logger.error(f"Failed to commit a batch of {len(batch)} writes: {e}")
+                outcomes = [(False, e)] * len(batch)
+
+            for (_, _, future), (succeeded, result) in zip(batch, outcomes):
+                if future.done():
+                    continue  # The caller was cancelled, the write still went through
+                if succeeded:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+
+    def commit_batch(self, batch):
+        """Run a batch of writes in one transaction on the writer thread. Return (succeeded, result) per write."""
+        if self.conn is None:
+            self.conn = self.connect()
+        cursor = self.conn.cursor()
+
+        # Take the write lock once for the whole batch
+        started = time.perf_counter()
+        cursor.execute("BEGIN IMMEDIATE")
+        self.stats['total_lock_wait'] += time.perf_counter() - started
+        outcomes = []
+        try:
+            for write, args, _ in batch:
+                cursor.execute("SAVEPOINT batched_write")
+                try:
+                    outcomes.append((True, write(cursor, *args)))
+                    cursor.execute("RELEASE batched_write")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO batched_write")
+                    cursor.execute("RELEASE batched_write")
+                    outcomes.append((False, e))
+                    self.stats['failed_writes'] += 1
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self.stats['writes'] += len(batch)
+        self.stats['commits'] += 1
+        return outcomes
+
+    async def close(self):
+        """Commit what is still pending, then release the writer thread and its connection."""
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.executor is not None:
+            if self.conn is not None:
+                self.executor.submit(self.conn.close).result()
+                self.conn = None
+            self.executor.shutdown()
+            self.executor = None
+
+    def get_stats(self):
+        """Return the write and commit counters with the average writes per commit and latency."""
+        stats = dict(self.stats)
+        total_latency = stats.pop('total_latency')
+        total_lock_wait = stats.pop('total_lock_wait')
+        if stats['commits']:
+            stats['writes_per_commit'] = round(stats['writes'] / stats['commits'], 2)
+            stats['avg_lock_wait_ms'] = round(total_lock_wait / stats['commits'] * 1000, 2)
+        if stats['writes']:
+            stats['avg_latency_ms'] = round(total_latency / stats['writes'] * 1000, 2)
+        stats['enabled'] = self.enabled
+        stats['pending'] = len(self.pending)
+        return stats
+
+# Shared by the handlers of this worker, one per shard since each shard file has its own write lock
+write_batchers = {}
+
+def get_write_batcher(chat_id):
+    """Return the write batcher of the shard holding a chat's rows."""
+    shard = get_shard(chat_id)
+    if shard not in write_batchers:
+        # Batched writes only touch per-user tables, so the main database is not attached and stays unlocked
+        connect = (lambda: connect_shard(shard, attach_main=False)) if DATABASE_SHARDS > 1 else create_connection
+        write_batchers[shard] = WriteBatcher(connect)
+    return write_batchers[shard]
+
+async def close_write_batchers():
+    """Commit the writes still queued on every shard."""
+    for batcher in write_batchers.values():
+        await batcher.close()
+
+def get_write_stats():
+    """Return the write batcher stats, per shard when sharded."""
+    if DATABASE_SHARDS > 1:
+        return {f"shard{shard}": batcher.get_stats() for shard, batcher in sorted(write_batchers.items())}
+    return get_write_batcher(0).get_stats()
+
+def get_write_load():
+    """Return the writes waiting for a commit, the commits so far and their total wait for the write lock."""
+    batchers = list(write_batchers.values())
+    return sum(len(batcher.pending) for batcher in batchers), sum(batcher.stats['commits'] for batcher in batchers), sum(batcher.stats['total_lock_wait'] for batcher in batchers)
+
+async def run_benchmark(writer_counts, seconds, max_delay_ms, max_size):
+    """Measure ledger inserts and commits per second, committing every write alone and in groups."""
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'writes.db')
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE cashflow_ledger (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount INTEGER, description TEXT, transaction_date INTEGER)")
+    conn.close()
+
+    def insert_ledger_entry(cursor, user_id):
+        cursor.execute("INSERT INTO cashflow_ledger (user_id, amount, description, transaction_date) VALUES (?, ?, ?, ?)", (user_id, -100, 'Benchmark write.', int(time.time())))
+
+    print(f"{'writers':>8} {'mode':>10} {'writes/s':>10} {'commits/s':>10} {'avg (ms)':>9} {'p99 (ms)':>9}")
+    for writers in writer_counts:
+        for enabled in (False, True):
+            batcher = WriteBatcher(lambda: sqlite3.connect(path), enabled, max_delay_ms, max_size)
+            latencies = []
+            deadline = time.perf_counter() + seconds
+
+            async def writer(user_id):
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    await batcher.submit(insert_ledger_entry, user_id)
+                    latencies.append(time.perf_counter() - started)
+                    await asyncio.sleep(0)  # Let the other writers run, as handlers awaiting I/O would
+
+            started = time.perf_counter()
+            await asyncio.gather(*(writer(user_id) for user_id in range(writers)))
+            await batcher.close()
+            elapsed = time.perf_counter() - started
+
+            latencies.sort()
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f"{writers:>8} {'batched' if enabled else 'per write':>10} {len(latencies) / elapsed:>10,.0f} {batcher.stats['commits'] / elapsed:>10,.0f} "
+                  f"{sum(latencies) / len(latencies) * 1000:>9.2f} {p99 * 1000:>9.2f}")
+
+    shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark group commits of ledger writes.')
+    parser.add_argument('--writers', type=int, nargs='+', default=[1, 10, 100])  # Concurrent writers
+    parser.add_argument('--seconds', type=float, default=3)  # Duration of each run
+    parser.add_argument('--max-delay-ms', type=float, default=WRITE_BATCH_MAX_DELAY_MS)
+    parser.add_argument('--max-size', type=int, default=WRITE_BATCH_MAX_SIZE)
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.writers, args.seconds, args.max_delay_ms, args.max_size))
\ No newline at end of file
@@ -0,0 +1,130 @@
+import asyncio
+import glob
+import os
+import sys
+import tempfile
+import pytest
+
+# The modules read their configuration when imported, so point them at a scratch database first
+TEST_DIR = tempfile.mkdtemp(prefix='ffarm-tests-')
+os.environ['DATABASE_NAME'] = os.path.join(TEST_DIR, 'farming_game.db')
+os.environ['DATABASE_SHARDS'] = os.getenv('TEST_DATABASE_SHARDS', '1')  # Set to run the tests against sharded storage
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '1:test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+TEST_POSTGRES_DSN = os.getenv('TEST_POSTGRES_DSN')  # Also run the repository tests against PostgreSQL, in a scratch schema
+
+# Plants with equal min and max ratios, so every harvest event but a disaster yields planted quantity x ratio
+PLANTS = [
+    # id, name, category, emoji, min ratio, max ratio, seed price, harvest time (minutes), selling price, upgrade id
+    (1, 'Corn', 'Grain', '🌽', 2, 2, 1, 60, 10, None),
+    (2, 'Wheat', 'Grain', '🌾', 1, 1, 2, 30, 5, None),
+    (3, 'Rose', 'Flower', '🌹', 3, 3, 5, 120, 20, 4),
+]
+UPGRADES = [
+    # id, level, category, description, price
+    (1, 1, 'plot', 'Plot 1', 20),
+    (2, 2, 'plot', 'Plot 2', 40),
+    (3, 1, 'manager', 'Manager 1', 30),
+    (4, 1, 'crops', 'Roses', 50),
+]
+
+# Other photos the handlers send
+PHOTOS = ['crops_upgrade.jpg', 'harvested.webp', 'manager_harvest.webp', 'manager_planting.webp', 'manager_upgrade.webp',
+          'planted.webp', 'plot_upgrade.webp', 'rankings.jpeg', 'ready_for_harvest.jpg']
+
+class RecordingBot:
+    """Stands in for the Telegram bots and records what would have been sent."""
+
+    def __init__(self):
+        self.sent = []  # (method, chat_id, text or caption)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(('message', chat_id, text))
+
+    async def send_photo(self, chat_id, photo=None, caption=None, **kwargs):
+        if hasattr(photo, 'close'):
+            photo.close()
+        self.sent.append(('photo', chat_id, caption))
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.sent.append(('media_group', chat_id, None))
+
+    async def edit_message_text(self, chat_id=None, message_id=None, text=None, **kwargs):
+        self.sent.append(('edit', chat_id, text))
+
+    def texts(self, chat_id=None):
+        """Return the texts and captions sent, optionally to one chat."""
+        return [text for _, sent_chat_id, text in self.sent if chat_id in (None, sent_chat_id)]
+
+def close_shared_connections():
+    """Close the connections the shared repository keeps and forget the write batchers, closed with their event loop."""
+    from repository import repository
+    from write_batcher import write_batchers
+    write_batchers.clear()
+    asyncio.run(repository.close())
+
+@pytest.fixture
+def database():
+    """Create the tables in a new database with a small plant and upgrade catalog."""
+    from database import create_tables, create_connection
+    from menu_cache import invalidate_menus
+    from user_mgnt import known_chats
+
+    close_shared_connections()
+    for path in glob.glob(os.path.join(TEST_DIR, 'farming_game*')):
+        os.remove(path)
+    invalidate_menus()
+    known_chats.clear()
+
+    create_tables()
+    conn = create_connection()
+    with conn:
+        conn.executemany("""
+            INSERT INTO plants_listing (id, name, category, emoji, min_harvesting_ratio, max_harvesting_ratio,
+                                        seed_purchase_price, harvest_time, selling_price, upgrade_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, PLANTS)
+        conn.executemany("INSERT INTO upgrade_listings (id, level, category, description, price) VALUES (?, ?, ?, ?, ?)", UPGRADES)
+    conn.close()
+    create_tables()  # Copies the catalog into the shards
+
+    yield
+    close_shared_connections()
+
+@pytest.fixture
+def run(database):
+    """Return a function that runs a coroutine with the shared repository open, as the app's lifespan does."""
+    from repository import repository
+
+    def run(coroutine):
+        async def main():
+            await repository.open()
+            try:
+                return await coroutine
+            finally:
+                await repository.close()
+        return asyncio.run(main())
+    return run
+
+@pytest.fixture
+def bot(monkeypatch):
+    """Record the messages and photos the handlers send instead of calling Telegram."""
+    import importlib
+    from harvest_rules import HARVEST_EVENT_MESSAGES
+
+    # Handlers open their photos from ../images, relative to the working directory
+    os.makedirs(os.path.join(TEST_DIR, 'run'), exist_ok=True)
+    os.makedirs(os.path.join(TEST_DIR, 'images'), exist_ok=True)
+    for photo_path in [path for path, _ in HARVEST_EVENT_MESSAGES.values()] + [f'../images/{name}' for name in PHOTOS]:
+        open(os.path.join(TEST_DIR, 'run', photo_path), 'ab').close()
+    monkeypatch.chdir(os.path.join(TEST_DIR, 'run'))
+
+    recording_bot = RecordingBot()
+    for module_name in ('telegram_bot', 'harvest_crops', 'notifications', 'overload', 'farm_manager', 'planting', 'upgrades', 'admin', 'broadcast', 'background_task', 'harvest_batch', 'user_mgnt', 'game_menu', 'message_handler'):
+        module = importlib.import_module(module_name)
+        for name in ('bot', 'bulk_bot'):
+            if hasattr(module, name):
+                monkeypatch.setattr(module, name, recording_bot)
+    return recording_bot
@@ -0,0 +1,73 @@
+import time
+import pytest
+from repository import repository
+from test_manager_harvest import add_farmer, get_balances
+
+async def add_overdue_farmer(chat_id, quantity, planted_ago):
+    """Register a manager user with a crop of Corn that matured without being marked ready. Return the user."""
+    user, _ = await repository.register_user(chat_id, f'farmer{chat_id}', int(time.time()), 1000, 'Initial cashflow upon registration.')
+    await repository.set_manager_on_off(chat_id, 1)
+    await repository.record_planting(user, 1, quantity, quantity, f'Planted {quantity} Corn(s).', int(time.time()) - planted_ago, 100)
+    return await repository.get_user(chat_id)
+
+@pytest.mark.parametrize('mode', ['per_user', 'inline'])
+def test_catch_up_harvests_only_the_users_of_each_slice(run, bot, monkeypatch, mode):
+    import background_task
+    import farm_manager
+    monkeypatch.setattr(farm_manager, 'MANAGER_HARVEST_MODE', mode)
+    monkeypatch.setattr(background_task, 'CATCH_UP_SLICE_SIZE', 1)
+    monkeypatch.setattr(background_task, 'CATCH_UP_SLICE_INTERVAL', 0)
+    monkeypatch.setattr(background_task, 'CATCH_UP_NOTIFY_WINDOW', 0)
+
+    async def scenario():
+        # The older overdue crop is the first slice; the crop already ready is in no slice
+        second = await add_farmer(1002, 5)
+        first = await add_overdue_farmer(1001, 10, 10800)
+        third = await add_overdue_farmer(1003, 5, 7200)
+
+        slices = []
+        async def record_slice(users):
+            await farm_manager.handle_manager_auto_harvest(users)
+            slices.append(([user['chat_id'] for user in users], await get_balances([first, second, third])))
+        monkeypatch.setattr(background_task, 'handle_manager_auto_harvest', record_slice)
+
+        await background_task.run_catch_up(2, 2)
+        assert slices == [([1001], {1001: 1174, 1002: 995, 1003: 995}), ([1003], {1001: 1174, 1002: 995, 1003: 1087})]
+    run(scenario())
+
+def test_catch_up_and_pipeline_replant_of_one_manager_stay_within_the_plots(run, bot, monkeypatch):
+    import asyncio
+    import background_task
+    import farm_manager
+    import manager_pipeline
+    monkeypatch.setattr(background_task, 'CATCH_UP_SLICE_INTERVAL', 0)
+    monkeypatch.setattr(background_task, 'CATCH_UP_NOTIFY_WINDOW', 0)
+    monkeypatch.setattr(manager_pipeline, 'MANAGER_PIPELINE_BATCH_WAIT', 0)
+
+    async def scenario():
+        user = await add_overdue_farmer(1001, 10, 10800)
+        await repository.record_upgrade_purchase(user, 3, 30, 'Purchased manager upgrade to level 1', int(time.time()))
+        await repository.set_auto_planting(user, 1)
+
+        # The pipeline replants the manager while the catch-up replants them too, both finding 100 free plots
+        replant_queue = asyncio.Queue()
+        async def harvest_during_pipeline(users):
+            await farm_manager.harvest_manager_users(users)
+            await replant_queue.put(users[0])
+            await farm_manager.handle_manager_auto_planting(users)
+        monkeypatch.setattr(background_task, 'handle_manager_auto_harvest', harvest_during_pipeline)
+
+        replanted = manager_pipeline.pipeline_stats['replanted_users']
+        replant_stage = asyncio.create_task(manager_pipeline.run_replant_stage(replant_queue))
+        try:
+            await background_task.run_catch_up(1, 1)
+            while manager_pipeline.pipeline_stats['replanted_users'] == replanted:
+                await asyncio.sleep(0.01)
+        finally:
+            replant_stage.cancel()
+
+        # 1000 - 10 - 30 + 200 harvested less 8% payroll, less $1 per Corn planted in the 100 plots
+        assert await repository.get_occupied_plots(user) == 100
+        assert await repository.get_balance(user) == 1044
+        assert await repository.check_occupied_plots() == []
+    run(scenario())
\ No newline at end of file
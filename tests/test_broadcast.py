@@ -0,0 +1,58 @@
+import asyncio
+import time
+import pytest
+from repository import repository
+
+class InterruptingBot:
+    """Records broadcast sends and runs an action after a given number of them."""
+
+    def __init__(self, after, action):
+        self.sent = []
+        self.after = after
+        self.action = action
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if len(self.sent) == self.after:
+            self.action()
+        self.sent.append(chat_id)
+
+def test_broadcast_resumes_from_its_cursor(run, bot, monkeypatch):
+    import broadcast
+    from database import create_connection
+    monkeypatch.setattr(broadcast, 'BROADCAST_PAGE_SIZE', 2)
+    monkeypatch.setattr(broadcast, 'BROADCAST_RATE_PER_SECOND', 1000000)
+
+    async def scenario():
+        for chat_id in range(1001, 1008):
+            await repository.register_user(chat_id, f'farmer{chat_id}', int(time.time()), 50, 'Initial cashflow upon registration.')
+        conn = create_connection()
+        with conn:
+            conn.execute("UPDATE users SET reachability = 'blocked' WHERE chat_id = 1004")
+        conn.close()
+        job_id, total_recipients = broadcast.create_broadcast_job(1001, 'text', 'Harvest festival!')
+        assert total_recipients == 6
+
+        # Paused by the admin while the third message is sent, which still goes out
+        first = InterruptingBot(2, lambda: broadcast.set_broadcast_status(job_id, 'paused', ['running']))
+        monkeypatch.setattr(broadcast, 'bulk_bot', first)
+        await broadcast.run_broadcast_job(job_id)
+        assert first.sent == [1001, 1002, 1003]
+        assert broadcast.get_broadcast_job(job_id)[3:6] == ('paused', 3, 3)
+
+        # The worker dies during the second send after the resume; that chat is not sent to again
+        def die():
+            raise asyncio.CancelledError()
+        second = InterruptingBot(1, die)
+        monkeypatch.setattr(broadcast, 'bulk_bot', second)
+        assert broadcast.set_broadcast_status(job_id, 'running', ['paused'])
+        with pytest.raises(asyncio.CancelledError):
+            await broadcast.run_broadcast_job(job_id)
+        assert second.sent == [1005]
+
+        third = InterruptingBot(None, None)
+        monkeypatch.setattr(broadcast, 'bulk_bot', third)
+        await broadcast.run_broadcast_job(job_id)
+        assert third.sent == [1007]
+        assert broadcast.get_broadcast_job(job_id)[3:] == ('done', 7, 5, 1, 6)
+        assert bot.texts(1001)[-1] == f'📢 Broadcast #{job_id} (text): done - 6/6 processed, 5 sent, 1 failed.'
+    run(scenario())
\ No newline at end of file
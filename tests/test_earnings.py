@@ -0,0 +1,44 @@
+import time
+from repository import repository
+from test_manager_harvest import add_farmer
+
+def test_entries_are_rolled_up_per_user_and_day():
+    from earnings import roll_up_entries, SECONDS_PER_DAY
+
+    day = 20000
+    entries = [
+        (1, 50, 'Initial cashflow upon registration.', day * SECONDS_PER_DAY),
+        (1, -30, 'Planted 30 Corn(s).', day * SECONDS_PER_DAY + 60),
+        (1, 200, 'Harvested 20 Corn(s).', day * SECONDS_PER_DAY + 3660),
+        (1, -16, 'Manager payroll for harvesting 20 Corn(s).', day * SECONDS_PER_DAY + 3660),
+        (1, 5, 'Bonus.', (day + 1) * SECONDS_PER_DAY),
+        (2, -2, None, day * SECONDS_PER_DAY),
+    ]
+    assert sorted(roll_up_entries(entries)) == [(1, day, 250, 30, 16, 1, 4), (1, day + 1, 5, 0, 0, 0, 1), (2, day, 0, 2, 0, 0, 1)]
+
+def test_daily_earnings_follow_the_ledger(run, bot):
+    from database import create_connection
+    from earnings import create_daily_earnings, DAILY_EARNINGS_SELECT_SQL
+    from harvest_crops import harvest_crops
+
+    async def scenario():
+        user = await add_farmer(1001, 10)
+        await repository.add_ledger_entry(user, 5, 'Bonus.', int(time.time()) - 86400)
+        await harvest_crops(1001, interactive=True)
+
+        conn = create_connection(1001)  # The user's shard, as the rollups are rebuilt at startup
+        rollups = lambda: sorted(conn.execute("SELECT user_id, day, income, spend, payroll, harvests, entries FROM user_daily_earnings").fetchall())
+
+        # Written with each ledger entry, the rollups add up to the ledger
+        expected = sorted(conn.execute(DAILY_EARNINGS_SELECT_SQL).fetchall())
+        assert rollups() == expected
+        assert [row[2:] for row in expected if row[1] == max(row[1] for row in expected)] == [(1200, 10, 16, 1, 4)]
+        assert create_daily_earnings(conn.cursor()) is False
+
+        # Rollups that no longer add up are rebuilt from the ledger
+        with conn:
+            conn.execute("DELETE FROM user_daily_earnings WHERE income = 5")
+            assert create_daily_earnings(conn.cursor()) is True
+        assert rollups() == expected
+        conn.close()
+    run(scenario())
\ No newline at end of file
@@ -0,0 +1,18 @@
+import pytest
+from repository import repository
+from test_manager_harvest import add_farmer, get_balances
+
+@pytest.mark.parametrize('interactive, reported', [(True, True), (False, False)])
+def test_only_asked_for_harvests_are_reported_under_load(run, bot, monkeypatch, interactive, reported):
+    import overload
+    from harvest_crops import harvest_crops
+    monkeypatch.setitem(overload.overload_state, 'level', overload.LEVEL_ESSENTIAL)
+
+    async def scenario():
+        # A manager user pressing Harvest is answered; the manager's own harvests wait for the load to ease
+        user = await add_farmer(1001, 10)
+        await harvest_crops(1001, interactive=interactive)
+
+        assert await get_balances([user]) == {1001: 1174}
+        assert any(text.startswith('👨‍🌾 Manager harvest report') for text in bot.texts(1001)) is reported
+    run(scenario())
\ No newline at end of file
@@ -0,0 +1,93 @@
+import time
+import pytest
+from repository import repository
+
+async def add_farmer(chat_id, quantity, manager_on_off=1, cash=1000):
+    """Register a user with a mature, ready crop of Corn and their manager turned on or off. Return the user."""
+    now = int(time.time())
+    user, _ = await repository.register_user(chat_id, f'farmer{chat_id}', now, cash, 'Initial cashflow upon registration.')
+    await repository.set_manager_on_off(chat_id, manager_on_off)
+    await repository.record_planting(user, 1, quantity, quantity, f'Planted {quantity} Corn(s).', now - 7200, 100)
+    await repository.mark_due_crops_ready(now)
+    return await repository.get_user(chat_id)
+
+async def get_balances(users):
+    """Return the balance of each user by chat id."""
+    return {user['chat_id']: await repository.get_balance(user) for user in users}
+
+@pytest.mark.parametrize('mode', ['per_user', 'inline'])
+def test_harvest_only_the_given_manager_users(run, bot, monkeypatch, mode):
+    import farm_manager
+    monkeypatch.setattr(farm_manager, 'MANAGER_HARVEST_MODE', mode)
+
+    async def scenario():
+        first = await add_farmer(1001, 10)
+        second = await add_farmer(1002, 5)
+        await farm_manager.harvest_manager_users([first])
+
+        # Corn yields 2 per plant at $10, less 8% payroll: 1000 - 10 + 200 - 16
+        assert await get_balances([first, second]) == {1001: 1174, 1002: 995}
+        assert [crop['status'] for crop in await repository.get_crops(second)] == [1]
+
+        await farm_manager.harvest_manager_users([])
+        assert await get_balances([first, second]) == {1001: 1174, 1002: 995}
+    run(scenario())
+
+
+async def add_farm_group(offset):
+    """Register two manager users and one without a manager, with ready crops of several rows and plants."""
+    now = int(time.time())
+    users = []
+    for chat_id, manager_on_off, plantings in [
+        (offset + 1, 1, [(1, 10, 10800), (1, 4, 7200), (2, 3, 3600)]),
+        (offset + 2, 1, [(2, 5, 3600)]),
+        (offset + 3, 0, [(1, 5, 7200)]),
+    ]:
+        user, _ = await repository.register_user(chat_id, f'farmer{chat_id}', now, 1000, 'Initial cashflow upon registration.')
+        await repository.set_manager_on_off(chat_id, manager_on_off)
+        for item_id, quantity, planted_ago in plantings:
+            await repository.record_planting(user, item_id, quantity, quantity, f'Planted {quantity} of plant {item_id}.', now - planted_ago, 100)
+        users.append(await repository.get_user(chat_id))
+    await repository.mark_due_crops_ready(now)
+    return users
+
+async def get_farm_snapshot(users):
+    """Return each user's balance, ledger, crop statuses and occupied plots, in the order of users."""
+    snapshot = []
+    for user in users:
+        ledger = repository.connect(repository.shard_of(user)).execute("SELECT amount, description FROM cashflow_ledger WHERE user_id = ? ORDER BY amount, description", (user['id'],)).fetchall()
+        crops = sorted((crop['item_id'], crop['planted_quantity'], crop['status']) for crop in await repository.get_crops(user))
+        snapshot.append((await repository.get_balance(user), [tuple(row) for row in ledger], crops, await repository.get_occupied_plots(user)))
+    return snapshot
+
+@pytest.mark.parametrize('mode', ['inline', 'thread'])
+def test_batch_harvest_matches_the_per_user_harvest(run, bot, monkeypatch, mode):
+    import farm_manager
+    from harvest_batch import run_manager_harvest_batch
+    monkeypatch.setattr(farm_manager, 'MANAGER_HARVEST_MODE', 'per_user')
+
+    async def scenario():
+        per_user, batch = await add_farm_group(1000), await add_farm_group(2000)
+        await farm_manager.harvest_manager_users([user for user in per_user if user['manager_on_off'] == 1])
+        await run_manager_harvest_batch(mode, user_ids=[user['id'] for user in batch])
+
+        expected = await get_farm_snapshot(per_user)
+        # Corn pays 2 per plant at $10 and Wheat 1 at $5, less 8% payroll per plant; the third user has no manager
+        assert [balance for balance, _, _, _ in expected] == [1000 - 17 + 280 - 22 + 15 - 1, 1000 - 5 + 25 - 2, 995]
+        assert await get_farm_snapshot(batch) == expected
+    run(scenario())
+
+def test_a_manager_without_a_plot_upgrade_plants_the_basic_plots(run, bot):
+    import time
+    import farm_manager
+
+    async def scenario():
+        user, _ = await repository.register_user(1001, 'farmer1001', int(time.time()), 500, 'Initial cashflow upon registration.')
+        await repository.set_manager_on_off(1001, 1)
+        await repository.set_auto_planting(user, 1)
+        await repository.record_upgrade_purchase(user, 3, 30, 'Purchased manager upgrade to level 1', int(time.time()))
+
+        # Only the manager upgrade is owned, so the farm has the 100 plots of level 0
+        await farm_manager.handle_manager_auto_planting([await repository.get_user(1001)])
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user)) == (370, 100)
+    run(scenario())
\ No newline at end of file
@@ -0,0 +1,54 @@
+import asyncio
+import time
+import pytest
+from repository import repository
+from test_manager_harvest import add_farmer, get_balances
+
+async def run_pipeline_until(condition, timeout=5):
+    """Run the manager pipeline until condition() holds, then stop it."""
+    from manager_pipeline import run_manager_pipeline
+    pipeline = asyncio.create_task(run_manager_pipeline())
+    try:
+        for _ in range(int(timeout / 0.05)):
+            await asyncio.sleep(0.05)
+            if condition():
+                return
+        raise AssertionError('The manager pipeline did not get there in time.')
+    finally:
+        pipeline.cancel()
+        await asyncio.gather(pipeline, return_exceptions=True)
+
+def test_the_rescan_harvests_crops_the_schedule_missed(run, bot, monkeypatch):
+    import manager_pipeline
+    monkeypatch.setattr(manager_pipeline, 'MANAGER_PIPELINE_BATCH_WAIT', 0.05)
+    stats = manager_pipeline.pipeline_stats
+
+    async def scenario():
+        # Crops already ready at start are never scheduled, only the rescan finds them
+        first = await add_farmer(1001, 10)
+        second = await add_farmer(1002, 5, manager_on_off=0)
+        replanted = stats['replanted_users']
+        await run_pipeline_until(lambda: stats['replanted_users'] > replanted)
+
+        assert stats['running'] is False
+        assert await get_balances([first, second]) == {1001: 1174, 1002: 995}
+        assert await repository.get_crops(first) == []
+    run(scenario())
+
+def test_checkpoints_are_saved_below_the_crops_still_growing(run, bot, monkeypatch):
+    import manager_pipeline
+    monkeypatch.setattr(manager_pipeline, 'MANAGER_PIPELINE_BATCH_WAIT', 0.05)
+    stats = manager_pipeline.pipeline_stats
+
+    async def scenario():
+        first = await add_farmer(1001, 10)
+        second = await add_farmer(1002, 5)
+        await repository.record_planting(second, 2, 1, 2, 'Planted 1 Wheat(s).', int(time.time()), 100)
+        growing = [crop['id'] for crop in await repository.get_crops(second) if crop['status'] == 0]
+        replanted = stats['replanted_users']
+        await run_pipeline_until(lambda: stats['replanted_users'] > replanted and stats['scheduled'] == 1)
+
+        # A new leader resumes reading just below the Wheat, which is still growing
+        assert manager_pipeline.load_checkpoints()[repository.shard_of(second)] == growing[0] - 1
+        assert await get_balances([first]) == {1001: 1174}
+    run(scenario())
\ No newline at end of file
@@ -0,0 +1,43 @@
+import asyncio
+import pytest
+
+def test_levels_step_up_and_down_with_the_load(monkeypatch):
+    import overload
+    monkeypatch.setattr(overload, 'OVERLOAD_CONTROL', True)
+    monkeypatch.setattr(overload, 'OVERLOAD_SAMPLE_INTERVAL', 0)
+    monkeypatch.setattr(overload, 'OVERLOAD_STEP_UP_SAMPLES', 2)
+    monkeypatch.setattr(overload, 'OVERLOAD_STEP_DOWN_SAMPLES', 3)
+    monkeypatch.setattr(overload, 'overload_state', {'level': overload.LEVEL_NORMAL, 'level_changes': 0, 'changed_at': None, 'signals': {}})
+
+    # Writes waiting per sample against a queue depth limit of 64: overloaded at 64, calm below 32, held in between
+    pending_writes = [64, 64, 64, 64, 40, 64, 64, 64, 64, 0, 0, 0, 0, 0, 0, 40, 0, 0, 0, 0, 0, 0]
+    counters = [0] + pending_writes  # The first read is the baseline
+    levels = []
+
+    def read_counters():
+        levels.append(overload.get_level())
+        if len(levels) > len(counters):
+            raise asyncio.CancelledError()
+        return {'pending_writes': counters[len(levels) - 1], 'commits': 0, 'total_lock_wait': 0, 'rate_limited': 0}
+    monkeypatch.setattr(overload, 'OVERLOAD_LIMITS', dict(overload.OVERLOAD_LIMITS, queue_depth=64, loop_lag_ms=1000))
+    monkeypatch.setattr(overload, 'read_counters', read_counters)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(overload.run_overload_controller())
+
+    # The level after each sample
+    assert levels[2:] == [0, 1, 1, 2, 2, 2, 3, 3, 3, 3, 3, 2, 2, 2, 1, 1, 1, 1, 0, 0, 0, 0]
+    assert overload.get_overload_stats()['level_changes'] == 6
+    assert overload.get_overload_stats()['level_name'] == 'normal'
+
+def test_photos_become_text_once_degraded(bot, monkeypatch):
+    import overload
+
+    async def send_pictures():
+        await overload.send_picture(bot, 1001, '../images/harvested.webp', 'Harvested!')
+        await overload.send_picture(bot, 1001, '../images/planted.webp', 'Happy planting! 🌱', decorative=True)
+
+    asyncio.run(send_pictures())
+    monkeypatch.setitem(overload.overload_state, 'level', overload.LEVEL_TEXT_ONLY)
+    asyncio.run(send_pictures())
+    assert bot.sent == [('photo', 1001, 'Harvested!'), ('photo', 1001, 'Happy planting! 🌱'), ('message', 1001, 'Harvested!')]
\ No newline at end of file
@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+from repository import repository
+
+def test_plantings_are_charged_and_occupy_plots(run, bot):
+    from menu_cache import load_plant_data
+    from message_handler import handle_message
+
+    async def scenario():
+        plant_data, user_data = {}, {}
+        load_plant_data(plant_data)
+
+        async def send(text=None, callback_data=None):
+            await handle_message(1001, text, {'message': {'from': {'username': 'farmer1001'}}}, callback_data, user_data, plant_data)
+
+        await send('/home')
+        user = await repository.get_user(1001)
+        assert await repository.get_balance(user) == 50
+
+        # 30 Corn at $1 each
+        await send(callback_data='plant_Grain_1_1')
+        await send('30')
+        assert 'You have successfully planted 30 Corn(s) for $30!' in bot.texts(1001)
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user)) == (20, 30)
+
+        # 5 Roses would cost $25 with $20 left
+        await send(callback_data='plant_Flower_3_5')
+        await send('5')
+        assert bot.texts(1001)[-1] == 'You do not have enough balance to plant this quantity.'
+
+        # More Corn than the 100 plots of a new farm
+        await send(callback_data='plant_Grain_1_1')
+        await send('80')
+        assert bot.texts(1001)[-1] == 'You cannot plant more than the available slots.'
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user)) == (20, 30)
+
+        # Max plants as much Wheat as $20 buys at $2 each
+        await send(callback_data='plant_Grain_2_2')
+        await send(callback_data='max_2_2')
+        assert 'You have successfully planted 10 Wheat(s)!' in bot.texts(1001)
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user)) == (0, 40)
+        assert sorted((crop['item_id'], crop['planted_quantity']) for crop in await repository.get_crops(user)) == [(1, 30), (2, 10)]
+        assert await repository.check_occupied_plots() == []
+    run(scenario())
+
+def test_concurrent_max_plantings_are_charged_once(run, bot):
+    from menu_cache import load_plant_data
+    from message_handler import handle_message
+
+    async def scenario():
+        plant_data, user_data = {}, {}
+        load_plant_data(plant_data)
+
+        async def send(text=None, callback_data=None):
+            await handle_message(1001, text, {'message': {'from': {'username': 'farmer1001'}}}, callback_data, user_data, plant_data)
+
+        await send('/home')
+        user = await repository.get_user(1001)
+
+        # Both taps read $50 and 100 free plots, but only the first planting of 25 Wheat fits the balance
+        await send(callback_data='plant_Grain_2_2')
+        await asyncio.gather(send(callback_data='max_2_2'), send(callback_data='max_2_2'))
+        assert bot.texts(1001).count('You have successfully planted 25 Wheat(s)!') == 1
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user)) == (0, 25)
+    run(scenario())
\ No newline at end of file
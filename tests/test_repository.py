@@ -0,0 +1,247 @@
+import asyncio
+import os
+import time
+import pytest
+from conftest import TEST_POSTGRES_DSN
+
+# SQLite always, PostgreSQL when TEST_POSTGRES_DSN points at a server
+BACKENDS = ['sqlite'] + (['postgres'] if TEST_POSTGRES_DSN else [])
+
+@pytest.fixture(params=BACKENDS)
+def with_repository(request, database):
+    """Return a function that runs scenario(repository) against a new repository of the backend."""
+    from repository import SQLiteRepository, PostgresRepository
+
+    async def run_scenario(repository, scenario):
+        await repository.open()
+        try:
+            return await scenario(repository)
+        finally:
+            await repository.close()
+
+    async def main(scenario):
+        if request.param == 'sqlite':
+            return await run_scenario(SQLiteRepository(), scenario)
+
+        # A scratch schema per test, dropped afterwards
+        import asyncpg
+        schema = f'repository_test_{os.getpid()}'
+        admin = await asyncpg.connect(TEST_POSTGRES_DSN)
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        try:
+            return await run_scenario(PostgresRepository(TEST_POSTGRES_DSN, min_size=1, max_size=2, schema=schema), scenario)
+        finally:
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+            await admin.close()
+
+    return lambda scenario: asyncio.run(main(scenario))
+
+async def register(repository, chat_id=990000001, username='first', amount=50):
+    """Register a user with their initial cash and return them."""
+    user, _ = await repository.register_user(chat_id, username, int(time.time()), amount, 'Initial cashflow upon registration.')
+    return user
+
+def test_registration(with_repository):
+    async def scenario(repository):
+        now = int(time.time())
+        user, registered = await repository.register_user(990000001, 'first', now, 50, 'Initial cashflow upon registration.')
+        assert (registered, user['username'], await repository.get_balance(user)) == (True, 'first', 50)
+
+        # Registering again neither adds a user nor grants the cash twice
+        _, registered = await repository.register_user(990000001, 'first', now, 50, 'Initial cashflow upon registration.')
+        assert registered is False
+        assert await repository.get_balance(user) == 50
+        assert await repository.get_user(990000003) is None
+    with_repository(scenario)
+
+def test_concurrent_registrations_grant_once(with_repository):
+    async def scenario(repository):
+        results = await asyncio.gather(*(repository.register_user(990000001, 'first', int(time.time()), 50, 'Initial cashflow upon registration.') for _ in range(3)))
+        assert sorted(registered for _, registered in results) == [False, False, True]
+        assert await repository.get_balance(results[0][0]) == 50
+    with_repository(scenario)
+
+def test_postgres_grant_waits_without_the_sqlite_lock(with_repository):
+    import repository as repository_module
+    from database import create_connection
+
+    async def scenario(repository):
+        if not isinstance(repository, repository_module.PostgresRepository):
+            return  # SQLite grants the cash in the user's own transaction
+
+        # The first grant finds SQLite free for other writers, then fails and is retried
+        attempts = []
+        grant_initial_cash = repository.grant_initial_cash
+        async def failing_grant(*args):
+            attempts.append(args)
+            if len(attempts) == 1:
+                conn = create_connection()
+                conn.execute("PRAGMA busy_timeout = 0")
+                conn.execute("BEGIN IMMEDIATE")
+                conn.rollback()
+                conn.close()
+                raise ConnectionError('PostgreSQL went away.')
+            return await grant_initial_cash(*args)
+        repository.grant_initial_cash = failing_grant
+
+        user, registered = await repository.register_user(990000001, 'first', int(time.time()), 50, 'Initial cashflow upon registration.')
+        assert (registered, len(attempts), await repository.get_balance(user)) == (True, 2, 50)
+
+        # A grant lost after the user was committed is made up by the next registration, once
+        await repository.pool.execute("DELETE FROM cashflow_ledger WHERE user_id = $1", user['id'])
+        assert (await repository.register_user(990000001, 'first', int(time.time()), 50, 'Initial cashflow upon registration.'))[1] is False
+        await repository.register_user(990000001, 'first', int(time.time()), 50, 'Initial cashflow upon registration.')
+        assert await repository.get_balance(user) == 50
+    with_repository(scenario)
+
+def test_plantings_merge_per_ready_bucket(with_repository):
+    async def scenario(repository):
+        user = await register(repository)
+        now = int(time.time())
+
+        # Two plantings that become ready in the same bucket share a row; the third is ready an hour earlier
+        await repository.record_planting(user, 1, 3, 3, 'Planted 3 Corn(s).', now - 7200, 100)
+        await repository.record_planting(user, 1, 2, 2, 'Planted 2 Corn(s).', now - 7200, 100)
+        await repository.record_planting(user, 1, 4, 4, 'Planted 4 Corn(s).', now - 10800, 100)
+
+        assert sorted(crop['planted_quantity'] for crop in await repository.get_crops(user)) == [4, 5]
+        assert await repository.get_occupied_plots(user) == 9
+        assert await repository.get_balance(user) == 41
+    with_repository(scenario)
+
+def test_harvest_is_paid_once(with_repository):
+    async def scenario(repository):
+        user = await register(repository)
+        now = int(time.time())
+        await repository.record_planting(user, 1, 3, 3, 'Planted 3 Corn(s).', now - 7200, 100)
+        await repository.record_planting(user, 1, 4, 4, 'Planted 4 Corn(s).', now - 10800, 100)
+        assert await repository.mark_due_crops_ready(now) == {user['id']: 2}
+
+        ready_crops = await repository.get_ready_crops(user)
+        assert [(crop['item_id'], crop['quantity'], len(crop['crop_ids'])) for crop in ready_crops] == [(1, 7, 2)]
+        # The harvest rules multiply these by floats, so aggregates must come back as ints
+        assert (type(ready_crops[0]['quantity']), type(await repository.get_balance(user))) == (int, int)
+
+        harvest = (ready_crops[0]['crop_ids'], [(user['id'], 140, 'Harvested 14 Corn(s).', now)])
+        assert await repository.record_harvest(user, [harvest]) == [True]
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user), await repository.get_crops(user)) == (183, 0, [])
+
+        # Harvesting the same rows again frees and pays nothing
+        assert await repository.record_harvest(user, [harvest]) == [False]
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user)) == (183, 0)
+        assert await repository.check_occupied_plots() == []
+    with_repository(scenario)
+
+def test_concurrent_harvests_are_paid_once(with_repository):
+    async def scenario(repository):
+        user = await register(repository)
+        now = int(time.time())
+        await repository.record_planting(user, 1, 10, 10, 'Planted 10 Corn(s).', now - 7200, 100)
+        await repository.mark_due_crops_ready(now)
+        ready_crops = await repository.get_ready_crops(user)
+
+        harvest = (ready_crops[0]['crop_ids'], [(user['id'], 200, 'Harvested 20 Corn(s).', now)])
+        recorded = await asyncio.gather(repository.record_harvest(user, [harvest]), repository.record_harvest(user, [harvest]))
+        assert sorted(recorded) == [[False], [True]]
+        assert await repository.get_balance(user) == 240
+        assert await repository.get_occupied_plots(user) == 0
+    with_repository(scenario)
+
+def test_a_harvest_of_partly_harvested_crops_is_not_paid(with_repository):
+    async def scenario(repository):
+        user = await register(repository)
+        now = int(time.time())
+        await repository.record_planting(user, 1, 3, 3, 'Planted 3 Corn(s).', now - 7200, 100)
+        await repository.record_planting(user, 1, 4, 4, 'Planted 4 Corn(s).', now - 10800, 100)
+        await repository.mark_due_crops_ready(now)
+        crop_ids = (await repository.get_ready_crops(user))[0]['crop_ids']
+
+        assert await repository.record_harvest(user, [(crop_ids[:1], [(user['id'], 10, 'Harvested 1 Corn(s).', now)])]) == [True]
+        assert await repository.record_harvest(user, [(crop_ids, [(user['id'], 70, 'Harvested 7 Corn(s).', now)])]) == [False]
+        assert await repository.get_balance(user) == 53
+        assert [crop['id'] for crop in await repository.get_crops(user)] == crop_ids[1:]
+    with_repository(scenario)
+
+def test_crops_become_ready_only_once_mature(with_repository):
+    async def scenario(repository):
+        user = await register(repository)
+        now = int(time.time())
+        await repository.record_planting(user, 1, 1, 1, 'Planted 1 Corn(s).', now - 7200, 100)
+        await repository.record_planting(user, 2, 1, 2, 'Planted 1 Wheat(s).', now, 100)
+        crops = await repository.get_crops(user)
+
+        assert await repository.count_due_crops(now) == (1, 1)
+        await repository.mark_crops_ready(user, [crop['id'] for crop in crops])
+        assert [crop['status'] for crop in await repository.get_crops(user)] == [1, 0]
+        assert await repository.get_planted_crops(user, [crop['id'] for crop in crops]) == [(crops[1]['id'], user['id'], now + 1800)]
+    with_repository(scenario)
+
+def test_upgrades_and_auto_planting(with_repository):
+    async def scenario(repository):
+        user = await register(repository)
+        other = await register(repository, 990000002, 'second')
+        await repository.record_upgrade_purchase(user, 1, 20, 'Purchased plot upgrade to level 1', int(time.time()))
+        assert (await repository.get_upgrade_ids(user), await repository.get_balance(user)) == (frozenset({1}), 30)
+        assert await repository.get_entitlements(990000001) == (user, frozenset({1}))
+
+        assert await repository.get_auto_planting(other) is None
+        await repository.set_auto_planting(other, 1)
+        await repository.set_auto_planting(other, 2)
+        assert await repository.get_auto_planting(other) == 2
+    with_repository(scenario)
+
+def test_plantings_and_purchases_are_refused_in_their_transaction(with_repository):
+    from crops import REFUSED_BALANCE, REFUSED_PLOTS, REFUSED_OWNED
+
+    async def scenario(repository):
+        user = await register(repository)
+        now = int(time.time())
+
+        # Each write checks the plots and balance left by the writes committed before it
+        refusals = await asyncio.gather(*(repository.record_planting(user, 1, 40, 20, 'Planted 40 Corn(s).', now, 100) for _ in range(3)))
+        assert sorted(refusals, key=str) == [None, None, REFUSED_PLOTS]
+        assert await repository.record_planting(user, 1, 10, 20, 'Planted 10 Corn(s).', now, 100) == REFUSED_BALANCE
+        assert (await repository.get_balance(user), await repository.get_occupied_plots(user)) == (10, 80)
+
+        await repository.add_ledger_entry(user, 30, 'Bonus.', now)
+        refusals = await asyncio.gather(repository.record_upgrade_purchase(user, 1, 20, 'Purchased plot upgrade to level 1', now), repository.record_upgrade_purchase(user, 1, 20, 'Purchased plot upgrade to level 1', now))
+        assert sorted(refusals, key=str) == [None, REFUSED_OWNED]
+        assert await repository.record_upgrade_purchase(user, 2, 40, 'Purchased plot upgrade to level 2', now) == REFUSED_BALANCE
+        assert (await repository.get_upgrade_ids(user), await repository.get_balance(user)) == (frozenset({1}), 20)
+    with_repository(scenario)
+
+def test_rankings_windows(with_repository):
+    from earnings import get_day
+
+    async def scenario(repository):
+        now = int(time.time())
+        first = await register(repository, 990000001, 'first', 51)
+        second = await register(repository, 990000002, 'second')
+        assert await repository.get_rankings(10) == [('first', 51), ('second', 50)]
+
+        # Leaderboard windows count only the days they cover
+        await repository.add_ledger_entry(second, 5, 'Bonus.', now - 10 * 86400)
+        assert await repository.get_rankings(10) == [('second', 55), ('first', 51)]
+        assert await repository.get_rankings(10, get_day(now) - 1) == [('first', 51), ('second', 50)]
+    with_repository(scenario)
+
+def test_catch_up_serves_active_users_first(with_repository):
+    async def scenario(repository):
+        now = int(time.time())
+        first = await register(repository, 990000001, 'first')
+        second = await register(repository, 990000002, 'second')
+
+        _, checkpoints = await repository.get_planted_crops_since({})
+        await repository.record_planting(second, 2, 1, 0, 'Planted 1 Wheat(s).', now - 7200, 100)
+        await repository.record_planting(first, 2, 1, 0, 'Planted 1 Wheat(s).', now - 3600, 100)
+        crops_since, checkpoints = await repository.get_planted_crops_since(checkpoints)
+        assert sorted(user_id for _, user_id, _, _ in crops_since) == sorted([first['id'], second['id']])
+        assert (await repository.get_planted_crops_since(checkpoints))[0] == []
+
+        conn = repository.connect()
+        with conn:
+            conn.execute("UPDATE users SET last_seen_at = ? WHERE id = ?", (now, first['id']))
+        assert await repository.mark_due_crops_ready(now, limit=1, active_since=now - 60) == {first['id']: 1}
+        assert await repository.mark_due_crops_ready(now, limit=1, active_since=now + 60) == {second['id']: 1}
+        assert await repository.check_occupied_plots() == []
+    with_repository(scenario)
@@ -0,0 +1,39 @@
+import time
+import pytest
+from update_dedupe import UpdateWindow, UPDATE_DEDUPE_RESET_AFTER
+
+def test_window_drops_redeliveries():
+    window = UpdateWindow(16)
+    assert [window.check(update_id) for update_id in (100, 101, 100, 99, 99, 101)] == [True, True, False, True, False, False]
+
+    # Sliding forward forgets the ids that fall out of the window, which are then too old to tell
+    assert window.check(120) is True
+    assert (window.check(101), window.check(104), window.check(105), window.check(105)) == (False, False, True, False)
+
+def test_window_starts_over_after_a_quiet_period():
+    window = UpdateWindow(16)
+    window.check(5000)
+    assert window.check(10) is False
+
+    # Telegram starts from a new random id after a quiet week
+    window.updated_at = time.time() - UPDATE_DEDUPE_RESET_AFTER
+    assert (window.check(10), window.check(10), window.check(11)) == (True, False, True)
+
+def test_window_survives_a_restart(database, monkeypatch):
+    import update_dedupe
+    monkeypatch.setattr(update_dedupe, 'SHARED_STATE', False)
+    monkeypatch.setattr(update_dedupe, 'update_window', UpdateWindow(update_dedupe.UPDATE_DEDUPE_WINDOW))
+
+    assert [update_dedupe.accept_update(update_id) for update_id in (7, 8, 7)] == [True, True, False]
+    update_dedupe.save_update_window()
+
+    monkeypatch.setattr(update_dedupe, 'update_window', UpdateWindow(update_dedupe.UPDATE_DEDUPE_WINDOW))
+    update_dedupe.load_update_window()
+    assert [update_dedupe.accept_update(update_id) for update_id in (8, 9, None)] == [False, True, True]
+
+def test_workers_share_the_window(database, monkeypatch):
+    import update_dedupe
+    monkeypatch.setattr(update_dedupe, 'SHARED_STATE', True)
+
+    # Every call reads and writes the window in SQLite, as each worker does
+    assert [update_dedupe.accept_update(update_id) for update_id in (7, 8, 7, 8, 6)] == [True, True, False, False, True]
\ No newline at end of file
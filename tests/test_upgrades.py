@@ -0,0 +1,20 @@
+import asyncio
+import pytest
+from repository import repository
+
+def test_concurrent_confirmations_grant_the_upgrade_once(run, bot):
+    from message_handler import handle_message
+
+    async def scenario():
+        async def send(text=None, callback_data=None):
+            await handle_message(1001, text, {'message': {'from': {'username': 'farmer1001'}}}, callback_data, {}, {})
+
+        await send('/home')
+        user = await repository.get_user(1001)
+
+        # Both confirmations find the plot upgrade not owned yet; the second is refused by the purchase itself
+        await asyncio.gather(send(callback_data='confirm_upgrade_1'), send(callback_data='confirm_upgrade_1'))
+        assert bot.texts(1001).count('You already own this upgrade.') == 1
+        assert (await repository.get_upgrade_ids(user), await repository.get_balance(user)) == (frozenset({1}), 30)
+        assert repository.connect(repository.shard_of(user)).execute("SELECT COUNT(*) FROM user_upgrades WHERE user_id = ?", (user['id'],)).fetchone()[0] == 1
+    run(scenario())
\ No newline at end of file
@@ -0,0 +1,38 @@
+import pytest
+from repository import repository
+
+def test_known_chats_are_capped_least_recently_seen_first(run, bot, monkeypatch):
+    import user_mgnt
+    monkeypatch.setattr(user_mgnt, 'KNOWN_CHATS_MAX_SIZE', 2)
+
+    async def scenario():
+        for chat_id in (1001, 1002):
+            await user_mgnt.register_user(chat_id, {'message': {'from': {'username': f'farmer{chat_id}'}}})
+        assert bot.texts(1001) == ['Welcome to FFarm 🌾\nYou have been registered with $50 in your wallet.']
+
+        # Seeing 1001 again makes 1002 the least recently seen, forgotten when 1003 registers
+        user = await user_mgnt.get_known_user(1001)
+        await user_mgnt.register_user(1003, {'message': {'from': {'username': 'farmer1003'}}})
+        assert list(user_mgnt.known_chats) == [1001, 1003]
+        assert user == {'id': (await repository.get_user(1001))['id'], 'chat_id': 1001, 'username': 'farmer1001'}
+
+        # A forgotten chat is read again and remembered, an unregistered one is not
+        assert (await user_mgnt.get_known_user(1002))['username'] == 'farmer1002'
+        assert await user_mgnt.get_known_user(1004) is None
+        assert list(user_mgnt.known_chats) == [1003, 1002]
+    run(scenario())
+
+def test_known_entitlements_need_no_user_lookup(run, bot, monkeypatch):
+    import time
+    import user_mgnt
+
+    async def scenario():
+        await user_mgnt.register_user(1001, {'message': {'from': {'username': 'farmer1001'}}})
+        user = await user_mgnt.get_known_user(1001)
+        await repository.record_upgrade_purchase(user, 1, 20, 'Purchased plot upgrade to level 1', int(time.time()))
+
+        async def get_user(chat_id):
+            raise AssertionError('A known chat is not looked up.')
+        monkeypatch.setattr(repository, 'get_user', get_user)
+        assert await user_mgnt.get_known_entitlements(1001) == (user, frozenset({1}))
+    run(scenario())
\ No newline at end of file